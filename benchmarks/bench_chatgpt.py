@@ -0,0 +1,115 @@
+"""bench_chatgpt.py
+Load test ChatGPT against the local mock server, no network access needed.
+
+Measures throughput, latency, time to first token and memory with several requests in
+flight, both from threads and on the async engine.
+
+Usage:
+    python benchmarks/bench_chatgpt.py --requests 200 --concurrency 8
+"""
+import argparse
+import statistics
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from chatgpt4maya import chatgpt, engine  # noqa: E402
+from chatgpt4maya.mock_server import MockServer  # noqa: E402
+
+QUESTION = 'example create cube in mel and python'
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def new_api(url):
+    return chatgpt.ChatGPT(api_key='mock', save=False, use_cache=False, summarize=False, base_url=url)
+
+
+def stream_sync(url):
+    """Send one streamed message from the calling thread, returns (ttft, total, error)."""
+    api = new_api(url)
+    start = time.perf_counter()
+    first = None
+    for _ in api.stream_message(QUESTION):
+        if first is None:
+            first = time.perf_counter() - start
+    return first, time.perf_counter() - start, bool(api.history.get('error'))
+
+
+async def stream_async(url):
+    """Send one streamed message on the async engine, returns (ttft, total, error)."""
+    api = new_api(url)
+    start = time.perf_counter()
+    first = None
+    async for _ in api.stream_message_async(QUESTION):
+        if first is None:
+            first = time.perf_counter() - start
+    return first, time.perf_counter() - start, bool(api.history.get('error'))
+
+
+def run(mode, url, requests, concurrency):
+    tracemalloc.start()
+    start = time.perf_counter()
+    if mode == 'threads':
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda _: stream_sync(url), range(requests)))
+    else:
+        async_engine = engine.AsyncEngine(max_concurrency=concurrency)
+        futures = [async_engine.submit(stream_async(url)) for _ in range(requests)]
+        results = [future.result() for future in futures]
+        async_engine.stop()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ttfts = [ttft for ttft, _, error in results if ttft is not None and not error]
+    totals = [total for _, total, error in results if not error]
+    errors = sum(1 for _, _, error in results if error)
+    print(f'{mode:8} {requests} requests, concurrency {concurrency}')
+    print(f'  throughput   {requests / elapsed:8.1f} req/s')
+    print(f'  latency      p50 {percentile(totals, 50) * 1000:7.1f} ms   p95 {percentile(totals, 95) * 1000:7.1f} ms'
+          f'   mean {statistics.mean(totals) * 1000 if totals else 0:7.1f} ms')
+    print(f'  first token  p50 {percentile(ttfts, 50) * 1000:7.1f} ms   p95 {percentile(ttfts, 95) * 1000:7.1f} ms')
+    print(f'  peak memory  {peak / 1024 / 1024:8.1f} MB')
+    print(f'  errors       {errors:8d}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mode', choices=['threads', 'async', 'both'], default='both')
+    parser.add_argument('--latency', type=float, default=0.05, help='mock server latency in seconds')
+    parser.add_argument('--tokens-per-second', type=float, default=2000.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--respect-limits', action='store_true',
+                        help='keep the configured rate limits instead of lifting them')
+    args = parser.parse_args()
+
+    if not args.respect_limits:
+        chatgpt.SCHEDULER = chatgpt.RequestScheduler(requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12,
+                                                     base_delay=0.05)
+
+    server = MockServer(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                        error_rate=args.error_rate, retry_after=0.05).start()
+    try:
+        modes = ['threads', 'async'] if args.mode == 'both' else [args.mode]
+        for mode in modes:
+            run(mode, server.url, args.requests, args.concurrency)
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""bench_markdown.py
+Compare the markdown parser with the regex helpers it replaced, on multi-kilobyte replies.
+
+The old way split the reply with split_code_blocks and ran get_code_parts on every part,
+the parser does a single pass over the text and can be fed a streamed reply chunk by chunk.
+
+Usage:
+    python benchmarks/bench_markdown.py --size 16 --repeat 200
+"""
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from chatgpt4maya import markdown  # noqa: E402
+from chatgpt4maya.mock_server import MOCK_REPLY  # noqa: E402
+
+EXTRA = ('\n\nTo do this for every selected object:\n'
+         '\n'
+         '1. Select the objects in the outliner\n'
+         '2. Run the script below, it uses `cmds.ls(selection=True)`\n'
+         '- Undo with `ctrl+z` if you change your mind\n'
+         '\n'
+         '```python\n'
+         'for node in cmds.ls(selection=True):\n'
+         '    cmds.setAttr(node + ".visibility", False)\n'
+         '```\n\n')
+
+
+def reply(kilobytes):
+    """A reply of about the given size, made from the mock reply."""
+    block = MOCK_REPLY + EXTRA
+    return block * max(1, int(kilobytes * 1024 / len(block)))
+
+
+# The helpers the parser replaced, as they were, kept here for comparison
+def get_code_parts(part):
+    """
+    Extracts code parts from a given string using regex pattern matching.
+
+    Args:
+        part (str): The string to extract code parts from.
+
+    Returns:
+        list[str]: A list of strings containing the code parts found in the input string.
+
+    """
+    pattern = r"```(?:\w+\n)?([\s\S]+?)```"  # regex pattern to match code parts
+    code_parts = re.findall(pattern, part)  # extract code parts from input string using regex pattern matching
+    return code_parts  # return the list of code parts found in the input string
+
+
+def split_code_blocks(input_string):
+    """
+    Splits a string at triple ticks ``` code blocks.
+
+    Args:
+        input_string (str): The string to split.
+
+    Returns:
+        list[str]: A list of strings containing the code blocks and the text outside of the code blocks.
+
+    """
+    # Regex pattern to find code blocks
+    pattern = r'(```(?:\w+\n)?(?:[\s\S]+?)```)'
+    return re.split(pattern, input_string)  # split the input string at the code blocks using the regex pattern
+
+
+def old_parse(text):
+    # What ChatGPTMessage and ChatBubble used to do for every reply
+    parts = []
+    for part in split_code_blocks(text):
+        parts.append(get_code_parts(part) or part.strip())
+    return parts
+
+
+def streamed_parse(chunks):
+    parser = markdown.MarkdownParser()
+    segments = []
+    for chunk in chunks:
+        segments.extend(parser.feed(chunk))
+        parser.pending_text()
+    segments.extend(parser.close())
+    return segments
+
+
+def old_streamed_parse(chunks):
+    # Re-parsing everything received so far on every chunk is what rendering a stream with
+    # the old helpers would take
+    text = ''
+    for chunk in chunks:
+        text += chunk
+        old_parse(text)
+    return old_parse(text)
+
+
+def measure(name, function, argument, repeat, size):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(argument)
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f'  {name:24} {elapsed * 1000:8.3f} ms   {size / 1024 / 1024 / elapsed:8.1f} MB/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=float, default=16, help='size of the reply in kilobytes')
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--chunk', type=int, default=12, help='characters per streamed chunk')
+    args = parser.parse_args()
+
+    text = reply(args.size)
+    chunks = [text[i:i + args.chunk] for i in range(0, len(text), args.chunk)]
+    size = len(text.encode('utf-8'))
+    print(f'{size / 1024:.1f} KB reply, {len(markdown.parse(text))} segments, {len(chunks)} chunks')
+
+    measure('regex helpers', old_parse, text, args.repeat, size)
+    measure('parser', markdown.parse, text, args.repeat, size)
+    measure('parser, streamed', streamed_parse, chunks, args.repeat, size)
+    measure('regex helpers, streamed', old_streamed_parse, chunks, max(1, args.repeat // 100), size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""bench_syntax.py
+Compare how code blocks are highlighted with the highlighter it replaced, on large generated scripts.
+
+The old highlighter compiled its rules as QRegExps for every code block and scanned each
+line once per rule, it's timed highlighting a whole QTextDocument. Code blocks are now
+shown in a codeview.CodeView, which has the code tokenized by a shared lexer on a worker
+thread and formats lines as they're painted.
+
+To compare the same work the view is first timed until every line is formatted. Then
+it's timed until only the visible lines are formatted, which is what showing a code
+block costs, with an empty range cache and with the code already in it. Needs PySide2,
+run it with mayapy or a Python that has PySide2 installed.
+
+Usage:
+    mayapy benchmarks/bench_syntax.py --lines 5000 --repeat 5
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PySide2 import QtCore, QtGui, QtWidgets  # noqa: E402
+
+from chatgpt4maya import codeview, syntax  # noqa: E402
+from chatgpt4maya.syntax import STYLES  # noqa: E402
+
+SCRIPT = '''import maya.cmds as cmds
+
+
+class Rig(object):
+    """Builds a simple rig for the selected joints."""
+
+    def __init__(self, name, joints=None):
+        self.name = name
+        self.joints = joints or cmds.ls(selection=True, type='joint')
+
+    def build(self, radius=1.5):
+        # Make a control for every joint
+        controls = []
+        for index, joint in enumerate(self.joints):
+            control = cmds.circle(name="%s_%d_ctrl" % (self.name, index), radius=radius * 0.5)[0]
+            cmds.matchTransform(control, joint)
+            controls.append(control)
+        return controls
+'''
+
+
+def script(lines):
+    """A script of about the given number of lines."""
+    count = max(1, lines // SCRIPT.count('\n'))
+    return '\n'.join(SCRIPT.replace('Rig', f'Rig{i}') for i in range(count))
+
+
+class OldPythonHighlighter(QtGui.QSyntaxHighlighter):
+    # The highlighter as it was, kept here for comparison. It's from the Python Wiki,
+    # https://wiki.python.org/moin/PyQt/Python%20syntax%20highlighting under the Modified BSD License
+    keywords = [
+        'and', 'assert', 'break', 'class', 'continue', 'def',
+        'del', 'elif', 'else', 'except', 'exec', 'finally',
+        'for', 'from', 'global', 'if', 'import', 'in',
+        'is', 'lambda', 'not', 'or', 'pass', 'print',
+        'raise', 'return', 'try', 'while', 'yield',
+        'None', 'True', 'False',
+    ]
+    operators = [
+        '=', '==', '!=', '<', '<=', '>', '>=',
+        r'\+', '-', r'\*', '/', '//', r'\%', r'\*\*',
+        r'\+=', '-=', r'\*=', '/=', r'\%=',
+        r'\^', r'\|', r'\&', r'\~', '>>', '<<',
+    ]
+    braces = [r'\{', r'\}', r'\(', r'\)', r'\[', r'\]']
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.tri_single = (QtCore.QRegExp("'''"), 1, STYLES['string2'])
+        self.tri_double = (QtCore.QRegExp('"""'), 2, STYLES['string2'])
+        rules = []
+        rules += [(r'\b%s\b' % w, 0, STYLES['keyword']) for w in self.keywords]
+        rules += [(r'%s' % o, 0, STYLES['operator']) for o in self.operators]
+        rules += [(r'%s' % b, 0, STYLES['brace']) for b in self.braces]
+        rules += [
+            (r'\bself\b', 0, STYLES['self']),
+            (r'\bdef\b\s*(\w+)', 1, STYLES['defclass']),
+            (r'\bclass\b\s*(\w+)', 1, STYLES['defclass']),
+            (r'\b[+-]?[0-9]+[lL]?\b', 0, STYLES['numbers']),
+            (r'\b[+-]?0[xX][0-9A-Fa-f]+[lL]?\b', 0, STYLES['numbers']),
+            (r'\b[+-]?[0-9]+(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?\b', 0, STYLES['numbers']),
+            (r'"[^"\\]*(\\.[^"\\]*)*"', 0, STYLES['string']),
+            (r"'[^'\\]*(\\.[^'\\]*)*'", 0, STYLES['string']),
+            (r'#[^\n]*', 0, STYLES['comment']),
+            (r'\b[a-z][a-zA-Z]*\b(?=\()', 0, STYLES['function'])
+        ]
+        self.rules = [(QtCore.QRegExp(pat), index, fmt) for (pat, index, fmt) in rules]
+
+    def highlightBlock(self, text):
+        self.tripleQuoutesWithinStrings = []
+        for expression, nth, format in self.rules:
+            index = expression.indexIn(text, 0)
+            if index >= 0:
+                if expression.pattern() in [r'"[^"\\]*(\\.[^"\\]*)*"', r"'[^'\\]*(\\.[^'\\]*)*'"]:
+                    innerIndex = self.tri_single[0].indexIn(text, index + 1)
+                    if innerIndex == -1:
+                        innerIndex = self.tri_double[0].indexIn(text, index + 1)
+                    if innerIndex != -1:
+                        self.tripleQuoutesWithinStrings.extend(range(innerIndex, innerIndex + 3))
+            while index >= 0:
+                if index in self.tripleQuoutesWithinStrings:
+                    index += 1
+                    expression.indexIn(text, index)
+                    continue
+                index = expression.pos(nth)
+                length = len(expression.cap(nth))
+                self.setFormat(index, length, format)
+                index = expression.indexIn(text, index + length)
+        self.setCurrentBlockState(0)
+        if not self.match_multiline(text, *self.tri_single):
+            self.match_multiline(text, *self.tri_double)
+
+    def match_multiline(self, text, delimiter, in_state, style):
+        if self.previousBlockState() == in_state:
+            start = 0
+            add = 0
+        else:
+            start = delimiter.indexIn(text)
+            if start in self.tripleQuoutesWithinStrings:
+                return False
+            add = delimiter.matchedLength()
+        while start >= 0:
+            end = delimiter.indexIn(text, start + add)
+            if end >= add:
+                length = end - start + add + delimiter.matchedLength()
+                self.setCurrentBlockState(0)
+            else:
+                self.setCurrentBlockState(in_state)
+                length = len(text) - start + add
+            self.setFormat(start, length, style)
+            start = delimiter.indexIn(text, start + length)
+        return self.currentBlockState() == in_state
+
+
+def highlight_old(app, code, cached=False):
+    document = QtGui.QTextDocument()
+    document.setPlainText(code)
+    # Attaching a highlighter only schedules highlighting for the next event loop iteration
+    highlighter = OldPythonHighlighter(document)
+    highlighter.rehighlight()
+    return document
+
+
+def highlight(app, code, cached=False, whole=False):
+    if not cached:
+        syntax.RANGE_CACHE.clear()
+    view = codeview.CodeView(code, syntax.lexer_for(syntax.PYTHON))
+    view.resize(800, view.height())
+    # Wait for the ranges from the tokenizer thread, then format what would be painted first,
+    # or every line to do the same work as the old highlighter
+    while view._ranges is None:
+        app.processEvents(QtCore.QEventLoop.WaitForMoreEvents)
+    rect = view.viewport().rect()
+    if whole:
+        rect.setHeight(2 ** 30)
+    view.highlight(rect)
+    return view
+
+
+def highlight_whole(app, code, cached=False):
+    return highlight(app, code, cached, whole=True)
+
+
+def measure(name, function, app, code, repeat, lines, cached=False):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(app, code, cached)
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f'  {name:24} {elapsed * 1000:8.1f} ms   {lines / elapsed:10.0f} lines/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, default=5000, help='lines in the generated script')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # Documents and highlighters need an application, kept alive until the end
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+    code = script(args.lines)
+    lines = code.count('\n') + 1
+    print(f'{lines} lines, {len(code) / 1024:.1f} KB')
+
+    print('Whole document:')
+    measure('old highlighter', highlight_old, app, code, args.repeat, lines)
+    measure('code view', highlight_whole, app, code, args.repeat, lines)
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        syntax.PythonLexer().tokenize(code)
+    elapsed = (time.perf_counter() - start) / args.repeat
+    print(f'  {"lexer only":24} {elapsed * 1000:8.1f} ms   {lines / elapsed:10.0f} lines/s')
+
+    # Lines/s is of the whole script, though only the lines in view are formatted
+    print('Visible lines only:')
+    measure('code view', highlight, app, code, args.repeat, lines)
+    measure('code view, cached', highlight, app, code, args.repeat, lines, cached=True)
+
+    codeview.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,13 +6,13 @@ Inspired by https://github.com/JiachengXuGit/ChatGPTforNuke
 import logging
 import sys
 import os
-from maya import cmds, mel
+import maya.utils
 from maya import OpenMayaUI as omui
-from shiboken2 import wrapInstance
+from shiboken2 import wrapInstance, isValid
 from PySide2 import QtWidgets, QtCore, QtGui
-from chatgpt4maya import styles, chatgpt, syntax, helpers, config
-from chatgpt4maya.config import Config, MENU, BOT_USER, DATA_PATH
-from chatgpt4maya.helpers import placeholder_text, get_code_parts, random_string, split_code_blocks
+from chatgpt4maya import styles, chatgpt, syntax, config, engine, markdown, execution, workers, conversation, codeview
+from chatgpt4maya.config import Config, BOT_USER, DATA_PATH
+from chatgpt4maya.helpers import placeholder_text
 
 logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
 
@@ -104,8 +104,8 @@ class ConfigWindow(QtWidgets.QWidget):
         """Saves the values in the form to the configuration file.
 
         This function iterates over the items in the form, extracts the label and field
-        information, and saves each key-value pair to the configuration file using the
-        ConfigParser module. If a section label is encountered, the subsequent keys and
+        information, and saves each key-value pair to the configuration file in a single
+        batch. If a section label is encountered, the subsequent keys and
         values will be saved to that section until another section label is encountered.
 
         After saving, the appearance and text of the 'Save' button are updated to indicate
@@ -114,30 +114,32 @@ class ConfigWindow(QtWidgets.QWidget):
         # Set the default section to 'DEFAULT'
         section = 'DEFAULT'
 
-        # Iterate over the rows in the form layout
-        for i in range(self.form_layout.rowCount()):
-            # Get the label and field for the current row
-            field = self.form_layout.itemAt(i, QtWidgets.QFormLayout.FieldRole)
-            if field:
-                label = self.form_layout.itemAt(i, QtWidgets.QFormLayout.LabelRole)
-
-                # Extract the key and value from the label and field widgets
-                key = label.widget().text()
-                value = field.widget().text()
-
-                # Log a message indicating the key-value pair being saved
-                logging.info(f'Saving "{key} = {value}" to config')
-
-                # Save the key-value pair to the configuration file
-                self.config.set(section, key, value)
-            else:
-                # If a label is encountered without a corresponding field, it is assumed
-                # to be a section label, and subsequent keys and values will be saved to
-                # that section until another section label is encountered.
-                label = self.form_layout.itemAt(i, QtWidgets.QFormLayout.LabelRole)
-                widget = label.widget()
-                if isinstance(widget, QtWidgets.QLabel):
-                    section = widget.text()
+        # Collect all rows and write the file once
+        with self.config.batch():
+            # Iterate over the rows in the form layout
+            for i in range(self.form_layout.rowCount()):
+                # Get the label and field for the current row
+                field = self.form_layout.itemAt(i, QtWidgets.QFormLayout.FieldRole)
+                if field:
+                    label = self.form_layout.itemAt(i, QtWidgets.QFormLayout.LabelRole)
+
+                    # Extract the key and value from the label and field widgets
+                    key = label.widget().text()
+                    value = field.widget().text()
+
+                    # Log a message indicating the key-value pair being saved
+                    logging.info(f'Saving "{key} = {value}" to config')
+
+                    # Save the key-value pair to the configuration file
+                    self.config.set(section, key, value)
+                else:
+                    # If a label is encountered without a corresponding field, it is assumed
+                    # to be a section label, and subsequent keys and values will be saved to
+                    # that section until another section label is encountered.
+                    label = self.form_layout.itemAt(i, QtWidgets.QFormLayout.LabelRole)
+                    widget = label.widget()
+                    if isinstance(widget, QtWidgets.QLabel):
+                        section = widget.text()
 
         # Update the appearance and text of the 'Save' button to indicate that the changes
         # have been saved
@@ -147,31 +149,81 @@ class ConfigWindow(QtWidgets.QWidget):
 
 
 class ChatGPTMessage(QtCore.QObject):
-    response = QtCore.Signal(list)
+    """
+    Sends a message on the async engine and reports back through Qt signals.
+
+    The signals are emitted from the engine thread with the message as first argument.
+    Connect them to methods of widgets so the slots run queued on the main thread.
+
+    Replies are parsed into markdown segments on the engine thread. While streaming, chunk
+    is emitted with the segments completed so far and the text of the one in progress,
+    response is emitted with the remaining segments when the reply is done.
+    """
+    response = QtCore.Signal(object, list)
     messages = QtCore.Signal(list)
+    chunk = QtCore.Signal(object, list, str)
 
-    def __init__(self, api, content, parent=None, *args, **kwargs):
+    def __init__(self, api, content, stream=True, parent=None, *args, **kwargs):
         super().__init__(parent, *args, **kwargs)
         self.api = api
         self.content = content
+        self.stream = stream
+        self.future = None
 
     def request(self):
+        """
+        Submit the message to the async engine.
+
+        Messages sent with the same api are answered one at a time, in order.
+
+        Returns:
+            concurrent.futures.Future: A future that is done when the reply has been emitted.
+        """
         logging.info(f'Sending message "{self.content}"')
-        response = self.api.send_message(self.content)
+        coroutine = self._stream() if self.stream else self._send()
+        self.future = engine.engine().submit(coroutine, key=self.api)
+        self.future.add_done_callback(self._done)
+        return self.future
+
+    def cancel(self):
+        """Stop waiting for the reply, it is not added to the conversation."""
+        if self.future is not None:
+            self.future.cancel()
+
+    async def _send(self):
+        response = await self.api.send_message_async(self.content)
+        self._emit_response(response)
+
+    async def _stream(self):
+        # Emit the reply piece by piece as it is generated
+        parser = markdown.MarkdownParser()
+        async for delta in self.api.stream_message_async(self.content):
+            self.chunk.emit(self, parser.feed(delta), parser.pending_text())
+        self._emit_response(self.api.history, parser)
+
+    def _done(self, future):
+        # Make sure the window always gets a reply, even if something unexpected went wrong
+        if future.cancelled():
+            self._emit_response({'error': 'The request was cancelled'})
+        elif future.exception():
+            logging.error(future.exception())
+            self._emit_response({'error': future.exception()})
+
+    def _emit_response(self, response, parser=None):
         if response.get('error'):
-            # Split response at code blocks
-            response_message = [
-                f"Uh oh, I must've gotten a little lost in my own thoughts there... Check the log for more info.",
-                f"```{response['error']}```"]
-            logging.warning(f'ChatGPT had an error "{response["error"][:48]}..."')
-            self.response.emit([response_message])
+            response_message = markdown.parse(
+                f"Uh oh, I must've gotten a little lost in my own thoughts there... Check the log for more info.\n"
+                f"\n"
+                f"```\n{response['error']}\n```")
+            logging.warning(f'ChatGPT had an error "{str(response["error"])[:48]}..."')
+            self.response.emit(self, response_message)
         else:
-            # Split response at code blocks
             response_message = response['choices'][0]['message']
             response_content = response_message['content']
-            split_content = split_code_blocks(response_content)
             logging.info(f'ChatGPT replied "{response_content[:48]}..."')
-            self.response.emit(split_content)
+            # A streamed reply has already been parsed up to the last segment
+            segments = parser.close() if parser else markdown.parse(response_content)
+            self.response.emit(self, segments)
 
 
 class Button(QtWidgets.QPushButton):
@@ -196,13 +248,6 @@ class ChatBubbleUsername(ChatBubbleText):
         super().__init__(text=username, selector='heading', selectable=False, *args, **kwargs)
 
 
-class ChatBubbleCode(ChatBubbleText):
-    def __init__(self, content, *args, **kwargs):
-        super().__init__(text=content, selector='code', selectable=True, *args, **kwargs)
-        text_document = self.findChild(QtGui.QTextDocument)
-        highlight = syntax.PythonHighlighter(text_document)
-
-
 class ChatBubbleParagraph(ChatBubbleText):
     def __init__(self, content, *args, **kwargs):
         super().__init__(text='<p style="line-height: 1.4;">{text}</p>'.format(text=content.replace("\n", "<br>")),
@@ -213,7 +258,7 @@ class ChatBubbleParagraph(ChatBubbleText):
 
 class ChatBubble(QtWidgets.QFrame):
     # Define the __init__ method, which is called when an instance of the class is created
-    def __init__(self, user: str, content: list, is_bot=True, parent=None):
+    def __init__(self, user: str, content, is_bot=True, parent=None, message=None):
         # Call the __init__ method of the parent class
         super().__init__(parent)
 
@@ -237,43 +282,120 @@ class ChatBubble(QtWidgets.QFrame):
         layout = QtWidgets.QVBoxLayout()
         layout.addWidget(label_user)
 
-        # Iterate through each part of the content and add it to the layout
-        for part in content:
-            # Check if the part contains code blocks
-            code_parts = get_code_parts(part)
-            if code_parts:
-                # If it does, create a code block widget
-                widget_content = self.code_block(code_parts)
-            else:
-                # If it doesn't, create a paragraph widget
-                widget_content = ChatBubbleParagraph(part.strip())
-            # Add the widget to the layout
-            layout.addWidget(widget_content)
-
         # Set the layout of the frame to the QVBoxLayout object
         self.setLayout(layout)
 
-    def code_block(self, code_parts):
-        """Create a code block with syntax highlighting and run/copy buttons
+        # The message shown, it keeps the state of the code blocks when the bubble is
+        # deleted because it scrolled out of view
+        self.message = message if message is not None else conversation.Message.from_content(user, content, is_bot)
+
+        # The segment of a streamed reply that is still being received
+        self.label_stream = None
+
+        # Code blocks by id, for running and copying them
+        self.code_blocks = {}
+        self.rendered_segments = 0
+
+        self.update_message(self.message)
+
+    def set_content(self, content):
+        """Replace the content of the bubble.
 
         Args:
-            code_parts:
+            content (list): Segments of the message, or strings of markdown.
+        """
+        layout = self.layout()
+
+        # Remove everything except the username
+        for i in reversed(range(1, layout.count())):
+            widget = layout.takeAt(i).widget()
+            if widget:
+                widget.deleteLater()
+        self.label_stream = None
+        self.code_blocks = {}
+        self.rendered_segments = 0
+
+        self.message.segments = conversation.Message.from_content(self.message.user, content).segments
+        self.message.stream_text = ''
+        self.message.statuses = {}
+        self.update_message(self.message)
+
+    def update_message(self, message):
+        """Show what was added to the message since the bubble was last updated.
+
+        Args:
+            message (conversation.Message): The message of the bubble.
 
         Returns:
+            bool: Always True, a bubble can show any message.
+        """
+        self.add_segments(message.segments[self.rendered_segments:])
+        self.set_stream_text(message.stream_text)
+        for code_block_id, status in message.statuses.items():
+            if code_block_id in self.code_blocks:
+                self._apply_status(code_block_id, *status)
+        return True
+
+    def add_segments(self, segments):
+        """Add segments to the end of the bubble, before the streamed text if there is any.
+
+        Args:
+            segments (list[markdown.Segment]): The segments to add.
+        """
+        layout = self.layout()
+        for segment in segments:
+            if segment.kind == markdown.CODE:
+                widget_content = self.code_block(segment)
+            else:
+                widget_content = ChatBubbleParagraph(markdown.to_html(segment))
+            if self.label_stream is None:
+                layout.addWidget(widget_content)
+            else:
+                layout.insertWidget(layout.indexOf(self.label_stream), widget_content)
+        self.rendered_segments += len(segments)
+
+    def set_stream_text(self, text):
+        """Show the text of the segment of a streamed reply that is still being received.
 
+        Args:
+            text (str): The text, an empty string removes it.
         """
-        self.code_block_id = random_string()
-        code_block_id = random_string()
+        if not text:
+            if self.label_stream is not None:
+                self.layout().removeWidget(self.label_stream)
+                self.label_stream.deleteLater()
+                self.label_stream = None
+            return
+
+        if self.label_stream is None:
+            self.label_stream = ChatBubbleText('')
+            self.label_stream.setTextFormat(QtCore.Qt.PlainText)
+            self.layout().addWidget(self.label_stream)
+        self.label_stream.setText(text)
+
+    def code_block(self, segment):
+        """Create a code block with syntax highlighting and run/copy buttons
+
+        Args:
+            segment (markdown.Segment): The code segment.
+
+        Returns:
+            QtWidgets.QFrame: The code block.
+        """
+        # Ids follow the order of the blocks, so a new bubble for the same message gets the same ids
+        code_block_id = f'code-block-{len(self.code_blocks)}'
+        self.code_blocks[code_block_id] = segment
         frame = QtWidgets.QFrame()
         frame_layout = QtWidgets.QVBoxLayout()
         frame.setProperty('selector', 'code')
 
-        # Add code
-        for code in code_parts:
-            label_code = ChatBubbleCode(code.strip())
-            label_code.setProperty('code-block-id', code_block_id)
-            label_code.setObjectName(code_block_id)
-            frame_layout.addWidget(label_code)
+        # Add code, highlighted off the main thread and collapsed when long
+        language = execution.detect_language(segment.text, segment.language)
+        code_viewer = codeview.CodeViewer(segment.text.strip(), syntax.lexer_for(language))
+        code_viewer.view.setProperty('code-block-id', code_block_id)
+        code_viewer.view.setProperty('language', segment.language or '')
+        code_viewer.view.setObjectName(code_block_id)
+        frame_layout.addWidget(code_viewer)
         frame.setLayout(frame_layout)
 
         # Buttons
@@ -286,37 +408,154 @@ class ChatBubble(QtWidgets.QFrame):
         self.button_copy.setProperty('code-block-id', code_block_id)
         self.button_copy.clicked.connect(lambda: self.copy_code(code_block_id))
 
+        self.button_profile = Button('Profile')
+        self.button_profile.setProperty('code-block-id', code_block_id)
+        self.button_profile.setToolTip('Run the code and show where the time went')
+        self.button_profile.clicked.connect(lambda: self.run_code(code_block_id, profile=True))
+
+        self.button_preview = Button('Preview')
+        self.button_preview.setProperty('code-block-id', code_block_id)
+        self.button_preview.setToolTip('Try the code on a copy of the scene in the background')
+        self.button_preview.clicked.connect(lambda: self.preview_code(code_block_id))
+
         buttons_layout.addWidget(self.button_run)
+        buttons_layout.addWidget(self.button_preview)
         buttons_layout.addWidget(self.button_copy)
+        buttons_layout.addWidget(self.button_profile)
         frame_layout.addLayout(buttons_layout)
+
+        # Outcome of the last run
+        label_status = ChatBubbleText('', selector='status')
+        label_status.setObjectName(f'{code_block_id}-status')
+        label_status.setVisible(False)
+        frame_layout.addWidget(label_status)
+
+        # Hotspots of the last profiled run
+        label_profile = ChatBubbleText('', selector='profile', word_wrap=False)
+        label_profile.setTextFormat(QtCore.Qt.PlainText)
+        label_profile.setObjectName(f'{code_block_id}-profile')
+        label_profile.setVisible(False)
+        frame_layout.addWidget(label_profile)
         return frame
 
-    def run_code(self, code_block_id):
+    def run_code(self, code_block_id, profile=False):
+        """Run a code block as Python or MEL when Maya is idle and show how it went under the block.
+
+        The code runs as a single undo step, with the viewport refresh suspended unless
+        SuspendRefresh is 0 in the Execution section of the config, and with the evaluation
+        manager off if SuspendEvaluation is 1. If RequirePreview is 1 only code that was
+        previewed without errors is run.
+
+        Args:
+            code_block_id (str): The id of the code block.
+            profile (bool, optional): Run under cProfile and show the hotspots. Defaults to False.
+        """
         logging.info(f'Running code block #{code_block_id}')
-        code_block_label = self.findChild(QtWidgets.QLabel, code_block_id)
-        code = code_block_label.text()
+        segment = self.code_blocks[code_block_id]
+        code = segment.text.strip()
         logging.debug(code)
+        settings = Config()
+        if settings.get('Execution', 'RequirePreview', '0') == '1' and code not in self.message.proven_code:
+            self.set_status(code_block_id, 'Preview the code before running it', success=False)
+            return
+
+        self.set_status(code_block_id, 'Profiling...' if profile else 'Running...')
+        suspend_refresh = settings.get('Execution', 'SuspendRefresh', '1') != '0'
+        suspend_evaluation = settings.get('Execution', 'SuspendEvaluation', '0') == '1'
+        execution.run_deferred(code, segment.language,
+                               callback=lambda result: self.show_status(code_block_id, result),
+                               suspend_refresh=suspend_refresh,
+                               suspend_evaluation=suspend_evaluation,
+                               profile=profile)
+
+    def preview_code(self, code_block_id):
+        """Run a code block on a copy of the scene in a mayapy worker.
+
+        The whole scene is copied, or only the selection if PreviewScene is selection in the
+        Execution section of the config. Several blocks can be previewed at the same time,
+        up to PreviewWorkers of them run in parallel.
+
+        Args:
+            code_block_id (str): The id of the code block.
+        """
+        logging.info(f'Previewing code block #{code_block_id}')
+        segment = self.code_blocks[code_block_id]
+        code = segment.text.strip()
+        settings = Config()
+        self.set_status(code_block_id, 'Previewing...')
+        scene = None
         try:
-            logging.debug('Running python')
-            exec(code)
-        except SyntaxError as e:
-            try:
-                logging.debug('Running mel')
-                exec(f'mel.eval("{code}")')
+            scene = workers.snapshot(selection=settings.get('Execution', 'PreviewScene', 'scene') == 'selection')
+            pool = workers.pool(int(settings.get('Execution', 'PreviewWorkers', '2')))
+            future = pool.submit(code, segment.language, scene)
+        except Exception as e:
+            logging.error(f'Could not preview code block #{code_block_id}: {e}')
+            if scene:
+                workers.remove_snapshot(scene)
+            error = str(e).strip() or type(e).__name__
+            self.show_preview(code_block_id,
+                              workers.PreviewResult(execution.ExecutionResult(None, success=False, error=error)))
+            return
+        # Exported scenes can be large, each is deleted as soon as its preview is done
+        future.add_done_callback(lambda f: workers.remove_snapshot(scene))
+        future.add_done_callback(lambda f: self._preview_done(code_block_id, f))
+
+    def _preview_done(self, code_block_id, future):
+        # Called on a pool thread, the result is shown from the main thread
+        if future.cancelled() or future.exception():
+            error = 'The preview was cancelled' if future.cancelled() else str(future.exception())
+            preview = workers.PreviewResult(execution.ExecutionResult(None, success=False, error=error))
+        else:
+            preview = future.result()
+        maya.utils.executeDeferred(self.show_preview, code_block_id, preview)
+
+    def show_preview(self, code_block_id, preview):
+        """Show the outcome of a preview under the code block."""
+        if preview.success:
+            self.message.proven_code.add(self.code_blocks[code_block_id].text.strip())
+        self.set_status(code_block_id, preview.summary(), preview.success, preview.result.details)
+
+    def show_status(self, code_block_id, result):
+        """Show the outcome of running a code block under it."""
+        self.set_status(code_block_id, result.summary(), result.success, result.details,
+                        result.profile.summary() if result.profile else None)
 
-            except Exception as e:
-                logging.error(e)
+    def set_status(self, code_block_id, text, success=True, details=None, profile=None):
+        """Set the status line, and the hotspots of a profiled run, under a code block.
+
+        The status is kept in the message, so it's still there if the bubble is deleted
+        and created again when it scrolls back into view.
+        """
+        self.message.statuses[code_block_id] = (text, success, details, profile)
+        if isValid(self):
+            self._apply_status(code_block_id, text, success, details, profile)
+        else:
+            # The bubble was deleted while the code was running
+            self.message.notify()
+
+    def _apply_status(self, code_block_id, text, success, details, profile):
+        label_status = self.findChild(QtWidgets.QLabel, f'{code_block_id}-status')
+        label_status.setText(text)
+        label_status.setToolTip(details or '')
+        label_status.setProperty('success', success)
+        label_status.style().unpolish(label_status)
+        label_status.style().polish(label_status)
+        label_status.setVisible(True)
+
+        label_profile = self.findChild(QtWidgets.QLabel, f'{code_block_id}-profile')
+        label_profile.setText(profile or '')
+        label_profile.setVisible(profile is not None)
 
     def copy_code(self, code_block_id):
         logging.info(f'Copying code block #{code_block_id}')
-        code_block_label = self.findChild(QtWidgets.QLabel, code_block_id)
-        logging.debug(code_block_label.text())
+        code = self.code_blocks[code_block_id].text.strip()
+        logging.debug(code)
         app = QtWidgets.QApplication.instance()
         if app is None:
             # if it does not exist then a QApplication is created
             app = QtWidgets.QApplication([])
         clipboard = app.clipboard()
-        clipboard.setText(code_block_label.text(), QtGui.QClipboard.Clipboard)
+        clipboard.setText(code, QtGui.QClipboard.Clipboard)
 
 
 class Spinner(QtWidgets.QFrame):
@@ -340,6 +579,26 @@ class Spinner(QtWidgets.QFrame):
         layout.addWidget(label)
         self.setLayout(layout)
 
+    def update_message(self, message):
+        """The spinner can only show a message that hasn't received anything yet."""
+        return message.pending and not message.segments and not message.stream_text
+
+
+def message_widget(message, parent=None):
+    """
+    Create the widget of a message in the conversation view.
+
+    Args:
+        message (conversation.Message): The message.
+        parent (QtWidgets.QWidget, optional): Parent widget. Defaults to None.
+
+    Returns:
+        QtWidgets.QWidget: A spinner while waiting for a reply, otherwise a ChatBubble.
+    """
+    if message.pending and not message.segments and not message.stream_text:
+        return Spinner(parent=parent)
+    return ChatBubble(message.user, message.segments, message.is_bot, parent, message=message)
+
 
 class ChatWindow(QtWidgets.QWidget):
     def __init__(self, *args, **kwargs):
@@ -347,10 +606,13 @@ class ChatWindow(QtWidgets.QWidget):
         self.config = Config()
 
         # Setup api
-        self.api = chatgpt.ChatGPT(api_key=self.config.get('OpenAI', 'OpenAIApiKey', os.getenv('OPENAI_API_KEY')))
+        self.api = chatgpt.ChatGPT(api_key=self.config.get('OpenAI', 'OpenAIApiKey', os.getenv('OPENAI_API_KEY')),
+                                   base_url=self.config.get('OpenAI', 'OpenAIBaseUrl'))
 
         self.user = os.getlogin().title()
         self.margin = styles.Margin.large
+        # Message of each request waiting for a reply
+        self.pending_replies = {}
 
         self.setWindowFlags(QtCore.Qt.Window)
         self.setObjectName('ChatGPTWindow')
@@ -368,29 +630,18 @@ class ChatWindow(QtWidgets.QWidget):
         self.main_layout.setSpacing(0)
         self.main_layout.setMargin(0)
 
-        # conversation section
-        self.conversation_scroll_area = QtWidgets.QScrollArea()
-        self.scrollbar = QtWidgets.QScrollBar()
-        self.conversation_scroll_area.setVerticalScrollBar(self.scrollbar)
-        self.conversation_scroll_area.setWidgetResizable(True)
-        self.conversation_scroll_area.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAsNeeded)
-        self.conversation_scroll_area.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        # conversation section, only the messages in view get widgets
+        self.conversation_model = conversation.ConversationModel(self)
+        self.conversation_view = conversation.ConversationView(self.conversation_model, message_widget)
+        self.conversation_view.setObjectName('conversation-view')
+        self.conversation_view.setSpacing(self.margin // 2)
+        self.scrollbar = self.conversation_view.verticalScrollBar()
+        # New content only scrolls the view if it was at the bottom, so older messages can be
+        # read while their measured heights change the range
+        self.follow_bottom = True
+        self.scrollbar.valueChanged.connect(self.update_follow_bottom)
         self.scrollbar.rangeChanged.connect(self.scroll_to_bottom)
 
-        # The widget to fill the scroll area
-        self.conversation_scroll_area_widget = QtWidgets.QWidget(self.conversation_scroll_area)
-
-        # The actual messages layout
-        self.conversation_layout = QtWidgets.QVBoxLayout(self.conversation_scroll_area_widget)
-        self.conversation_layout.setStretch(0, 0)
-        self.conversation_layout.setObjectName('conversation-layout')
-        self.conversation_layout.setMargin(0)
-        self.conversation_layout.setContentsMargins(0, self.margin, 0, 0)
-        self.conversation_layout.setSpacing(self.margin)
-        self.conversation_layout.setAlignment(QtCore.Qt.AlignTop)
-        self.conversation_scroll_area.setWidget(self.conversation_scroll_area_widget)
-        self.conversation_scroll_area.setFrameStyle(QtWidgets.QFrame.NoFrame)
-
         # Input section
         # Set up a vertical box layout for the input container
         frame_input_container = QtWidgets.QVBoxLayout()
@@ -406,7 +657,7 @@ class ChatWindow(QtWidgets.QWidget):
         self.frame_input_layout = QtWidgets.QHBoxLayout()
         self.frame_input_layout.setSpacing(0)
         self.frame_input_layout.setMargin(0)
-        self.conversation_layout.setObjectName('input-layout')
+        self.frame_input_layout.setObjectName('input-layout')
 
         # Set up a QLineEdit widget for the input field
         self.input_field = QtWidgets.QLineEdit()
@@ -430,7 +681,7 @@ class ChatWindow(QtWidgets.QWidget):
 
         # Assemble sections into main layout
         self.main_layout.addWidget(header)
-        self.main_layout.addWidget(self.conversation_scroll_area)
+        self.main_layout.addWidget(self.conversation_view)
         self.main_layout.addLayout(frame_input_container)
 
         # Update the conversation from the messages in the api
@@ -475,7 +726,12 @@ class ChatWindow(QtWidgets.QWidget):
 
         self.label_new_conversation.mousePressEvent = self.action_clear
 
-        header_layout.addWidget(QtWidgets.QLabel())  # filler to keep logo centered
+        # Token usage of the conversation, also keeps the logo centered
+        self.label_tokens = QtWidgets.QLabel()
+        self.label_tokens.setObjectName('token-count')
+        self.update_token_count()
+
+        header_layout.addWidget(self.label_tokens)
         header_layout.addWidget(header_logo)
         header_layout.addWidget(self.label_new_conversation)
 
@@ -489,9 +745,29 @@ class ChatWindow(QtWidgets.QWidget):
         # Return the header frame widget.
         return header
 
+    def update_token_count(self):
+        """Show how many tokens the next request will send."""
+        # Counted on the engine thread, the requests running there change the same state
+        counts = engine.engine().run(self.api.token_counts).result()
+        self.label_tokens.setText(f'{counts["sent"]} / {counts["budget"]} tokens')
+        tooltip = f'{counts["total"]} tokens in conversation'
+        if counts['trimmed_messages']:
+            tooltip += f', {counts["trimmed_messages"]} older messages left out'
+        last = self.api.last_metrics
+        if last:
+            tooltip += f'\nLast reply took {last["total"]:.1f}s'
+            if last.get('first_token') is not None:
+                tooltip += f', first token after {last["first_token"]:.1f}s'
+        self.label_tokens.setToolTip(tooltip)
+
+    @QtCore.Slot(int)
+    def update_follow_bottom(self, value):
+        self.follow_bottom = value >= self.scrollbar.maximum()
+
     @QtCore.Slot(int, int)
     def scroll_to_bottom(self, minimum, maximum):
-        self.scrollbar.setValue(maximum)
+        if self.follow_bottom:
+            self.scrollbar.setValue(maximum)
 
     def input_field_text_color_white(self):
         self.input_field.setStyleSheet(f'color: {styles.Color.almost_white};')
@@ -511,58 +787,78 @@ class ChatWindow(QtWidgets.QWidget):
         user = self.user
         content = self.input_field.text()
         if content:
-            # Setup multithreading to avoid gui freezing when waiting for response
-            self.thread = QtCore.QThread()
-            self.worker = ChatGPTMessage(self.api, content)
-            self.worker.moveToThread(self.thread)
-            # Connect correct methods
-            self.thread.started.connect(self.worker.request)
-            self.worker.response.connect(self.action_response_received)
-            self.worker.response.connect(self.thread.quit)
-            self.worker.response.connect(self.worker.deleteLater)
-            self.thread.finished.connect(self.thread.deleteLater)
-
-            self.button_send.setEnabled(False)
-            # User message
-            user_message = ChatBubble(user, [content], is_bot=False)
-            self.conversation_layout.insertWidget(self.conversation_layout.count(), user_message)
+            # Requests run on the async engine, so the window stays responsive and more
+            # messages can be sent while waiting for a reply
+            worker = ChatGPTMessage(self.api, content)
+            worker.chunk.connect(self.action_chunk_received)
+            worker.response.connect(self.action_response_received)
+
+            # User message, the view follows the reply from the bottom
+            self.follow_bottom = True
+            self.conversation_model.append(conversation.Message.from_content(user, content, is_bot=False))
 
             # Clear input field
             self.input_field.clear()
             self.input_field.setPlaceholderText('Waiting for reply')
 
-            # Add response
-            self.spinner = Spinner()
-            self.conversation_layout.addWidget(self.spinner)
-            self.thread.start()
-
-    def action_response_received(self, response):
-        self.conversation_layout.removeWidget(self.spinner)
-        self.spinner.close()
-        response_message = ChatBubble(BOT_USER, response, is_bot=True)
-        self.conversation_layout.insertWidget(self.conversation_layout.count(), response_message)
-
-        self.button_send.setEnabled(True)
-        # Reset text color
-        self.input_field_text_color_gray()
-        self.input_field.setPlaceholderText('Give further instructions')
+            # Add a message where the reply will show up, it shows a spinner until the first token arrives
+            message = conversation.Message(BOT_USER, is_bot=True, pending=True)
+            self.conversation_model.append(message)
+            self.pending_replies[worker] = message
+            worker.request()
+
+    def action_chunk_received(self, worker, segments, pending):
+        # The conversation was cleared while waiting for the reply
+        if worker not in self.pending_replies:
+            return
+
+        message = self.pending_replies[worker]
+        message.segments.extend(segments)
+        message.stream_text = pending
+        message.notify()
+
+    def action_response_received(self, worker, response):
+        if worker not in self.pending_replies:
+            worker.deleteLater()
+            return
+
+        message = self.pending_replies.pop(worker)
+        message.segments.extend(response)
+        message.stream_text = ''
+        message.pending = False
+        message.notify()
+        worker.deleteLater()
+
+        self.update_token_count()
+        if not self.pending_replies:
+            # Reset text color
+            self.input_field_text_color_gray()
+            self.input_field.setPlaceholderText('Give further instructions')
 
     def action_clear(self, *args):
         """This is what happens when you click the clear button"""
-        self.api.reset_conversation()
+        # Replies that are still on their way are cancelled, a reply that arrives anyway is
+        # discarded by the api because the conversation changed. Cancelling answers right away
+        # through action_response_received, so the pending replies are emptied first
+        workers = list(self.pending_replies)
+        self.pending_replies.clear()
+        for worker in workers:
+            worker.cancel()
+
+        # Reset on the engine thread, where requests change the conversation
+        engine.engine().run(self.api.reset_conversation).result()
 
         # Reset input field
         self.input_field.clear()
         self.input_field.setPlaceholderText(placeholder_text())
 
         # Delete messages from window
-        for i in reversed(range(self.conversation_layout.count())):
-            if self.conversation_layout.itemAt(i):
-                # self.conversation_layout.removeItem(self.conversation_layout.itemAt(i))
-                self.conversation_layout.itemAt(i).widget().deleteLater()
+        self.follow_bottom = True
+        self.conversation_model.clear()
 
         # Add default message
         self.update_conversation_layout()
+        self.update_token_count()
 
     def update_conversation_layout(self):
         for msg in self.api.messages:
@@ -575,58 +871,8 @@ class ChatWindow(QtWidgets.QWidget):
             else:
                 user = self.user
                 content = msg['content']
-            self.conversation_layout.addWidget(ChatBubble(user, content))
-
-
-def delete_menu(menu_id):
-    """
-    Delete a menu
-
-    Args:
-        menu_id (str): The ID of the menu to be deleted.
-    """
-    if cmds.menu(menu_id, exists=True):  # Check if the menu exists
-        cmds.deleteUI(menu_id)  # Delete the menu
-
-
-def create_menu():
-    """
-    Create a menu with options for the ChatGPT plugin.
-    """
-    # Delete menu if it already exists
-    delete_menu(MENU)
-
-    # Create menu
-    menu = cmds.menu(MENU,
-                     parent='MayaWindow',
-                     label='ChatGPT',
-                     tearOff=True)
-
-    # Add menu items
-    cmds.menuItem(parent=MENU,
-                  label='Open chat',
-                  # i=os.path.join(ICONS_PATH, 'reload.png'),
-                  enable=True,
-                  c=open_chat)
-    cmds.menuItem(optionBox=True, c=open_config)
-    # cmds.menuItem(parent=MENU,
-    #               label='Quick command',
-    #               # i=os.path.join(ICONS_PATH, 'reload.png'),
-    #               enable=False)
-    cmds.menuItem(parent=MENU,
-                  label='Get API key...',
-                  # i=os.path.join(ICONS_PATH, 'reload.png'),
-                  enable=True,
-                  c=open_api_key_url)
-
-
-def open_api_key_url(*args):
-    """
-    Opens a web browser to the OpenAI API key management page.
-    """
-    url = 'https://platform.openai.com/account/api-keys'  # URL of the API key management page
-    logging.info(f'Opening web browser to {url}')  # Log the URL that is being opened
-    helpers.open_url(url)  # Open the URL in the user's default web browser
+            self.conversation_model.append(conversation.Message.from_content(user, content,
+                                                                             is_bot=msg['role'] != 'user'))
 
 
 def open_chat(*args):
@@ -0,0 +1,175 @@
+"""cache.py
+Cache for api responses, kept in memory and on disk.
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from chatgpt4maya import config
+
+logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+
+def normalize_messages(messages):
+    """
+    Strip everything from the messages that doesn't change the reply.
+
+    Args:
+        messages (list[dict]): The messages sent to the api.
+
+    Returns:
+        list[list[str]]: Role and stripped content of each message.
+    """
+    return [[message['role'], message['content'].strip()] for message in messages]
+
+
+def cache_key(model, parameters, messages):
+    """
+    Create a cache key for a request.
+
+    Args:
+        model (str): The model the request is sent to.
+        parameters (dict): The sampling parameters of the request.
+        messages (list[dict]): The messages sent to the api.
+
+    Returns:
+        str: A sha256 hex digest identifying the request.
+    """
+    data = json.dumps({'model': model,
+                       'parameters': parameters,
+                       'messages': normalize_messages(messages)}, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Two tier response cache.
+
+    Recently used responses are kept in an in-memory LRU, everything else is looked up in
+    an SQLite database under the config path so answers survive between sessions.
+    """
+
+    def __init__(self, path=None, max_entries=128, max_disk_entries=4096, max_age=7 * 24 * 60 * 60):
+        """
+        Initialize the cache and create the database if it doesn't exist.
+
+        Args:
+            path (pathlib.Path, optional): Path to the database file. Defaults to None.
+            max_entries (int, optional): Max number of responses kept in memory. Defaults to 128.
+            max_disk_entries (int, optional): Max number of responses kept on disk. Defaults to 4096.
+            max_age (float, optional): Seconds before a response is considered stale. Defaults to a week.
+        """
+        self.path = path if path else config.config_path() / 'cache.db'
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.max_age = max_age
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        if not self.path.parent.is_dir():
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(str(self.path), timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _remember(self, key, created, response):
+        """Put a response in the memory tier and evict the least recently used ones."""
+        with self._lock:
+            self._memory[key] = (created, response)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Get a cached response.
+
+        Args:
+            key (str): The cache key, as returned by cache_key.
+
+        Returns:
+            dict: The cached response, or None if there is no fresh response for the key.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry:
+                created, response = entry
+                if now - created <= self.max_age:
+                    self._memory.move_to_end(key)
+                    return response
+                del self._memory[key]
+
+        try:
+            with self._connect() as connection:
+                row = connection.execute('SELECT created, data FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+
+                created, data = row
+                if now - created > self.max_age:
+                    connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    return None
+                connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        except sqlite3.Error as e:
+            logging.error(f'Could not read from response cache: {e}')
+            return None
+
+        response = json.loads(data)
+        self._remember(key, created, response)
+        return response
+
+    def set(self, key, response):
+        """
+        Cache a response.
+
+        Args:
+            key (str): The cache key, as returned by cache_key.
+            response (dict): The response returned from the api.
+        """
+        now = time.time()
+        self._remember(key, now, response)
+        try:
+            with self._connect() as connection:
+                connection.execute('INSERT OR REPLACE INTO responses (key, created, accessed, data) '
+                                   'VALUES (?, ?, ?, ?)', (key, now, now, json.dumps(response, default=str)))
+                self._evict(connection, now)
+        except sqlite3.Error as e:
+            logging.error(f'Could not write to response cache: {e}')
+
+    def _evict(self, connection, now):
+        """Remove stale responses and the least recently used ones above max_disk_entries."""
+        connection.execute('DELETE FROM responses WHERE created < ?', (now - self.max_age,))
+        connection.execute('DELETE FROM responses WHERE key NOT IN '
+                           '(SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)', (self.max_disk_entries,))
+
+    def clear(self):
+        """Remove all cached responses."""
+        with self._lock:
+            self._memory.clear()
+        with self._connect() as connection:
+            connection.execute('DELETE FROM responses')
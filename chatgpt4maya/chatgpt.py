@@ -1,11 +1,14 @@
-import json
+import asyncio
+import email.utils
 import logging
 import os
-import sys
-from pathlib import Path
+import random
+import threading
+import time
+import uuid
 from pprint import pprint
 
-from chatgpt4maya import config
+from chatgpt4maya import config, history, cache, tokens, summary, clients, metrics
 
 logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
 # Load .env during development
@@ -16,96 +19,243 @@ try:
 except ImportError:
     pass
 
-# Insert path to openai dependencies
-sys.path.insert(0, str(Path(config.Config().get('OpenAI', 'OpenAILibraryPath')).resolve()))
-
-# Import openai
+# The library path is set up by the clients module
 try:
-    from openai import OpenAI
-
-    logging.info('Imported openai')
+    import openai
 except Exception as e:
-    logging.error(e)
-    logging.error('openai package could not be imported')
+    # Packages built for another python can fail with more than an ImportError
+    logging.error(f'openai package could not be imported: {e}')
     openai = None
 
 
+class TokenBucket:
+    """
+    Thread safe token bucket that refills at a fixed rate per minute.
+
+    Reserving more than is available puts the bucket in debt, the caller is told how long
+    to wait until the reservation is covered.
+    """
+
+    def __init__(self, per_minute):
+        """
+        Args:
+            per_minute (float): How much the bucket refills per minute, also its capacity.
+        """
+        self.per_minute = per_minute
+        self.available = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Take an amount from the bucket.
+
+        Args:
+            amount (float): How much to take.
+
+        Returns:
+            float: Seconds to wait before the reservation may be used.
+        """
+        with self._lock:
+            now = time.monotonic()
+            rate = self.per_minute / 60
+            self.available = min(self.per_minute, self.available + (now - self.updated) * rate)
+            self.updated = now
+            self.available -= min(amount, self.per_minute)
+            return max(0.0, -self.available / rate)
+
+
+class RequestScheduler:
+    """
+    Smooths out bursts of requests and retries the ones that fail for transient reasons.
+
+    Requests wait for room in the shared request and token buckets before they are sent.
+    Rate limit, connection and server errors are retried with exponential backoff and
+    jitter, using the Retry-After header when the api sends one.
+    """
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200000, max_retries=5, base_delay=1.0,
+                 max_delay=60.0):
+        """
+        Args:
+            requests_per_minute (float, optional): Request rate limit. Defaults to 500.
+            tokens_per_minute (float, optional): Token rate limit. Defaults to 200000.
+            max_retries (int, optional): Max number of retries per request. Defaults to 5.
+            base_delay (float, optional): Delay before the first retry in seconds. Defaults to 1.0.
+            max_delay (float, optional): Max delay between retries in seconds. Defaults to 60.0.
+        """
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _reserve(self, token_count):
+        return max(self.requests.reserve(1), self.tokens.reserve(token_count))
+
+    @staticmethod
+    def _is_retryable(error):
+        if openai is None:
+            return False
+        return isinstance(error, (openai.RateLimitError,
+                                  openai.APIConnectionError,
+                                  openai.InternalServerError))
+
+    @staticmethod
+    def _retry_after(error):
+        """Get the delay the api asked for in seconds, or None."""
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if not headers:
+            return None
+
+        try:
+            if headers.get('retry-after-ms'):
+                return float(headers['retry-after-ms']) / 1000
+            if headers.get('retry-after'):
+                value = headers['retry-after']
+                try:
+                    return float(value)
+                except ValueError:
+                    return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+        return None
+
+    def _retry_delay(self, error, attempt):
+        retry_after = self._retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # Full jitter keeps retries from many sessions from lining up
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, function, token_count=0, timer=None):
+        """
+        Call a function that sends a request, waiting for rate limits and retrying on failure.
+
+        Args:
+            function (callable): The function sending the request.
+            token_count (int, optional): Estimated tokens used by the request. Defaults to 0.
+            timer (metrics.RequestTimer, optional): Marked when each attempt is sent, when
+                one is retried and when the api answers. Defaults to None.
+
+        Returns:
+            object: What the function returns.
+        """
+        attempt = 0
+        while True:
+            time.sleep(self._reserve(token_count))
+            try:
+                if timer:
+                    timer.sent()
+                result = function()
+                if timer:
+                    timer.mark('connected')
+                return result
+            except Exception as e:
+                if attempt >= self.max_retries or not self._is_retryable(e):
+                    raise
+                delay = self._retry_delay(e, attempt)
+                logging.warning(f'Request failed ({e}), retrying in {delay:.1f}s')
+                metrics.counter('retries').increment()
+                if timer:
+                    timer.retried()
+                time.sleep(delay)
+                attempt += 1
+
+    async def call_async(self, function, token_count=0, timer=None):
+        """
+        Coroutine version of call.
+
+        Args:
+            function (callable): Function returning an awaitable that sends the request.
+            token_count (int, optional): Estimated tokens used by the request. Defaults to 0.
+            timer (metrics.RequestTimer, optional): Marked when each attempt is sent, when
+                one is retried and when the api answers. Defaults to None.
+
+        Returns:
+            object: What the awaitable returns.
+        """
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._reserve(token_count))
+            try:
+                if timer:
+                    timer.sent()
+                result = await function()
+                if timer:
+                    timer.mark('connected')
+                return result
+            except asyncio.CancelledError:
+                # Before python 3.8 it's an Exception, a cancelled request is never retried
+                raise
+            except Exception as e:
+                if attempt >= self.max_retries or not self._is_retryable(e):
+                    raise
+                delay = self._retry_delay(e, attempt)
+                logging.warning(f'Request failed ({e}), retrying in {delay:.1f}s')
+                metrics.counter('retries').increment()
+                if timer:
+                    timer.retried()
+                await asyncio.sleep(delay)
+                attempt += 1
+
+
+# Shared by all ChatGPT instances so the whole session stays within the limits. How many
+# requests run at once is MaxConcurrentRequests in the same section, read by engine.engine()
+_config = config.Config()
+SCHEDULER = RequestScheduler(requests_per_minute=float(_config.get('OpenAI', 'RequestsPerMinute') or 500),
+                             tokens_per_minute=float(_config.get('OpenAI', 'TokensPerMinute') or 200000))
+
+
 class ChatGPT:
-    def __init__(self, api_key=None, save=True):
+    def __init__(self, api_key=None, save=True, use_cache=True, context_budget=8192, summarize=True, base_url=None):
         self.client = None
+        self.async_client = None
+
+        # Point base_url at a mock_server to work offline
+        self.base_url = base_url if base_url else os.getenv('OPENAI_BASE_URL')
 
         # Get api key
         api_key = api_key if api_key else os.getenv('OPENAI_API_KEY')
         if api_key:
-            # Set api key
-            self.client = OpenAI(api_key=api_key)
+            # Use the clients shared by the session so connections are reused
+            self.client = clients.get_client(api_key, self.base_url)
+            self.async_client = clients.get_async_client(api_key, self.base_url)
         else:
             logging.error('No api key given/found')
             raise Exception('No api key given/found')
 
         self.model = 'gpt-3.5-turbo'
+        self.parameters = {'temperature': 0,
+                           'max_tokens': 2048,
+                           'top_p': 1}
         self.system_message = {'role': 'system',
                                'content': 'Helpful assistant. '
                                           'Help with Autodesk Maya, python, mel, Maya expression.'}
         self.messages = [self.system_message]
+        self.conversation_id = uuid.uuid4().hex
+
+        # Only send as much of the conversation as fits the token budget
+        self.context = tokens.ContextWindow(budget=context_budget)
+
+        # Fold older turns into a summary in the background to keep long conversations small
+        summary_model = _config.get('OpenAI', 'SummaryModel') or summary.SUMMARY_MODEL
+        self.summarizer = summary.Summarizer(self.client, summary_model, scheduler=SCHEDULER) if summarize else None
 
         # Save history
         self.history = {}
-        self.file = Path(config.config_path() / 'history.json')
         self.save = save
 
-    def _save_conversation(self):
-        data = []
-        if self.file.is_file():
-            with self.file.open('r') as read_file:
-                data = json.load(read_file)
-
-        with self.file.open('w') as write_file:
-            data.append(self.history)
-            json.dump(data, write_file)
-        return self.file
-
-    def _get_mock_response(self):
-        """Send a request to httpbin"""
-        # url = 'https://httpbin.org/json'
-        # logging.info(f'Sending request to {url}')
-        logging.info('Pretending to send request to openai')
-        # res = urllib.request.urlopen(url)
-        # res_body = res.get()
-        # response = json.loads(res_body.decode("utf-8"))
-
-        response = {'choices': [{'finish_reason': 'stop',
-                                 'index': 0,
-                                 'message': {'content': "Here's how to create a cube in Maya "
-                                                        'using MEL:\n'
-                                                        '\n'
-                                                        '```\n'
-                                                        'polyCube -w 1 -h 1 -d 1;\n'
-                                                        '```\n'
-                                                        '\n'
-                                                        "And here's how to create a cube in Maya "
-                                                        'using Python:\n'
-                                                        '\n'
-                                                        '```\n'
-                                                        'import maya.cmds as cmds\n'
-                                                        '\n'
-                                                        'cmds.polyCube(w=1, h=1, d=1)\n'
-                                                        '```\n'
-                                                        '\n'
-                                                        'Both of these commands will create a '
-                                                        'cube with a width, height, and depth of '
-                                                        '1 unit. You can adjust the values to '
-                                                        'create a cube of any size.',
-                                             'role': 'assistant'}}],
-                    'created': 1682008110,
-                    'id': 'chatcmpl-77RR0y31Q4Rp8I2q6xFQdyIN86hkM',
-                    'model': 'gpt-3.5-turbo-0301',
-                    'object': 'chat.completion',
-                    'usage': {'completion_tokens': 106,
-                              'prompt_tokens': 36,
-                              'total_tokens': 142}}
+        # Timings and token usage of the last request
+        self.last_metrics = {}
 
-        return response
+        # Cache responses, the temperature is 0 so the same messages get the same reply
+        self.cache = cache.ResponseCache() if use_cache else None
+
+    def _save_conversation(self, conversation_id=None):
+        # Saving happens on the history writer thread so it never adds to the request time
+        history.writer().put(conversation_id or self.conversation_id, self.history)
 
     def _get_response(self):
         """
@@ -115,53 +265,376 @@ class ChatGPT:
             dict: The response generated by the GPT-3.5 model.
         """
         response = {}
+        timer = metrics.RequestTimer()
         try:
             # Create a chat completion using OpenAI's API
-            response = self.client.chat.completions.create(model=self.model,
-                                                           messages=self.messages,
-                                                           temperature=0,
-                                                           max_tokens=2048,
-                                                           top_p=1)
+            messages = self._request_messages()
+            response = SCHEDULER.call(lambda: self.client.chat.completions.create(model=self.model,
+                                                                                  messages=messages,
+                                                                                  **self.parameters),
+                                      token_count=self._token_estimate(),
+                                      timer=timer)
+            timer.mark('first_token')
             # Log the response for debugging purposes
             logging.debug(response)
 
+            # The client returns pydantic models, the rest of the code expects plain dicts
+            if hasattr(response, 'model_dump'):
+                response = response.model_dump()
+
+        except asyncio.CancelledError:
+            # Nothing is saved for a request that was cancelled
+            raise
         except Exception as e:
             # Log any exceptions that occur during the chat completion process
             logging.error(e)
             response = {'error': e}
 
+        self.last_metrics = timer.finish(response.get('usage'), error='error' in response)
         return response
 
+    async def _get_response_async(self):
+        """
+        Generate a chat response without blocking the event loop.
+
+        Returns:
+            dict: The response generated by the model.
+        """
+        response = {}
+        timer = metrics.RequestTimer()
+        try:
+            messages = self._request_messages()
+            response = await SCHEDULER.call_async(lambda: self.async_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                **self.parameters), token_count=self._token_estimate(), timer=timer)
+            timer.mark('first_token')
+            logging.debug(response)
+            if hasattr(response, 'model_dump'):
+                response = response.model_dump()
+
+        except asyncio.CancelledError:
+            # Nothing is saved for a request that was cancelled
+            raise
+        except Exception as e:
+            logging.error(e)
+            response = {'error': e}
+
+        self.last_metrics = timer.finish(response.get('usage'), error='error' in response)
+        return response
+
+    @staticmethod
+    def _new_stream_response():
+        return {'choices': [{'finish_reason': None,
+                             'index': 0,
+                             'message': {'content': '', 'role': 'assistant'}}],
+                'object': 'chat.completion'}
+
+    @staticmethod
+    def _add_stream_chunk(response, chunk):
+        """
+        Add a streamed chunk to the response being assembled.
+
+        Args:
+            response (dict): The response, as returned by _new_stream_response.
+            chunk (openai.types.chat.ChatCompletionChunk): The chunk received from the api.
+
+        Returns:
+            str: The content delta of the chunk, or None if it has no content.
+        """
+        response['id'] = chunk.id
+        response['model'] = chunk.model
+        response['created'] = chunk.created
+
+        # The last chunk has the usage and no choices
+        usage = getattr(chunk, 'usage', None)
+        if usage:
+            response['usage'] = usage.model_dump() if hasattr(usage, 'model_dump') else dict(usage)
+
+        if not chunk.choices:
+            return None
+
+        choice = chunk.choices[0]
+        if choice.finish_reason:
+            response['choices'][0]['finish_reason'] = choice.finish_reason
+        delta = choice.delta.content
+        if delta:
+            response['choices'][0]['message']['content'] += delta
+        return delta
+
+    def _get_stream(self):
+        """
+        Generate a chat response as a stream of content deltas.
+
+        The full response is assembled into the same shape as a non-streamed response and
+        stored in self.history when the stream is exhausted.
+
+        Yields:
+            str: The content deltas in the order they are received.
+        """
+        response = self._new_stream_response()
+        timer = metrics.RequestTimer()
+        try:
+            # Create a streamed chat completion using OpenAI's API
+            # Only creating the stream is retried, a stream that fails halfway is not restarted
+            messages = self._request_messages()
+            stream = SCHEDULER.call(lambda: self.client.chat.completions.create(model=self.model,
+                                                                                messages=messages,
+                                                                                stream=True,
+                                                                                stream_options={'include_usage': True},
+                                                                                **self.parameters),
+                                    token_count=self._token_estimate(),
+                                    timer=timer)
+            for chunk in stream:
+                delta = self._add_stream_chunk(response, chunk)
+                if delta:
+                    timer.mark_once('first_token')
+                    yield delta
+            logging.debug(response)
+
+        except Exception as e:
+            # Log any exceptions that occur during the chat completion process
+            logging.error(e)
+            response = {'error': e}
+
+        self.last_metrics = timer.finish(response.get('usage'), error='error' in response)
+        self.history = response
+
+    async def _get_stream_async(self):
+        """
+        Generate a chat response as a stream of content deltas without blocking the event loop.
+
+        Yields:
+            str: The content deltas in the order they are received.
+        """
+        response = self._new_stream_response()
+        timer = metrics.RequestTimer()
+        try:
+            messages = self._request_messages()
+            stream = await SCHEDULER.call_async(lambda: self.async_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True},
+                **self.parameters), token_count=self._token_estimate(), timer=timer)
+            async for chunk in stream:
+                delta = self._add_stream_chunk(response, chunk)
+                if delta:
+                    timer.mark_once('first_token')
+                    yield delta
+            logging.debug(response)
+
+        except asyncio.CancelledError:
+            # Nothing is saved for a request that was cancelled
+            raise
+        except Exception as e:
+            logging.error(e)
+            response = {'error': e}
+
+        self.last_metrics = timer.finish(response.get('usage'), error='error' in response)
+        self.history = response
+
     def _append_message(self, content, role='user'):
-        self.messages.append({'role': 'user', 'content': content})
+        self.messages.append({'role': role, 'content': content})
         return self.messages
 
-    def reset_conversation(self):
-        self.messages = [self.system_message]
-        return self.messages
+    def _request_messages(self):
+        messages = self.messages
+        if self.summarizer:
+            conversation_summary, summarized = self.summarizer.snapshot()
+            if conversation_summary:
+                system_message = {'role': 'system',
+                                  'content': f'{self.system_message["content"]}\n\n'
+                                             f'Summary of the conversation so far:\n{conversation_summary}'}
+                messages = [system_message] + self.messages[1 + summarized:]
+        return self.context.fit(messages)
 
-    def send_message(self, message):
-        # Append user message
-        self._append_message(message)
+    def _token_estimate(self):
+        # What the rate limiter counts, the prompt plus the max length of the reply
+        return self.context.sent_tokens + self.parameters.get('max_tokens', 0)
 
-        # Get response from api
-        # response = self._get_mock_response()  # mock api for testing
-        response = self._get_response()
+    def _cache_key(self):
+        return cache.cache_key(self.model, self.parameters, self._request_messages())
+
+    def token_counts(self):
+        """
+        Get the token counts of the conversation.
+
+        Returns:
+            dict: The total tokens in the conversation, the tokens sent with the next
+                request, the budget and the number of messages left out.
+        """
+        self._request_messages()
+        return self.context.counts()
+
+    def _get_cached_response(self, use_cache=True):
+        """
+        Look up a cached response for the current messages.
 
+        Args:
+            use_cache (bool, optional): Set to False to bypass the cache. Defaults to True.
+
+        Returns:
+            dict: The cached response, or None if there is none.
+        """
+        if not (use_cache and self.cache):
+            return None
+
+        response = self.cache.get(self._cache_key())
+        if response:
+            logging.info('Using cached response')
+            metrics.counter('cache.hits').increment()
+        else:
+            metrics.counter('cache.misses').increment()
+        return response
+
+    def _handle_response(self, response, cache_key=None, conversation_id=None, cached=False):
+        """Save the response and append the reply to the conversation.
+
+        Args:
+            response (dict): The response returned from the api.
+            cache_key (str, optional): Cache the response under this key. Defaults to None.
+            conversation_id (str, optional): The conversation the request was sent in. If the
+                conversation was reset since, the reply is only saved to the history of the old
+                conversation. Defaults to the current conversation.
+            cached (bool, optional): The response came from the cache, it was saved to the
+                history when it was first received so it isn't saved again. Defaults to False.
+
+        Returns:
+            dict: The same response.
+        """
         # Save history
         self.history = response
-        if self.save:
-            self._save_conversation()
+        if self.save and not cached:
+            self._save_conversation(conversation_id)
+
+        if response.get('error'):
+            # Take back the message that wasn't answered, so the next request doesn't send
+            # two user messages in a row
+            if (not conversation_id or conversation_id == self.conversation_id) and self.messages[-1]['role'] == 'user':
+                self.messages.pop()
+            return response
+
+        if conversation_id and conversation_id != self.conversation_id:
+            logging.info('Discarding a reply to a conversation that was reset')
+            return response
+
+        if cache_key and self.cache:
+            self.cache.set(cache_key, response)
 
         # Get the message content
         response_message = response['choices'][0]['message']
         logging.debug(f'ChatGPT: {response_message}')
 
         # Append response message
-        self._append_message(**response_message)
+        self._append_message(response_message['content'], response_message['role'])
+
+        if self.summarizer:
+            self.summarizer.update(self.messages[1:])
 
         return response
 
+    def reset_conversation(self):
+        self.messages = [self.system_message]
+        self.conversation_id = uuid.uuid4().hex
+        if self.summarizer:
+            self.summarizer.reset()
+        return self.messages
+
+    def send_message(self, message, use_cache=True):
+        # Append user message
+        conversation_id = self.conversation_id
+        self._append_message(message)
+
+        # Answer from the cache if the same question was asked before
+        response = self._get_cached_response(use_cache)
+        if response:
+            return self._handle_response(response, conversation_id=conversation_id, cached=True)
+
+        # Get response from api
+        cache_key = self._cache_key()
+        response = self._get_response()
+
+        return self._handle_response(response, cache_key, conversation_id)
+
+    def stream_message(self, message, use_cache=True):
+        """Send a message and stream the reply as it is generated.
+
+        Args:
+            message (str): The user message to send.
+            use_cache (bool, optional): Set to False to bypass the response cache. Defaults to True.
+
+        Yields:
+            str: The content deltas of the reply. When the generator is exhausted the
+                full response is available in self.history.
+        """
+        # Append user message
+        conversation_id = self.conversation_id
+        self._append_message(message)
+
+        # Answer from the cache if the same question was asked before
+        response = self._get_cached_response(use_cache)
+        if response:
+            yield response['choices'][0]['message']['content']
+            self._handle_response(response, conversation_id=conversation_id, cached=True)
+            return
+
+        # Get response from api
+        cache_key = self._cache_key()
+        yield from self._get_stream()
+
+        self._handle_response(self.history, cache_key, conversation_id)
+
+    async def send_message_async(self, message, use_cache=True):
+        """
+        Coroutine version of send_message, to be run on the async engine.
+
+        Args:
+            message (str): The user message to send.
+            use_cache (bool, optional): Set to False to bypass the response cache. Defaults to True.
+
+        Returns:
+            dict: The response.
+        """
+        conversation_id = self.conversation_id
+        self._append_message(message)
+
+        response = self._get_cached_response(use_cache)
+        if response:
+            return self._handle_response(response, conversation_id=conversation_id, cached=True)
+
+        cache_key = self._cache_key()
+        response = await self._get_response_async()
+
+        return self._handle_response(response, cache_key, conversation_id)
+
+    async def stream_message_async(self, message, use_cache=True):
+        """
+        Async generator version of stream_message, to be run on the async engine.
+
+        Args:
+            message (str): The user message to send.
+            use_cache (bool, optional): Set to False to bypass the response cache. Defaults to True.
+
+        Yields:
+            str: The content deltas of the reply. When the generator is exhausted the
+                full response is available in self.history.
+        """
+        conversation_id = self.conversation_id
+        self._append_message(message)
+
+        response = self._get_cached_response(use_cache)
+        if response:
+            yield response['choices'][0]['message']['content']
+            self._handle_response(response, conversation_id=conversation_id, cached=True)
+            return
+
+        cache_key = self._cache_key()
+        async for delta in self._get_stream_async():
+            yield delta
+
+        self._handle_response(self.history, cache_key, conversation_id)
+
     def hello_world(self):
         return 'Hello world'
 
@@ -0,0 +1,149 @@
+"""clients.py
+OpenAI clients shared by every window and conversation in the session.
+"""
+import logging
+import sys
+import threading
+from pathlib import Path
+
+from chatgpt4maya import config
+
+logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
+
+# Insert path to openai dependencies
+sys.path.insert(0, str(Path(config.Config().get('OpenAI', 'OpenAILibraryPath')).resolve()))
+
+# Import openai
+try:
+    import httpx
+    from openai import OpenAI, AsyncOpenAI
+
+    logging.info('Imported openai')
+except Exception as e:
+    logging.error(e)
+    logging.error('openai package could not be imported')
+    httpx = None
+    OpenAI = AsyncOpenAI = None
+
+# Keep idle connections open long enough to survive the time it takes to type a question
+KEEPALIVE_EXPIRY = 120
+MAX_CONNECTIONS = 16
+
+# Max seconds to wait for the async clients to close on shutdown
+CLOSE_TIMEOUT = 5
+
+# Retries are handled by the scheduler in the chatgpt module
+_clients = {}
+_async_clients = {}
+_lock = threading.Lock()
+
+
+def _require_openai():
+    if OpenAI is None:
+        raise ImportError('openai is not installed, run chatgpt4maya.config.setup_openai() to install it')
+
+
+def _limits():
+    return httpx.Limits(max_connections=MAX_CONNECTIONS,
+                        max_keepalive_connections=MAX_CONNECTIONS,
+                        keepalive_expiry=KEEPALIVE_EXPIRY)
+
+
+def get_client(api_key, base_url=None):
+    """
+    Get the shared client for an api key, creating it the first time.
+
+    Args:
+        api_key (str): The OpenAI api key.
+        base_url (str, optional): Url of the api, None for the OpenAI default. Defaults to None.
+
+    Returns:
+        openai.OpenAI: The shared client.
+    """
+    _require_openai()
+    with _lock:
+        client = _clients.get((api_key, base_url))
+        if client is None:
+            client = OpenAI(api_key=api_key, base_url=base_url, max_retries=0,
+                            http_client=httpx.Client(limits=_limits()))
+            _clients[(api_key, base_url)] = client
+        return client
+
+
+def get_async_client(api_key, base_url=None):
+    """
+    Get the shared async client for an api key, creating it the first time.
+
+    The async client must only be used on the event loop of the async engine.
+
+    Args:
+        api_key (str): The OpenAI api key.
+        base_url (str, optional): Url of the api, None for the OpenAI default. Defaults to None.
+
+    Returns:
+        openai.AsyncOpenAI: The shared async client.
+    """
+    _require_openai()
+    with _lock:
+        client = _async_clients.get((api_key, base_url))
+        if client is None:
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0,
+                                 http_client=httpx.AsyncClient(limits=_limits()))
+            _async_clients[(api_key, base_url)] = client
+        return client
+
+
+def warm_up(api_key, base_url=None):
+    """
+    Open connections to the api in the background so the first message doesn't pay for
+    DNS lookups and TLS handshakes.
+
+    Args:
+        api_key (str): The OpenAI api key.
+        base_url (str, optional): Url of the api, None for the OpenAI default. Defaults to None.
+
+    Returns:
+        threading.Thread: The thread doing the warm up.
+    """
+    from chatgpt4maya import engine
+
+    def run():
+        try:
+            get_client(api_key, base_url).models.list()
+            engine.engine().submit(get_async_client(api_key, base_url).models.list()).result()
+            logging.debug('Connections to the api are warmed up')
+        except Exception as e:
+            logging.debug(f'Could not warm up connections to the api: {e}')
+
+    thread = threading.Thread(target=run, name='ChatGPTWarmUp', daemon=True)
+    thread.start()
+    return thread
+
+
+def shutdown():
+    """
+    Close all shared clients and their connections.
+
+    The async clients belong to the event loop of the async engine, so they are closed on
+    it and this must be called before the engine is stopped.
+    """
+    with _lock:
+        for client in _clients.values():
+            try:
+                client.close()
+            except Exception as e:
+                logging.debug(f'Could not close client: {e}')
+        _clients.clear()
+        async_clients = list(_async_clients.values())
+        _async_clients.clear()
+
+    # Don't start an engine just to close clients that were never used on it
+    engine = sys.modules.get('chatgpt4maya.engine')
+    running = engine.running_engine() if engine else None
+    if running is None:
+        return
+    for client in async_clients:
+        try:
+            running.call(client.close()).result(CLOSE_TIMEOUT)
+        except Exception as e:
+            logging.debug(f'Could not close async client: {e}')
@@ -0,0 +1,263 @@
+"""codeview.py
+Read-only viewer for the code blocks in replies.
+
+The code is tokenized on a worker thread, or taken from syntax.RANGE_CACHE if it was shown
+before, and the formats are only applied to the lines that are visible, so showing a long
+script never blocks Maya. Long blocks are collapsed
+to a few lines until they're expanded.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide2 import QtCore, QtGui, QtWidgets
+from shiboken2 import isValid
+
+from chatgpt4maya import config, styles, syntax
+
+logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
+
+# Blocks longer than this are collapsed
+COLLAPSED_LINES = 24
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+class _Tokenizer(QtCore.QObject):
+    """
+    Tokenizes code on a worker thread for the viewers.
+
+    Created on the main thread, so its signal is delivered there however it's emitted.
+    """
+    # Emitted from the worker thread with a viewer and the ranges of every line of its code
+    done = QtCore.Signal(object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.done.connect(self._apply)
+
+    def submit(self, view):
+        """
+        Tokenize the code of a viewer and give it the ranges when done.
+
+        Args:
+            view (CodeView): The viewer.
+        """
+        self.executor.submit(self._tokenize, view, view.code, view.lexer)
+
+    def _tokenize(self, view, code, lexer):
+        # Runs on the worker thread, the viewer is only touched once back on the main thread
+        try:
+            ranges, _ = syntax.RANGE_CACHE.tokenize(code, lexer)
+        except Exception as e:
+            logging.error(f'Could not highlight code: {e}')
+            return
+        self.done.emit(view, ranges)
+
+    def _apply(self, view, ranges):
+        # The viewer may have been deleted while its code was tokenized
+        if isValid(view):
+            view.set_ranges(ranges)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def tokenizer():
+    """The tokenizer shared by all viewers, must first be called on the main thread."""
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            _tokenizer = _Tokenizer()
+        return _tokenizer
+
+
+def shutdown():
+    """Stop the tokenizer thread, if it was started."""
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is not None:
+            _tokenizer.shutdown()
+            _tokenizer = None
+
+
+class CodeView(QtWidgets.QPlainTextEdit):
+    """
+    Read-only code that's highlighted as it scrolls into view.
+    """
+
+    def __init__(self, code, lexer=None, parent=None):
+        """
+        Args:
+            code (str): The code to show.
+            lexer (syntax.Lexer, optional): Splits the code into styled ranges. Defaults to a PythonLexer.
+            parent (QtWidgets.QWidget, optional): Parent widget. Defaults to None.
+        """
+        super().__init__(parent)
+        self.setReadOnly(True)
+        self.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
+        self.setTextInteractionFlags(QtCore.Qt.TextSelectableByMouse | QtCore.Qt.TextSelectableByKeyboard)
+        self.setFrameStyle(QtWidgets.QFrame.NoFrame)
+        self.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAsNeeded)
+        self.setProperty('selector', 'code')
+
+        self.code = code
+        self.lexer = lexer if lexer is not None else syntax.lexer_for(syntax.PYTHON)
+        self.line_count = code.count('\n') + 1
+        # Code is shown in a monospaced font, so the line with the most characters is the widest
+        self._longest_line = max(code.split('\n'), key=len)
+        self.collapsed = self.line_count > COLLAPSED_LINES
+
+        # Ranges of every line once tokenized, and the lines they have been applied to
+        self._ranges = None
+        self._formatted = set()
+
+        self.setPlainText(code)
+        self.update_height()
+
+        # Code that was shown before is highlighted right away
+        tokens = syntax.RANGE_CACHE.get(code, self.lexer)
+        if tokens is not None:
+            self._ranges = tokens[0]
+        else:
+            tokenizer().submit(self)
+
+    def set_ranges(self, ranges):
+        """
+        Set the ranges of every line, they're applied as the lines are painted.
+
+        Args:
+            ranges (list[list[tuple]]): (start, length, style) ranges for each line.
+        """
+        self._ranges = ranges
+        self._formatted = set()
+        self.viewport().update()
+
+    def paintEvent(self, event):
+        # Lines are formatted right before they are first painted, so lines scrolled out of
+        # view, in the code or in the conversation, are never formatted
+        self.highlight(event.rect())
+        super().paintEvent(event)
+
+    def highlight(self, rect):
+        """
+        Apply the formats to the lines in a part of the viewport that don't have them yet.
+
+        Args:
+            rect (QtCore.QRect): The part of the viewport.
+        """
+        if self._ranges is None:
+            return
+
+        block = self.firstVisibleBlock()
+        top = self.blockBoundingGeometry(block).translated(self.contentOffset()).top()
+        first = None
+        last = None
+        while block.isValid() and top <= rect.bottom():
+            height = self.blockBoundingRect(block).height()
+            number = block.blockNumber()
+            if top + height >= rect.top() and number not in self._formatted and number < len(self._ranges):
+                formats = []
+                for start, length, style in self._ranges[number]:
+                    format_range = QtGui.QTextLayout.FormatRange()
+                    format_range.start = start
+                    format_range.length = length
+                    format_range.format = syntax.STYLES[style]
+                    formats.append(format_range)
+                block.layout().setFormats(formats)
+                self._formatted.add(number)
+                first = block if first is None else first
+                last = block
+            top += height
+            block = block.next()
+
+        if first is not None:
+            self.document().markContentsDirty(first.position(), last.position() + last.length() - first.position())
+
+    def needs_scroll_bar(self):
+        """Whether the longest line is wider than the viewport, so the horizontal scroll bar shows."""
+        width = self.fontMetrics().horizontalAdvance(self._longest_line) + self.document().documentMargin() * 2
+        return width > self.viewport().width()
+
+    def update_height(self):
+        """
+        Fit the height to the code, or to COLLAPSED_LINES lines when collapsed, with room
+        for the horizontal scroll bar if the code is wider than the view.
+        """
+        lines = min(self.line_count, COLLAPSED_LINES) if self.collapsed else self.line_count
+        margins = self.contentsMargins()
+        height = (lines * self.fontMetrics().lineSpacing() + self.document().documentMargin() * 2 +
+                  margins.top() + margins.bottom())
+        if self.needs_scroll_bar():
+            height += self.horizontalScrollBar().sizeHint().height()
+        self.setFixedHeight(int(height))
+
+    def showEvent(self, event):
+        # The font from the style sheet is only set once the view is shown
+        super().showEvent(event)
+        self.update_height()
+
+    def resizeEvent(self, event):
+        # Setting the height resizes the view again, only a new width can change it
+        super().resizeEvent(event)
+        if event.size().width() != event.oldSize().width():
+            self.update_height()
+
+    def set_collapsed(self, collapsed):
+        self.collapsed = collapsed
+        self.update_height()
+
+    def wheelEvent(self, event):
+        # The conversation scrolls up and down, the code only scrolls sideways
+        if event.angleDelta().x() == 0 and not event.modifiers() & QtCore.Qt.ShiftModifier:
+            event.ignore()
+        else:
+            super().wheelEvent(event)
+
+
+class CodeViewer(QtWidgets.QFrame):
+    """A CodeView with a button to expand and collapse long code."""
+
+    def __init__(self, code, lexer=None, parent=None):
+        """
+        Args:
+            code (str): The code to show.
+            lexer (syntax.Lexer, optional): Splits the code into styled ranges. Defaults to a PythonLexer.
+            parent (QtWidgets.QWidget, optional): Parent widget. Defaults to None.
+        """
+        super().__init__(parent)
+        self.setObjectName('code-viewer')
+        self.view = CodeView(code, lexer)
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.setMargin(0)
+        layout.setSpacing(styles.Margin.xsmall)
+        layout.addWidget(self.view)
+
+        self.button_expand = None
+        if self.view.collapsed:
+            self.button_expand = QtWidgets.QPushButton()
+            self.button_expand.setObjectName('button-expand')
+            self.button_expand.setStyleSheet(styles.STYLE)
+            self.button_expand.clicked.connect(self.toggle)
+            layout.addWidget(self.button_expand)
+            self._update_button()
+        self.setLayout(layout)
+
+    @property
+    def code(self):
+        return self.view.code
+
+    def _update_button(self):
+        if self.view.collapsed:
+            self.button_expand.setText(f'Show all {self.view.line_count} lines')
+        else:
+            self.button_expand.setText('Show less')
+
+    def toggle(self):
+        """Expand or collapse the code."""
+        self.view.set_collapsed(not self.view.collapsed)
+        self._update_button()
@@ -1,3 +1,4 @@
+import json
 import shutil
 import tempfile
 import configparser
@@ -5,9 +6,10 @@ import os
 import sys
 from pathlib import Path
 import logging
-import os
-import venv
+import threading
+import time
 import subprocess
+from contextlib import contextmanager
 
 from chatgpt4maya import helpers
 
@@ -54,6 +56,13 @@ def config_path():
 
 
 class Config:
+    # Parsed config files shared by all instances, by path
+    _snapshots = {}
+    _lock = threading.RLock()
+
+    # Seconds between checks if the file has been changed by someone else
+    CHECK_INTERVAL = 1.0
+
     def __init__(self, path=None):
         """
         Initialize a new Config object with the given path to the configuration file.
@@ -64,6 +73,8 @@ class Config:
             path (pathlib.Path, optional): Path to the configuration file. Defaults to None.
         """
         self.path = path if path else config_path() / 'config.ini'
+        self._resolved_path = None
+        self._pending = None
         self.parser = configparser.ConfigParser()
         self.parser.optionxform = str
 
@@ -76,28 +87,86 @@ class Config:
             with self.path.open('w') as configfile:
                 self.parser.write(configfile)
 
-        # Setup openai api key
-        if not self.get('OpenAI', 'OpenAIApiKey') and os.getenv('OPENAI_API_KEY'):
-            self.set('OpenAI', 'OpenAIApiKey', os.getenv('OPENAI_API_KEY'))
+        with self.batch():
+            # Setup openai api key
+            if not self.get('OpenAI', 'OpenAIApiKey') and os.getenv('OPENAI_API_KEY'):
+                self.set('OpenAI', 'OpenAIApiKey', os.getenv('OPENAI_API_KEY'))
 
-        # Setup openai library path
-        openai_txt_path = DATA_PATH / 'openai.txt'
-        if not self.get('OpenAI', 'OpenAILibraryPath') and openai_txt_path.is_file():
-            openai_pip_path = helpers.pip_location_to_path(openai_txt_path.read_text())
-            library_path = str(openai_pip_path.resolve())
-            self.set('OpenAI', 'OpenAILibraryPath', library_path)
+            # Setup openai library path
+            openai_txt_path = DATA_PATH / 'openai.txt'
+            if not self.get('OpenAI', 'OpenAILibraryPath') and openai_txt_path.is_file():
+                openai_pip_path = helpers.pip_location_to_path(openai_txt_path.read_text())
+                library_path = str(openai_pip_path.resolve())
+                self.set('OpenAI', 'OpenAILibraryPath', library_path)
 
     def _config_path_string(self):
-        return str(self.path.resolve())
+        # Resolving hits the disk, only do it once
+        if self._resolved_path is None:
+            self._resolved_path = str(self.path.resolve())
+        return self._resolved_path
+
+    def _stamp(self):
+        """Get what identifies the current version of the file, or None if it doesn't exist."""
+        try:
+            stat = self.path.stat()
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read(self, check=False):
+        """
+        Get the parsed configuration file.
 
-    def _read(self):
-        # Read the configuration file
-        self.parser.read(self._config_path_string())
-        return self.parser
+        The file is only parsed again when its modification time or size has changed, and
+        that is checked at most once every CHECK_INTERVAL seconds.
+
+        Args:
+            check (bool, optional): Check if the file has changed right away. Defaults to False.
+        """
+        key = self._config_path_string()
+        now = time.monotonic()
+        with Config._lock:
+            snapshot = Config._snapshots.get(key)
+            if snapshot and not check and now - snapshot['checked'] < self.CHECK_INTERVAL:
+                self.parser = snapshot['parser']
+                return self.parser
+
+            stamp = self._stamp()
+            if snapshot and snapshot['stamp'] == stamp:
+                snapshot['checked'] = now
+                self.parser = snapshot['parser']
+                return self.parser
+
+            # Read the configuration file
+            parser = configparser.ConfigParser()
+            parser.optionxform = str
+            parser.read(key)
+            Config._snapshots[key] = {'parser': parser, 'stamp': stamp, 'checked': now}
+            self.parser = parser
+            return self.parser
 
     def _write(self):
-        with self.path.open('w') as configfile:
-            self.parser.write(configfile)
+        with Config._lock:
+            # Write to a temporary file and swap it in, so a crash never leaves half a file
+            temp_file = tempfile.NamedTemporaryFile('w', dir=str(self.path.parent), prefix=f'.{self.path.name}.',
+                                                    suffix='.tmp', delete=False)
+            try:
+                with temp_file as configfile:
+                    self.parser.write(configfile)
+                os.replace(temp_file.name, str(self.path))
+            except Exception:
+                os.remove(temp_file.name)
+                # The parsed snapshot has changes that didn't make it to the file
+                self.invalidate()
+                raise
+            Config._snapshots[self._config_path_string()] = {'parser': self.parser,
+                                                             'stamp': self._stamp(),
+                                                             'checked': time.monotonic()}
+
+    def invalidate(self):
+        """Forget the parsed file so it's read again on the next lookup."""
+        with Config._lock:
+            Config._snapshots.pop(self._config_path_string(), None)
 
     def get(self, section, key, fallback=None):
         """
@@ -112,7 +181,7 @@ class Config:
         self._read()
         value = fallback
         if self.parser.has_section(section):
-            value = self.parser[section].get(key)
+            value = self.parser[section].get(key, fallback)
         else:
             logging.warning(f'Section "{section}" does not exist in {self.path.name}')
         return value
@@ -133,31 +202,224 @@ class Config:
         """
         Write a key-value pair to the configuration file.
 
+        Inside a batch() the change is written when the batch ends.
+
         Args:
             key (str): The key to write to the configuration file.
             value (str): The value to associate with the key.
         """
-        self._read()
-        if not self.parser.has_section(section):
-            self.parser[section] = {key: value}
-        else:
-            # Write the key-value pair to the configuration file
-            self.parser[section][key] = value
-        self._write()
+        if self._pending is not None:
+            self._pending.append((section, key, value))
+            return self.parser
+
+        return self._commit([(section, key, value)])
+
+    def _commit(self, changes):
+        """Apply changes to the file on disk and write it once."""
+        with Config._lock:
+            # Always start from the file on disk so changes made elsewhere aren't overwritten
+            self._read(check=True)
+            for section, key, value in changes:
+                if not self.parser.has_section(section):
+                    self.parser[section] = {key: value}
+                else:
+                    # Write the key-value pair to the configuration file
+                    self.parser[section][key] = value
+            self._write()
         return self.parser
 
+    @contextmanager
+    def batch(self):
+        """
+        Collect the changes made with set() and write them all at once when the block ends.
 
-def setup_openai():
-    # Set up a virtual environment using venv
-    env_dir = config_path() / 'venv'
-    env_dir.mkdir(exist_ok=True, parents=True)
-    venv.create(env_dir, with_pip=True)
-
-    # where requirements.txt is in same dir as this script
-    subprocess.check_call([env_dir / 'bin/pip', "install", "openai"], cwd=dir)
+        Nothing is written if the block raises an exception. Until the block ends get()
+        returns the values from before the batch.
 
-    # Return path to virtual environment site-packages
-    return os.path.join(env_dir, 'lib', 'python3.7', 'site-packages')
+        Example:
+            with config.batch():
+                config.set('OpenAI', 'OpenAIApiKey', key)
+                config.set('OpenAI', 'OpenAILibraryPath', path)
+        """
+        # Nested batches are written by the outermost one
+        if self._pending is not None:
+            yield self
+            return
+
+        self._pending = []
+        try:
+            yield self
+            changes = self._pending
+        finally:
+            self._pending = None
+        if changes:
+            self._commit(changes)
+
+
+def maya_version():
+    """Get the version of the running Maya, or 'standalone' outside of Maya."""
+    try:
+        from maya import cmds
+
+        return str(cmds.about(version=True))
+    except Exception:
+        return 'standalone'
+
+
+def python_executable():
+    """
+    Get mayapy, to install packages with and to run the preview workers.
+
+    Inside Maya sys.executable is Maya itself, so mayapy is used instead. It's next to Maya
+    on Windows and Linux, and in Maya.app/Contents/bin on macOS.
+
+    Returns:
+        pathlib.Path: Path to the interpreter.
+
+    Raises:
+        FileNotFoundError: If there is no mayapy, sys.executable can't be used instead since
+            inside Maya it would start another Maya.
+    """
+    executable = Path(sys.executable)
+    candidates = [executable.with_name('mayapy.exe'),
+                  executable.with_name('mayapy'),
+                  executable.parent.parent / 'bin' / 'mayapy']
+    for candidate in candidates:
+        if candidate.is_file():
+            return candidate
+    raise FileNotFoundError(f'mayapy not found next to {executable}')
+
+
+def environment_path():
+    """Get the folder packages are installed to for this Maya and python version."""
+    return config_path() / 'env' / f'maya{maya_version()}-py{sys.version_info.major}{sys.version_info.minor}'
+
+
+def _provision_stamp(wheelhouse, packages):
+    """Describe what an environment was provisioned from, to tell if it's up to date."""
+    wheels = []
+    if wheelhouse:
+        wheels = sorted([wheel.name, wheel.stat().st_size] for wheel in Path(wheelhouse).iterdir()
+                        if wheel.suffix in ('.whl', '.gz', '.zip'))
+    return {'python': sys.version,
+            'platform': sys.platform,
+            'packages': sorted(packages),
+            'wheels': wheels}
+
+
+def setup_openai(wheelhouse=None, packages=('openai',), force=False):
+    """
+    Install openai for the running Maya and point the config at it.
+
+    With a wheelhouse, a folder of pre-built wheels, everything is installed offline. The
+    result is kept per Maya and python version and nothing is installed again until the
+    wheelhouse or the packages change.
+
+    Args:
+        wheelhouse (str, optional): Folder with wheels to install from. Defaults to
+            OpenAIWheelhouse in the config or the CHATGPT4MAYA_WHEELHOUSE environment variable,
+            if neither is set packages are downloaded from PyPI.
+        packages (tuple[str], optional): Packages to install. Defaults to ('openai',).
+        force (bool, optional): Install even if the environment is up to date. Defaults to False.
+
+    Returns:
+        pathlib.Path: The folder the packages were installed to.
+
+    Raises:
+        FileNotFoundError: If mayapy can't be found.
+    """
+    settings = Config()
+    wheelhouse = wheelhouse or settings.get('OpenAI', 'OpenAIWheelhouse') or os.getenv('CHATGPT4MAYA_WHEELHOUSE')
+    env_dir = environment_path()
+    site_packages = env_dir / 'site-packages'
+    stamp_path = env_dir / 'provisioned.json'
+    stamp = _provision_stamp(wheelhouse, packages)
+
+    if not force and site_packages.is_dir() and stamp_path.is_file():
+        try:
+            up_to_date = json.loads(stamp_path.read_text()) == stamp
+        except ValueError:
+            up_to_date = False
+        if up_to_date:
+            logging.info(f'openai is up to date in {site_packages}')
+            settings.set('OpenAI', 'OpenAILibraryPath', str(site_packages))
+            return site_packages
+
+    # Install next to the final folder and swap it in, so a failed install leaves the old one working
+    python = python_executable()
+    env_dir.mkdir(exist_ok=True, parents=True)
+    staging = Path(tempfile.mkdtemp(prefix='site-packages-', dir=str(env_dir)))
+    command = [str(python), '-m', 'pip', 'install', '--disable-pip-version-check',
+               '--target', str(staging)]
+    if wheelhouse:
+        command += ['--no-index', '--find-links', str(wheelhouse)]
+    command += list(packages)
+    logging.info(f'Installing {", ".join(packages)} to {site_packages}')
+    try:
+        subprocess.check_call(command)
+    except (OSError, subprocess.CalledProcessError):
+        shutil.rmtree(str(staging), ignore_errors=True)
+        raise
+
+    # Loaded extension modules can't be deleted on Windows, so the old folder is moved aside
+    # before the new one is swapped in, and deleted afterwards as far as possible
+    old = None
+    if site_packages.is_dir():
+        old = Path(tempfile.mkdtemp(prefix='site-packages-old-', dir=str(env_dir)))
+        old.rmdir()
+        try:
+            site_packages.replace(old)
+        except OSError:
+            # Still in use, the current install is left as it is
+            shutil.rmtree(str(staging), ignore_errors=True)
+            raise
+    try:
+        staging.replace(site_packages)
+    except OSError:
+        if old is not None:
+            old.replace(site_packages)
+        shutil.rmtree(str(staging), ignore_errors=True)
+        raise
+    stamp_path.write_text(json.dumps(stamp))
+
+    # Remove this old folder and any that couldn't be removed before
+    for folder in env_dir.glob('site-packages-old-*'):
+        shutil.rmtree(str(folder), ignore_errors=True)
+
+    settings.set('OpenAI', 'OpenAILibraryPath', str(site_packages))
+    return site_packages
+
+
+def build_wheelhouse(path, packages=('openai',), python_version=None, platform=None):
+    """
+    Download wheels for the packages and all their dependencies, to provision machines offline.
+
+    Args:
+        path (str): Folder to put the wheels in.
+        packages (tuple[str], optional): Packages to download. Defaults to ('openai',).
+        python_version (str, optional): Python version of the target machines, like '3.10'.
+            Defaults to the running version.
+        platform (str, optional): Platform tag of the target machines, like 'win_amd64'.
+            Defaults to the running platform.
+
+    Returns:
+        pathlib.Path: The wheelhouse folder.
+
+    Raises:
+        FileNotFoundError: If mayapy can't be found.
+    """
+    python = python_executable()
+    path = Path(path)
+    path.mkdir(exist_ok=True, parents=True)
+    command = [str(python), '-m', 'pip', 'download', '--disable-pip-version-check',
+               '--only-binary=:all:', '--dest', str(path)]
+    if python_version:
+        command += ['--python-version', python_version]
+    if platform:
+        command += ['--platform', platform]
+    command += list(packages)
+    subprocess.check_call(command)
+    return path
 
 
 # def setup_openai():
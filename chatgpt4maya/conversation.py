@@ -0,0 +1,417 @@
+"""conversation.py
+Virtualized view of the conversation in the chat window.
+
+Messages are kept in a list model. Only the messages in view get widgets, as persistent
+editors of the list view, and only those are measured. Every other message keeps the
+height its widget had when it was last in view, or an estimate worked out from the
+length of its lines, so resizing the window never lays out messages that aren't shown.
+"""
+import html
+import itertools
+import logging
+import math
+import weakref
+from collections import OrderedDict
+
+from PySide2 import QtCore, QtGui, QtWidgets
+
+from chatgpt4maya import codeview, config, markdown, styles
+
+logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
+
+MessageRole = QtCore.Qt.UserRole + 1
+
+_message_keys = itertools.count()
+
+
+class Message:
+    """A message in the conversation and the state of its code blocks."""
+
+    def __init__(self, user, segments=None, is_bot=True, pending=False):
+        """
+        Args:
+            user (str): Name shown on the message.
+            segments (list[markdown.Segment], optional): The content. Defaults to None.
+            is_bot (bool, optional): True for replies. Defaults to True.
+            pending (bool, optional): True while waiting for the reply. Defaults to False.
+        """
+        self.user = user
+        self.segments = segments if segments is not None else []
+        self.is_bot = is_bot
+        self.pending = pending
+
+        # Text of the segment of a streamed reply that is still being received
+        self.stream_text = ''
+
+        # Status lines of the code blocks by code block id, kept here so they survive the
+        # widget being deleted when the message scrolls out of view
+        self.statuses = {}
+
+        # Code that ran without errors in a preview worker
+        self.proven_code = set()
+
+        # Identify the message and its changes, for caching its layout
+        self.key = next(_message_keys)
+        self.version = 0
+        self._model = None
+        self.row = -1
+
+    @classmethod
+    def from_content(cls, user, content, is_bot=True):
+        """
+        Create a message from markdown.
+
+        Args:
+            user (str): Name shown on the message.
+            content (str or list): Markdown, or a list of markdown strings and segments.
+            is_bot (bool, optional): True for replies. Defaults to True.
+
+        Returns:
+            Message: The message.
+        """
+        if isinstance(content, str):
+            content = [content]
+        segments = []
+        for part in content:
+            segments.extend(markdown.parse(part) if isinstance(part, str) else [part])
+        return cls(user, segments, is_bot)
+
+    def notify(self):
+        """Let the view know the message changed, must be called on the main thread."""
+        self.version += 1
+        model = self._model() if self._model else None
+        if model is not None:
+            model.message_changed(self)
+
+    def html(self):
+        """The message as rich text, for painting it without widgets."""
+        parts = [f'<p><b>{html.escape(self.user)}</b></p>']
+        for segment in self.segments:
+            if segment.kind == markdown.CODE:
+                parts.append(markdown.to_html(segment))
+            else:
+                parts.append(f'<p>{markdown.to_html(segment)}</p>')
+        if self.stream_text:
+            parts.append(f'<p>{markdown.spans_html([(markdown.TEXT, self.stream_text)])}</p>')
+        elif self.pending and not self.segments:
+            parts.append('<p>...</p>')
+        return ''.join(parts)
+
+    def text(self):
+        """The message as plain text."""
+        return '\n\n'.join(segment.text for segment in self.segments)
+
+
+class ConversationModel(QtCore.QAbstractListModel):
+    """The messages of the conversation, in order."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._messages = []
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self._messages)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._messages):
+            return None
+        message = self._messages[index.row()]
+        if role == MessageRole:
+            return message
+        if role == QtCore.Qt.DisplayRole:
+            return message.text()
+        return None
+
+    def messages(self):
+        return list(self._messages)
+
+    def append(self, message):
+        """
+        Add a message to the end of the conversation.
+
+        Args:
+            message (Message): The message.
+
+        Returns:
+            Message: The message.
+        """
+        row = len(self._messages)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        message.row = row
+        message._model = weakref.ref(self)
+        self._messages.append(message)
+        self.endInsertRows()
+        return message
+
+    def message_changed(self, message):
+        index = self.index(message.row)
+        self.dataChanged.emit(index, index)
+
+    def clear(self):
+        self.beginResetModel()
+        for message in self._messages:
+            message._model = None
+        self._messages = []
+        self.endResetModel()
+
+
+class ConversationDelegate(QtWidgets.QStyledItemDelegate):
+    """
+    Measures and paints messages, and creates the widgets of the messages in view.
+
+    The widgets come from widget_factory(message, parent). They must have an
+    update_message(message) method that returns False if the widget can't show the
+    message as it is now, then a new widget is created.
+    """
+
+    # Max number of laid out messages kept for painting
+    CACHE_SIZE = 64
+
+    def __init__(self, widget_factory, parent=None):
+        super().__init__(parent)
+        self.widget_factory = widget_factory
+        self.margin = styles.Margin.medium
+        self._documents = OrderedDict()
+        self._editor_indexes = weakref.WeakKeyDictionary()
+
+        # Heights of the widgets of messages, and what's needed to estimate the others
+        self._heights = weakref.WeakKeyDictionary()
+        self._line_widths_cache = weakref.WeakKeyDictionary()
+
+    def document(self, message, width):
+        """
+        Get the laid out rich text of a message, for painting it until its widget is created.
+
+        Cached per version of the message and width.
+
+        Args:
+            message (Message): The message.
+            width (int): The width it is shown at.
+
+        Returns:
+            QtGui.QTextDocument: The document.
+        """
+        key = (message.key, message.version, width)
+        document = self._documents.get(key)
+        if document is not None:
+            self._documents.move_to_end(key)
+            return document
+
+        document = QtGui.QTextDocument()
+        document.setDocumentMargin(0)
+        document.setHtml(message.html())
+        document.setTextWidth(max(1, width - self.margin * 2))
+        self._documents[key] = document
+        if len(self._documents) > self.CACHE_SIZE:
+            self._documents.popitem(last=False)
+        return document
+
+    def _width(self, option):
+        view = self.parent()
+        if view is None:
+            return option.rect.width()
+        return view.viewport().width() - view.spacing() * 2
+
+    def _font_metrics(self):
+        view = self.parent()
+        return view.fontMetrics() if view is not None else QtGui.QFontMetrics(QtGui.QFont())
+
+    def _line_widths(self, message):
+        """
+        Get the parts of a message that wrap and the height of the parts that don't.
+
+        Returns:
+            tuple[int, list[int]]: The height that doesn't depend on the width, and the width
+                of each line of text in pixels.
+        """
+        cached = self._line_widths_cache.get(message)
+        if cached is not None and cached[0] == message.version:
+            return cached[1]
+
+        font_metrics = self._font_metrics()
+        line_height = font_metrics.lineSpacing()
+        # The name above the message
+        fixed = line_height + self.margin
+        widths = []
+        for segment in message.segments:
+            if segment.kind == markdown.CODE:
+                lines = segment.text.count('\n') + 1
+                fixed += min(lines, codeview.COLLAPSED_LINES) * line_height + self.margin * 2
+                if lines > codeview.COLLAPSED_LINES:
+                    fixed += line_height + styles.Margin.xsmall
+                # Run, Preview, Copy and Profile buttons
+                fixed += line_height + self.margin * 2
+            else:
+                lines = segment.items if segment.kind == markdown.LIST else segment.text.split('\n')
+                widths.extend(font_metrics.horizontalAdvance(line) for line in lines)
+            fixed += self.margin
+        for line in message.stream_text.split('\n') if message.stream_text else []:
+            widths.append(font_metrics.horizontalAdvance(line))
+        if message.pending and not message.segments and not message.stream_text:
+            fixed += line_height
+
+        self._line_widths_cache[message] = (message.version, (fixed, widths))
+        return fixed, widths
+
+    def estimate_height(self, message, width):
+        """
+        Estimate the height of a message without laying it out.
+
+        Args:
+            message (Message): The message.
+            width (int): The width it is shown at.
+
+        Returns:
+            int: The height.
+        """
+        fixed, widths = self._line_widths(message)
+        text_width = max(1, width - self.margin * 2)
+        lines = sum(max(1, math.ceil(line_width / text_width)) for line_width in widths)
+        return fixed + lines * self._font_metrics().lineSpacing() + self.margin * 2
+
+    def sizeHint(self, option, index):
+        message = index.data(MessageRole)
+        width = self._width(option)
+        view = self.parent()
+        editor = view.indexWidget(index) if view is not None else None
+        if editor is not None:
+            if editor.hasHeightForWidth():
+                height = editor.heightForWidth(width)
+            else:
+                height = editor.sizeHint().height()
+            self._heights[message] = (message.version, height)
+            return QtCore.QSize(width, height)
+
+        # Messages out of view keep the height they had when they were last in view
+        measured = self._heights.get(message)
+        if measured is not None and measured[0] == message.version:
+            return QtCore.QSize(width, measured[1])
+        return QtCore.QSize(width, self.estimate_height(message, width))
+
+    def paint(self, painter, option, index):
+        # Messages with a widget are drawn by the widget
+        view = self.parent()
+        if view is not None and view.indexWidget(index) is not None:
+            return
+
+        message = index.data(MessageRole)
+        document = self.document(message, self._width(option))
+        painter.save()
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        painter.setPen(QtCore.Qt.NoPen)
+        painter.setBrush(QtGui.QColor(styles.Color.gray if message.is_bot else styles.Color.blue))
+        painter.drawRoundedRect(option.rect, self.margin, self.margin)
+        painter.translate(option.rect.left() + self.margin, option.rect.top() + self.margin)
+        document.drawContents(painter)
+        painter.restore()
+
+    def createEditor(self, parent, option, index):
+        editor = self.widget_factory(index.data(MessageRole), parent)
+        self._editor_indexes[editor] = QtCore.QPersistentModelIndex(index)
+        editor.installEventFilter(self)
+        return editor
+
+    def setEditorData(self, editor, index):
+        pass
+
+    def updateEditorGeometry(self, editor, option, index):
+        editor.setGeometry(option.rect)
+
+    def eventFilter(self, watched, event):
+        # The widget of a message changed size, the view has to make room for it
+        if event.type() == QtCore.QEvent.LayoutRequest:
+            index = self._editor_indexes.get(watched)
+            if index is not None and index.isValid():
+                self.sizeHintChanged.emit(QtCore.QModelIndex(index))
+        return False
+
+
+class ConversationView(QtWidgets.QListView):
+    """
+    List of messages that only keeps widgets for the messages in view.
+    """
+
+    # Number of messages above and below the view that keep their widgets
+    OVERSCAN = 2
+
+    def __init__(self, model, widget_factory, parent=None):
+        """
+        Args:
+            model (ConversationModel): The messages.
+            widget_factory (callable): Creates the widget of a message, see ConversationDelegate.
+            parent (QtWidgets.QWidget, optional): Parent widget. Defaults to None.
+        """
+        super().__init__(parent)
+        self.setModel(model)
+        self.setItemDelegate(ConversationDelegate(widget_factory, self))
+        self.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.setResizeMode(QtWidgets.QListView.Adjust)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        self.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.setFocusPolicy(QtCore.Qt.NoFocus)
+        self.setFrameStyle(QtWidgets.QFrame.NoFrame)
+        self.setMouseTracking(True)
+
+        # Rows with a widget
+        self._open_rows = set()
+
+        # Update the widgets once per event loop iteration, however many changes came in
+        self._update_timer = QtCore.QTimer(self)
+        self._update_timer.setSingleShot(True)
+        self._update_timer.setInterval(0)
+        self._update_timer.timeout.connect(self.update_widgets)
+
+        self.verticalScrollBar().valueChanged.connect(self.schedule_update)
+        model.rowsInserted.connect(self.schedule_update)
+        model.modelReset.connect(self._model_reset)
+        model.dataChanged.connect(self._data_changed)
+
+    def schedule_update(self, *args):
+        self._update_timer.start()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.schedule_update()
+
+    def _model_reset(self):
+        self._open_rows.clear()
+        self.schedule_update()
+
+    def visible_rows(self):
+        """
+        Get the rows in view, with a few extra rows above and below.
+
+        Returns:
+            range: The rows.
+        """
+        count = self.model().rowCount()
+        if not count:
+            return range(0)
+        viewport = self.viewport().rect()
+        top = self.indexAt(viewport.topLeft() + QtCore.QPoint(1, 1)).row()
+        bottom = self.indexAt(viewport.bottomLeft() + QtCore.QPoint(1, -1)).row()
+        top = 0 if top < 0 else top
+        bottom = count - 1 if bottom < 0 else bottom
+        return range(max(0, top - self.OVERSCAN), min(count, bottom + self.OVERSCAN + 1))
+
+    def update_widgets(self):
+        """Create widgets for the messages that came into view and delete the others."""
+        model = self.model()
+        visible = set(self.visible_rows())
+        for row in self._open_rows - visible:
+            self.closePersistentEditor(model.index(row))
+        for row in visible - self._open_rows:
+            self.openPersistentEditor(model.index(row))
+        self._open_rows = visible
+
+    def _data_changed(self, top_left, bottom_right, roles=None):
+        model = self.model()
+        for row in range(top_left.row(), bottom_right.row() + 1):
+            index = model.index(row)
+            widget = self.indexWidget(index)
+            if widget is not None and not widget.update_message(index.data(MessageRole)):
+                # The widget can't show the message like this, make a new one
+                self.closePersistentEditor(index)
+                self.openPersistentEditor(index)
+            self.itemDelegate().sizeHintChanged.emit(index)
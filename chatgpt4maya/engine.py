@@ -0,0 +1,177 @@
+"""engine.py
+Asyncio event loop on a dedicated thread for running several requests at once.
+"""
+import asyncio
+import logging
+import threading
+import time
+import weakref
+
+from chatgpt4maya import config, metrics
+
+logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
+
+# Requests running at once when MaxConcurrentRequests isn't set in the config
+MAX_CONCURRENCY = 4
+
+
+class AsyncEngine:
+    """
+    Runs coroutines on an event loop in a background thread.
+
+    Any number of coroutines can be submitted from any thread, at most max_concurrency
+    of them run at the same time. Coroutines submitted with the same key run one at a
+    time in the order they were submitted, so each conversation keeps its turns in order
+    while other conversations run in parallel.
+    """
+
+    def __init__(self, max_concurrency=4):
+        """
+        Initialize the engine and start the event loop thread.
+
+        Args:
+            max_concurrency (int, optional): Max number of coroutines running at once. Defaults to 4.
+        """
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self._semaphore = None
+        self._locks = weakref.WeakValueDictionary()
+        self._thread = threading.Thread(target=self._run, name='ChatGPTAsyncEngine', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def _lock(self, key):
+        # Only called on the loop thread, so no locking needed around the dictionary
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    async def _run_limited(self, coroutine, key, submitted):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        if key is None:
+            async with self._semaphore:
+                metrics.histogram('engine.queue_seconds').observe(time.perf_counter() - submitted)
+                return await coroutine
+
+        # Wait for our turn in the queue before taking one of the concurrency slots
+        async with self._lock(key):
+            async with self._semaphore:
+                metrics.histogram('engine.queue_seconds').observe(time.perf_counter() - submitted)
+                return await coroutine
+
+    def submit(self, coroutine, key=None):
+        """
+        Schedule a coroutine on the event loop.
+
+        Args:
+            coroutine (coroutine): The coroutine to run.
+            key (hashable, optional): Coroutines with the same key run one at a time, in
+                the order they were submitted. Defaults to None.
+
+        Returns:
+            concurrent.futures.Future: A future for the result of the coroutine.
+        """
+        return asyncio.run_coroutine_threadsafe(self._run_limited(coroutine, key, time.perf_counter()), self.loop)
+
+    def run(self, function, *args):
+        """
+        Call a function on the event loop thread, outside of the concurrency limit.
+
+        State used by the running coroutines can be read and changed this way from other
+        threads, since the coroutines only run on the event loop thread.
+
+        Args:
+            function (callable): The function to call.
+            *args: Arguments to call it with.
+
+        Returns:
+            concurrent.futures.Future: A future for what the function returns.
+        """
+
+        async def call():
+            return function(*args)
+
+        return self.call(call())
+
+    def call(self, coroutine):
+        """
+        Run a coroutine on the event loop right away, outside of the concurrency limit.
+
+        Args:
+            coroutine (coroutine): The coroutine to run.
+
+        Returns:
+            concurrent.futures.Future: A future for the result of the coroutine.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def is_running(self):
+        return self._thread.is_alive()
+
+    def stop(self, timeout=5):
+        """
+        Cancel everything that's running and stop the event loop.
+
+        Args:
+            timeout (float, optional): Max seconds to wait for the thread. Defaults to 5.
+        """
+        if not self.is_running():
+            return
+
+        def cancel_all():
+            for task in asyncio.all_tasks(self.loop):
+                task.cancel()
+            self.loop.call_soon(self.loop.stop)
+
+        self.loop.call_soon_threadsafe(cancel_all)
+        self._thread.join(timeout)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def engine(max_concurrency=None):
+    """
+    Get the engine shared by the whole session, starting it if needed.
+
+    Args:
+        max_concurrency (int, optional): Max number of requests running at once, only used
+            when the engine is started. Defaults to MaxConcurrentRequests in the OpenAI
+            section of the config, or MAX_CONCURRENCY.
+
+    Returns:
+        AsyncEngine: The running engine.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None or not _engine.is_running():
+            if max_concurrency is None:
+                max_concurrency = int(config.Config().get('OpenAI', 'MaxConcurrentRequests') or MAX_CONCURRENCY)
+            _engine = AsyncEngine(max_concurrency)
+        return _engine
+
+
+def running_engine():
+    """Get the engine shared by the session if it's running, without starting it."""
+    with _engine_lock:
+        if _engine is not None and _engine.is_running():
+            return _engine
+        return None
+
+
+def shutdown():
+    """Stop the shared engine, if it was started."""
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.stop()
+            _engine = None
@@ -0,0 +1,413 @@
+"""execution.py
+Runs code blocks from ChatGPT replies as Python or MEL.
+
+The language comes from the tag after the code fence, or is guessed from the code when
+there is none. Compiled Python is cached per code block, so running a block again
+doesn't parse it again. MEL is passed to mel.eval as it is, large scripts are written to
+a file and sourced.
+
+Code run from the chat goes through run_deferred, which runs it when Maya is idle as a
+single undo step and with the viewport refresh suspended. It can also be run under
+cProfile, to find out what makes a slow script slow.
+
+The Maya modules are imported when code is run, so the preview workers can import this
+module before maya.standalone is initialized.
+"""
+import contextlib
+import cProfile
+import datetime
+import functools
+import hashlib
+import logging
+import pstats
+import re
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+from chatgpt4maya import config, metrics
+
+logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
+
+PYTHON = 'python'
+MEL = 'mel'
+
+LANGUAGES = {'python': PYTHON,
+             'python3': PYTHON,
+             'py': PYTHON,
+             'mel': MEL}
+
+# MEL longer than this is sourced from a file instead of passed to mel.eval
+MEL_SOURCE_SIZE = 4096
+
+# How cProfile names maya.cmds functions
+CMDS_PREFIX = '<built-in method maya.cmds.'
+
+_python_hints = re.compile(r'^\s*(?:import\s+\w|from\s+\w+\s+import\b|def\s+\w+\s*\(|class\s+\w+|'
+                           r'(?:for|while|if|elif|with|try)\b[^;]*:\s*(?:#.*)?$|else\s*:|print\s*\()|'
+                           r'\bcmds\.\w+\s*\(|\bpm\.\w+\s*\(', re.MULTILINE)
+_mel_hints = re.compile(r'\$\w+|;\s*$|^\s*(?:global\s+)?proc\s+|'
+                        r'^\s*(?:string|int|float|vector|matrix)(?:\[\])?\s+\$|\s-\w+\b(?!\s*=)',
+                        re.MULTILINE)
+
+
+class ExecutionResult:
+    """What happened when a code block was run."""
+
+    def __init__(self, language, success=True, error=None, elapsed=0.0, details=None):
+        """
+        Args:
+            language (str): PYTHON or MEL.
+            success (bool, optional): False if the code raised an error. Defaults to True.
+            error (str, optional): The error message. Defaults to None.
+            elapsed (float, optional): Seconds it took to run. Defaults to 0.
+            details (str, optional): The full traceback of the error. Defaults to None.
+        """
+        self.language = language
+        self.success = success
+        self.error = error
+        self.elapsed = elapsed
+        self.details = details
+        self.profile = None
+
+    def __repr__(self):
+        return f'ExecutionResult({self.language!r}, success={self.success}, elapsed={self.elapsed:.3f})'
+
+    def to_dict(self):
+        """The result as a dictionary that can be sent as json."""
+        return {'language': self.language,
+                'success': self.success,
+                'error': self.error,
+                'elapsed': self.elapsed,
+                'details': self.details}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a result from the output of to_dict()."""
+        return cls(data['language'], data['success'], data.get('error'), data.get('elapsed', 0.0),
+                   data.get('details'))
+
+    def summary(self):
+        """A one line description to show next to the code block."""
+        language = {MEL: 'MEL', PYTHON: 'Python'}.get(self.language, 'Code')
+        if self.success:
+            return f'Ran {language} in {self.elapsed * 1000:.0f} ms'
+        return f'{language} error after {self.elapsed * 1000:.0f} ms: {self.error}'
+
+
+@functools.lru_cache(maxsize=512)
+def detect_language(code, language=None):
+    """
+    Get the language of a code block.
+
+    Args:
+        code (str): The code.
+        language (str, optional): The tag after the code fence. Defaults to None.
+
+    Returns:
+        str: PYTHON or MEL.
+    """
+    if language and language.lower() in LANGUAGES:
+        return LANGUAGES[language.lower()]
+
+    python_score = len(_python_hints.findall(code))
+    mel_score = len(_mel_hints.findall(code))
+    if python_score != mel_score:
+        return PYTHON if python_score > mel_score else MEL
+
+    # Too close to call, code that compiles as Python probably is Python
+    try:
+        compile_python(code)
+    except SyntaxError:
+        return MEL
+    return PYTHON
+
+
+@functools.lru_cache(maxsize=256)
+def compile_python(code):
+    """
+    Compile Python code, once per code block.
+
+    Args:
+        code (str): The code.
+
+    Returns:
+        code: The compiled code object.
+    """
+    return compile(code, '<chatgpt code block>', 'exec')
+
+
+def mel_script_path(code):
+    """
+    Write MEL code to a file named after its content, so it's only written once.
+
+    Args:
+        code (str): The code.
+
+    Returns:
+        pathlib.Path: The path to the .mel file.
+    """
+    directory = Path(tempfile.gettempdir()) / 'chatgpt4maya'
+    directory.mkdir(exist_ok=True)
+    path = directory / f'{hashlib.sha1(code.encode("utf-8")).hexdigest()}.mel'
+    if not path.is_file():
+        path.write_text(code, encoding='utf-8')
+    return path
+
+
+def run_mel(code):
+    """
+    Run MEL code, large scripts are sourced from a file.
+
+    Args:
+        code (str): The code.
+    """
+    from maya import mel
+
+    if len(code) <= MEL_SOURCE_SIZE:
+        mel.eval(code)
+    else:
+        mel.eval(f'source "{mel_script_path(code).as_posix()}";')
+
+
+def run_python(code, namespace=None):
+    """
+    Run Python code in its own namespace, with maya.cmds and maya.mel already imported.
+
+    Args:
+        code (str): The code.
+        namespace (dict, optional): Globals to run the code in. Defaults to a new namespace.
+    """
+    if namespace is None:
+        from maya import cmds, mel
+
+        namespace = {'__name__': '__main__', 'cmds': cmds, 'mel': mel}
+    exec(compile_python(code), namespace)
+
+
+def run(code, language=None, namespace=None):
+    """
+    Run a code block.
+
+    Args:
+        code (str): The code.
+        language (str, optional): The tag after the code fence. Defaults to None.
+        namespace (dict, optional): Globals to run Python code in. Defaults to a new namespace.
+
+    Returns:
+        ExecutionResult: The outcome.
+    """
+    language = detect_language(code, language)
+    start = time.perf_counter()
+    try:
+        if language == MEL:
+            run_mel(code)
+        else:
+            run_python(code, namespace)
+    except Exception as e:
+        result = ExecutionResult(language, success=False, error=str(e).strip() or type(e).__name__,
+                                 elapsed=time.perf_counter() - start, details=traceback.format_exc())
+        logging.error(f'Running {language} failed: {result.error}')
+        metrics.counter('execution.errors').increment()
+    else:
+        result = ExecutionResult(language, elapsed=time.perf_counter() - start)
+    metrics.histogram(f'execution.{language}_seconds').observe(result.elapsed)
+    return result
+
+
+@contextlib.contextmanager
+def scene_safe(name='ChatGPT code block', suspend_refresh=True, suspend_evaluation=False):
+    """
+    Make everything done inside one undo step, optionally without redrawing the viewport
+    and with the evaluation manager off.
+
+    Args:
+        name (str, optional): Name of the undo step. Defaults to 'ChatGPT code block'.
+        suspend_refresh (bool, optional): Don't redraw the viewport until done. Defaults to True.
+        suspend_evaluation (bool, optional): Switch the evaluation manager to DG mode until
+            done, so it doesn't rebuild its graph after every edit. Defaults to False.
+    """
+    from maya import cmds
+
+    # The mode is switched outside the undo step, so undoing the code doesn't switch it back
+    mode = None
+    if suspend_evaluation:
+        modes = cmds.evaluationManager(query=True, mode=True)
+        if modes and modes[0] != 'off':
+            mode = modes[0]
+            cmds.evaluationManager(mode='off')
+    try:
+        cmds.undoInfo(openChunk=True, chunkName=name)
+        suspended = False
+        try:
+            if suspend_refresh and not cmds.refresh(query=True, suspend=True):
+                cmds.refresh(suspend=True)
+                suspended = True
+            yield
+        finally:
+            if suspended:
+                cmds.refresh(suspend=False)
+                cmds.refresh(force=True)
+            cmds.undoInfo(closeChunk=True)
+    finally:
+        if mode:
+            cmds.evaluationManager(mode=mode)
+
+
+def run_safe(code, language=None, namespace=None, suspend_refresh=True, suspend_evaluation=False):
+    """
+    Run a code block as a single undo step.
+
+    Args:
+        code (str): The code.
+        language (str, optional): The tag after the code fence. Defaults to None.
+        namespace (dict, optional): Globals to run Python code in. Defaults to a new namespace.
+        suspend_refresh (bool, optional): Don't redraw the viewport while running. Defaults to True.
+        suspend_evaluation (bool, optional): Turn the evaluation manager off while running. Defaults to False.
+
+    Returns:
+        ExecutionResult: The outcome, elapsed includes redrawing the viewport afterwards.
+    """
+    start = time.perf_counter()
+    with scene_safe(suspend_refresh=suspend_refresh, suspend_evaluation=suspend_evaluation):
+        result = run(code, language, namespace)
+    result.elapsed = time.perf_counter() - start
+    logging.info(result.summary())
+    return result
+
+
+class ProfileReport:
+    """The hotspots of a profiled code block."""
+
+    def __init__(self, stats, path=None, top=8):
+        """
+        Args:
+            stats (pstats.Stats): The profile.
+            path (pathlib.Path, optional): Where the full profile was saved. Defaults to None.
+            top (int, optional): Number of hotspots to keep. Defaults to 8.
+        """
+        self.path = path
+        self.total_calls = stats.total_calls
+        self.total_time = stats.total_tt
+        self.cmds_calls = 0
+        self.cmds_time = 0.0
+        functions = []
+        for function, (_, calls, own_time, cumulative_time, _) in stats.stats.items():
+            name = function_name(function)
+            if name.startswith('maya.cmds.'):
+                self.cmds_calls += calls
+                self.cmds_time += own_time
+            # The profiler turning itself off isn't part of the code
+            if '_lsprof.Profiler' not in name:
+                functions.append((name, calls, own_time, cumulative_time))
+        functions.sort(key=lambda item: item[2], reverse=True)
+        self.hotspots = functions[:top]
+
+    def summary(self):
+        """A few lines describing where the time went, to show under the code block."""
+        lines = [f'{self.total_calls} calls, {self.cmds_calls} maya.cmds calls '
+                 f'({self.cmds_time * 1000:.0f} ms in maya.cmds)']
+        for name, calls, own_time, cumulative_time in self.hotspots:
+            lines.append(f'{own_time * 1000:8.1f} ms {cumulative_time * 1000:8.1f} ms {calls:7d}x  {name}')
+        if self.path:
+            lines.append(f'Saved to {self.path}')
+        return '\n'.join(lines)
+
+
+def function_name(function):
+    """
+    A readable name for a function in a profile.
+
+    Args:
+        function (tuple): (filename, line, name) as used by pstats.
+
+    Returns:
+        str: maya.cmds.polyCube for Maya commands, file:line(name) for Python functions.
+    """
+    filename, line, name = function
+    if filename == '~':
+        if name.startswith(CMDS_PREFIX):
+            return 'maya.cmds.' + name[len(CMDS_PREFIX):-1]
+        return name
+    return f'{Path(filename).name}:{line}({name})'
+
+
+def profiles_path():
+    """The folder profiles of code blocks are saved in."""
+    return config.config_path() / 'profiles'
+
+
+def run_profiled(code, language=None, namespace=None, suspend_refresh=True, suspend_evaluation=False, top=8):
+    """
+    Run a code block as a single undo step under cProfile.
+
+    The full profile is saved to profiles_path() and can be opened with pstats or
+    snakeviz, the hotspots are in the profile attribute of the result.
+
+    Args:
+        code (str): The code.
+        language (str, optional): The tag after the code fence. Defaults to None.
+        namespace (dict, optional): Globals to run Python code in. Defaults to a new namespace.
+        suspend_refresh (bool, optional): Don't redraw the viewport while running. Defaults to True.
+        suspend_evaluation (bool, optional): Turn the evaluation manager off while running. Defaults to False.
+        top (int, optional): Number of hotspots to report. Defaults to 8.
+
+    Returns:
+        ExecutionResult: The outcome, with a ProfileReport in the profile attribute.
+    """
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    with scene_safe(suspend_refresh=suspend_refresh, suspend_evaluation=suspend_evaluation):
+        profiler.enable()
+        try:
+            result = run(code, language, namespace)
+        finally:
+            profiler.disable()
+    result.elapsed = time.perf_counter() - start
+
+    path = profiles_path()
+    path.mkdir(exist_ok=True, parents=True)
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = path / f'{timestamp}-{hashlib.sha1(code.encode("utf-8")).hexdigest()[:8]}.prof'
+    profiler.dump_stats(str(path))
+
+    result.profile = ProfileReport(pstats.Stats(profiler), path, top)
+    logging.info(f'{result.summary()}\n{result.profile.summary()}')
+    return result
+
+
+def run_deferred(code, language=None, callback=None, suspend_refresh=True, suspend_evaluation=False,
+                 profile=False):
+    """
+    Run a code block as a single undo step when Maya is idle.
+
+    The caller returns right away, so the window can show that the code is running
+    before Maya gets busy with it.
+
+    Args:
+        code (str): The code.
+        language (str, optional): The tag after the code fence. Defaults to None.
+        callback (callable, optional): Called with the ExecutionResult when done. Defaults to None.
+        suspend_refresh (bool, optional): Don't redraw the viewport while running. Defaults to True.
+        suspend_evaluation (bool, optional): Turn the evaluation manager off while running. Defaults to False.
+        profile (bool, optional): Run under cProfile. Defaults to False.
+    """
+
+    def deferred():
+        run_function = run_profiled if profile else run_safe
+        try:
+            result = run_function(code, language, suspend_refresh=suspend_refresh,
+                                  suspend_evaluation=suspend_evaluation)
+        except Exception as e:
+            # Errors in the code are in the result, this is when the undo step or the refresh
+            # couldn't be set up or restored, the caller still has to hear how it went
+            result = ExecutionResult(detect_language(code, language), success=False,
+                                     error=str(e).strip() or type(e).__name__, details=traceback.format_exc())
+            logging.error(f'Running code failed: {result.error}')
+        if callback:
+            callback(result)
+
+    import maya.utils
+
+    maya.utils.executeDeferred(deferred)
@@ -1,6 +1,5 @@
 import logging
 import random
-import re
 import string
 import urllib.request
 import webbrowser
@@ -116,22 +115,6 @@ def random_bot_handle() -> str:
     return random.choice(bot_handles)  # return a randomly selected bot name from the list
 
 
-def get_code_parts(part):
-    """
-    Extracts code parts from a given string using regex pattern matching.
-
-    Args:
-        part (str): The string to extract code parts from.
-
-    Returns:
-        list[str]: A list of strings containing the code parts found in the input string.
-
-    """
-    pattern = r"```(?:\w+\n)?([\s\S]+?)```"  # regex pattern to match code parts
-    code_parts = re.findall(pattern, part)  # extract code parts from input string using regex pattern matching
-    return code_parts  # return the list of code parts found in the input string
-
-
 def random_string(length=16):
     """
     Generates a random string of the specified length.
@@ -148,22 +131,6 @@ def random_string(length=16):
     return ''.join([random.choice(string.ascii_letters) for x in range(length)])
 
 
-def split_code_blocks(input_string):
-    """
-    Splits a string at triple ticks ``` code blocks.
-
-    Args:
-        input_string (str): The string to split.
-
-    Returns:
-        list[str]: A list of strings containing the code blocks and the text outside of the code blocks.
-
-    """
-    # Regex pattern to find code blocks
-    pattern = r'(```(?:\w+\n)?(?:[\s\S]+?)```)'
-    return re.split(pattern, input_string)  # split the input string at the code blocks using the regex pattern
-
-
 def download_file(url, path):
     """
     Downloads a file from the specified URL and saves it to the specified path.
@@ -0,0 +1,309 @@
+"""history.py
+Conversation history stored in an SQLite database.
+"""
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from chatgpt4maya import config
+
+logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id TEXT NOT NULL,
+    created REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_conversation_id ON responses (conversation_id, id);
+CREATE TABLE IF NOT EXISTS migrations (
+    name TEXT PRIMARY KEY,
+    created REAL NOT NULL
+);
+"""
+
+
+class HistoryStore:
+    """
+    Append-only store for api responses, grouped by conversation.
+
+    The database runs in WAL mode so several Maya sessions sharing the same config path
+    can append at the same time without rewriting or corrupting each other's history.
+    """
+
+    def __init__(self, path=None):
+        """
+        Initialize the store and create the database if it doesn't exist.
+        Responses from an existing history.json are migrated the first time.
+
+        Args:
+            path (pathlib.Path, optional): Path to the database file. Defaults to None.
+        """
+        self.path = path if path else config.config_path() / 'history.db'
+        if not self.path.parent.is_dir():
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+
+        self._migrate_json(self.path.parent / 'history.json')
+
+    @contextmanager
+    def _connect(self):
+        # A connection per operation keeps the store safe to use from any thread
+        connection = sqlite3.connect(str(self.path), timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _migrate_json(self, json_path):
+        """Import responses from the old history.json and rename it so it only happens once.
+
+        The responses are inserted in the same transaction that marks the file as migrated,
+        so only one session imports it and a failed import is tried again on the next start.
+        The file is renamed once the import is committed.
+
+        Args:
+            json_path (pathlib.Path): Path to the json history file.
+        """
+        if not json_path.is_file():
+            return
+
+        with self._connect() as connection:
+            migrated = connection.execute('SELECT 1 FROM migrations WHERE name = ?', (json_path.name,)).fetchone()
+        if not migrated:
+            try:
+                with json_path.open('r') as read_file:
+                    data = json.load(read_file)
+            except (OSError, ValueError) as e:
+                logging.error(f'Could not migrate {json_path.name}: {e}')
+                return
+
+            # The json history didn't keep track of conversations, so each response gets its own
+            entries = [(f'migrated-{i}', response) for i, response in enumerate(data)]
+            try:
+                with self._connect() as connection:
+                    # Another session may have migrated it since, then nothing is inserted
+                    marked = connection.execute('INSERT OR IGNORE INTO migrations (name, created) VALUES (?, ?)',
+                                                (json_path.name, time.time()))
+                    if marked.rowcount:
+                        self._insert(connection, entries)
+                        logging.info(f'Migrated {len(entries)} responses from {json_path.name} to {self.path.name}')
+            except sqlite3.Error as e:
+                logging.error(f'Could not migrate {json_path.name}: {e}')
+                return
+
+        try:
+            json_path.replace(json_path.with_suffix('.json.migrated'))
+        except OSError as e:
+            logging.warning(f'Could not rename {json_path.name} after migrating it: {e}')
+
+    def append(self, conversation_id, response):
+        """
+        Append a response to a conversation.
+
+        Args:
+            conversation_id (str): The id of the conversation the response belongs to.
+            response (dict): The response returned from the api.
+        """
+        self.append_many([(conversation_id, response)])
+
+    def append_many(self, entries):
+        """
+        Append several responses in a single transaction.
+
+        Args:
+            entries (list[tuple[str, dict]]): Pairs of conversation id and response.
+        """
+        with self._connect() as connection:
+            self._insert(connection, entries)
+
+    @staticmethod
+    def _insert(connection, entries):
+        now = time.time()
+        rows = [(conversation_id, now, json.dumps(response, default=str)) for conversation_id, response in entries]
+        connection.executemany('INSERT INTO responses (conversation_id, created, data) VALUES (?, ?, ?)', rows)
+
+    def conversation(self, conversation_id):
+        """
+        Get all responses in a conversation, oldest first.
+
+        Args:
+            conversation_id (str): The id of the conversation.
+
+        Returns:
+            list[dict]: The responses in the conversation.
+        """
+        with self._connect() as connection:
+            rows = connection.execute('SELECT data FROM responses WHERE conversation_id = ? ORDER BY id',
+                                      (conversation_id,)).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def conversations(self):
+        """
+        Get the ids of all conversations, most recent first.
+
+        Returns:
+            list[str]: The conversation ids.
+        """
+        with self._connect() as connection:
+            rows = connection.execute('SELECT conversation_id FROM responses '
+                                      'GROUP BY conversation_id ORDER BY MAX(id) DESC').fetchall()
+        return [conversation_id for (conversation_id,) in rows]
+
+
+class HistoryWriter(threading.Thread):
+    """
+    Background thread that persists responses so saving never blocks a request.
+
+    Responses are put on a bounded queue and written to the store in batches, either
+    when the flush interval has passed or when flush() is called.
+    """
+
+    def __init__(self, store=None, interval=2.0, batch_size=64, max_queue=1024):
+        """
+        Initialize the writer. The thread has to be started with start().
+
+        Args:
+            store (HistoryStore, optional): The store to write to. Defaults to a HistoryStore
+                created on the writer thread.
+            interval (float, optional): Seconds between flushes. Defaults to 2.0.
+            batch_size (int, optional): Max number of responses per transaction. Defaults to 64.
+            max_queue (int, optional): Max number of responses waiting to be written. Defaults to 1024.
+        """
+        super().__init__(name='ChatGPTHistoryWriter', daemon=True)
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._stop_event = threading.Event()
+        self._flush_event = threading.Event()
+        self._flushed = threading.Condition()
+        self._pending = 0
+
+    def put(self, conversation_id, response):
+        """
+        Queue a response to be written.
+
+        Args:
+            conversation_id (str): The id of the conversation the response belongs to.
+            response (dict): The response returned from the api.
+        """
+        with self._flushed:
+            self._pending += 1
+        try:
+            self.queue.put_nowait((conversation_id, response))
+        except queue.Full:
+            # Only happens if the disk can't keep up, wait for room rather than lose history
+            logging.warning('History queue is full, waiting for the writer to catch up')
+            self._flush_event.set()
+            self.queue.put((conversation_id, response))
+
+    def _drain(self):
+        """Write everything currently in the queue, batch_size responses per transaction."""
+        while True:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if not batch:
+                return
+
+            try:
+                # Opened here so a database that can't be opened only loses this batch, the
+                # next one tries again
+                if self.store is None:
+                    self.store = HistoryStore()
+                self.store.append_many(batch)
+            except Exception as e:
+                logging.error(f'Could not save {len(batch)} responses to history: {e}')
+
+            with self._flushed:
+                self._pending -= len(batch)
+                self._flushed.notify_all()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._flush_event.wait(self.interval)
+            self._flush_event.clear()
+            self._drain()
+        self._drain()
+
+    def flush(self, timeout=None):
+        """
+        Write all queued responses and wait until they are saved.
+
+        Args:
+            timeout (float, optional): Max seconds to wait. Defaults to None.
+
+        Returns:
+            bool: True if everything was written before the timeout.
+        """
+        if not self.is_alive():
+            self._drain()
+            return True
+
+        self._flush_event.set()
+        with self._flushed:
+            return self._flushed.wait_for(lambda: self._pending <= 0, timeout)
+
+    def stop(self, timeout=None):
+        """
+        Write all queued responses and stop the thread.
+
+        Args:
+            timeout (float, optional): Max seconds to wait. Defaults to None.
+        """
+        self._stop_event.set()
+        self._flush_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def writer():
+    """
+    Get the history writer shared by the whole session, starting it if needed.
+
+    Returns:
+        HistoryWriter: The running history writer.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = HistoryWriter()
+            _writer.start()
+        return _writer
+
+
+def shutdown(timeout=10):
+    """
+    Flush and stop the shared history writer, if it was started.
+
+    Args:
+        timeout (float, optional): Max seconds to wait for pending writes. Defaults to 10.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.stop(timeout)
+            _writer = None
+
+
+if __name__ == '__main__':
+    store = HistoryStore()
+    for each_conversation in store.conversations():
+        print(each_conversation, len(store.conversation(each_conversation)))
@@ -0,0 +1,278 @@
+"""markdown.py
+Incremental parser for the markdown in ChatGPT replies.
+
+Text is scanned once, line by line, and split into typed segments: paragraphs, fenced
+code blocks with their language and lists. Streamed replies can be fed chunk by chunk,
+segments are returned as soon as they are complete.
+"""
+import html
+import re
+
+PARAGRAPH = 'paragraph'
+CODE = 'code'
+LIST = 'list'
+
+TEXT = 'text'
+INLINE_CODE = 'inline_code'
+
+FENCE = '```'
+
+_list_item = re.compile(r'(\s*)(?:[-*+]|(\d+)[.)])\s+(.*)')
+_inline_code = re.compile(r'`([^`\n]+)`')
+
+
+class Segment:
+    """A block of a message."""
+    __slots__ = ('kind', 'text', 'language', 'items', 'start', '_spans')
+
+    def __init__(self, kind, text='', language=None, items=None, start=None):
+        """
+        Args:
+            kind (str): PARAGRAPH, CODE or LIST.
+            text (str, optional): The text of the segment, without fences or list markers. Defaults to ''.
+            language (str, optional): The language after the opening fence of a code block. Defaults to None.
+            items (list[str], optional): The items of a list. Defaults to None.
+            start (int, optional): The number of the first item of a numbered list. Defaults to None
+                for bullet lists.
+        """
+        self.kind = kind
+        self.text = text
+        self.language = language
+        self.items = items if items is not None else []
+        self.start = start
+        self._spans = None
+
+    def __repr__(self):
+        return f'Segment({self.kind!r}, {self.text[:32]!r}, language={self.language!r})'
+
+    def __eq__(self, other):
+        return (isinstance(other, Segment) and self.kind == other.kind and self.text == other.text and
+                self.language == other.language and self.items == other.items and self.start == other.start)
+
+    @property
+    def spans(self):
+        """
+        The inline parts of a paragraph.
+
+        Returns:
+            list[tuple[str, str]]: (TEXT or INLINE_CODE, text) pairs.
+        """
+        if self._spans is None:
+            self._spans = inline_spans(self.text)
+        return self._spans
+
+
+def inline_spans(text):
+    """
+    Split text at `inline code`.
+
+    Args:
+        text (str): The text to split.
+
+    Returns:
+        list[tuple[str, str]]: (TEXT or INLINE_CODE, text) pairs.
+    """
+    if '`' not in text:
+        return [(TEXT, text)] if text else []
+
+    spans = []
+    position = 0
+    for match in _inline_code.finditer(text):
+        if match.start() > position:
+            spans.append((TEXT, text[position:match.start()]))
+        spans.append((INLINE_CODE, match.group(1)))
+        position = match.end()
+    if position < len(text):
+        spans.append((TEXT, text[position:]))
+    return spans
+
+
+class MarkdownParser:
+    """
+    Splits markdown into segments in a single pass.
+
+    Feed it text as it arrives, every call returns the segments that were completed by
+    that text. Call close() at the end to get the last segment.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._kind = None
+        self._lines = []
+        self._items = []
+        self._language = None
+        self._start = None
+        self._indented = False
+
+    def feed(self, text):
+        """
+        Add text to the parser.
+
+        Args:
+            text (str): The next piece of the message.
+
+        Returns:
+            list[Segment]: The segments completed by this text.
+        """
+        self._buffer += text
+        if '\n' not in text:
+            return []
+
+        segments = []
+        *lines, self._buffer = self._buffer.split('\n')
+        for line in lines:
+            self._line(line, segments)
+        return segments
+
+    def close(self):
+        """
+        Finish the message, an unterminated code block is returned as it is.
+
+        Returns:
+            list[Segment]: The remaining segments.
+        """
+        segments = []
+        if self._buffer:
+            self._line(self._buffer, segments)
+            self._buffer = ''
+        self._flush(segments)
+        return segments
+
+    def pending(self):
+        """
+        The segment that is still being received.
+
+        Returns:
+            Segment: The incomplete segment, or None if there is nothing pending.
+        """
+        lines = self._lines + [self._buffer] if self._buffer else self._lines
+        if self._kind == LIST:
+            items = self._items + [self._buffer.strip()] if self._buffer else self._items
+            return Segment(LIST, '\n'.join(items), items=items, start=self._start)
+        if self._kind == CODE:
+            return Segment(CODE, '\n'.join(lines), language=self._language)
+        if lines:
+            return Segment(PARAGRAPH, '\n'.join(lines).strip())
+        return None
+
+    def pending_text(self):
+        """The text of the segment that is still being received, without markup."""
+        if self._kind is None and not self._buffer:
+            return ''
+        segment = self.pending()
+        return segment.text if segment else ''
+
+    def _flush(self, segments):
+        if self._kind is None:
+            return
+        if self._kind == CODE:
+            # Empty code blocks have nothing to run or copy
+            if any(line.strip() for line in self._lines):
+                segments.append(Segment(CODE, '\n'.join(self._lines), language=self._language))
+        elif self._kind == LIST:
+            segments.append(Segment(LIST, '\n'.join(self._items), items=self._items, start=self._start))
+        else:
+            segments.append(Segment(PARAGRAPH, '\n'.join(self._lines).strip()))
+        self._kind = None
+        self._lines = []
+        self._items = []
+        self._language = None
+        self._start = None
+        self._indented = False
+
+    def _line(self, line, segments):
+        if self._kind == CODE:
+            if line.lstrip().startswith(FENCE):
+                self._flush(segments)
+            else:
+                self._lines.append(line)
+            return
+
+        stripped = line.strip()
+        if stripped.startswith(FENCE):
+            self._flush(segments)
+            rest = stripped[len(FENCE):]
+            if rest.endswith(FENCE) and len(rest) >= len(FENCE):
+                # The whole block is on one line
+                if rest[:-len(FENCE)].strip():
+                    segments.append(Segment(CODE, rest[:-len(FENCE)].strip()))
+                return
+            self._kind = CODE
+            self._language = rest.strip().lower() or None
+            return
+
+        if not stripped:
+            self._flush(segments)
+            return
+
+        match = _list_item.match(line) if stripped[0] in '-*+0123456789' else None
+        if match:
+            number = match.group(2)
+            # A numbered list after a bullet list, or the other way around, is a new list
+            if self._kind != LIST or (number is None) != (self._start is None):
+                self._flush(segments)
+                self._kind = LIST
+                self._start = int(number) if number is not None else None
+            self._items.append(match.group(3).strip())
+        elif self._kind == LIST and line[:1].isspace():
+            # Indented lines continue the last item
+            self._items[-1] += ' ' + stripped
+        else:
+            # Indented text, like code without fences, isn't merged with the text around it
+            indented = line.startswith(('    ', '\t'))
+            if self._kind == LIST or (self._kind == PARAGRAPH and indented != self._indented):
+                self._flush(segments)
+            if self._kind is None:
+                self._indented = indented
+            self._kind = PARAGRAPH
+            self._lines.append(line)
+
+
+def parse(text):
+    """
+    Split a complete message into segments.
+
+    Args:
+        text (str): The message.
+
+    Returns:
+        list[Segment]: The segments of the message.
+    """
+    parser = MarkdownParser()
+    segments = parser.feed(text)
+    segments.extend(parser.close())
+    return segments
+
+
+def spans_html(spans):
+    """Rich text for inline spans, inline code is shown in a monospace font."""
+    parts = []
+    for kind, text in spans:
+        text = html.escape(text, quote=False).replace('\n', '<br>')
+        parts.append(f'<code>{text}</code>' if kind == INLINE_CODE else text)
+    return ''.join(parts)
+
+
+def to_html(segment):
+    """
+    Rich text for a paragraph or list, for showing in a QLabel.
+
+    Args:
+        segment (Segment): The segment.
+
+    Returns:
+        str: The html.
+    """
+    if segment.kind == LIST:
+        items = ''.join(f'<li>{spans_html(inline_spans(item))}</li>' for item in segment.items)
+        if segment.start is None:
+            return f'<ul>{items}</ul>'
+        if segment.start == 1:
+            return f'<ol>{items}</ol>'
+        # Qt ignores the start of an <ol>, steps after a code block keep their numbers in the text
+        items = ''.join(f'<li>{number}. {spans_html(inline_spans(item))}</li>'
+                        for number, item in enumerate(segment.items, segment.start))
+        return f'<ol start="{segment.start}" style="list-style-type: none;">{items}</ol>'
+    if segment.kind == CODE:
+        return f'<pre>{html.escape(segment.text, quote=False)}</pre>'
+    return spans_html(segment.spans)
@@ -0,0 +1,217 @@
+"""menu.py
+The ChatGPT menu in Maya.
+
+Only lightweight modules are imported here so loading the plugin stays fast. openai,
+PySide2 and the windows are imported the first time they are needed, or prefetched in
+the background after the menu is created.
+"""
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+
+import maya.utils
+from maya import cmds
+
+from chatgpt4maya import config, helpers
+from chatgpt4maya.config import Config, MENU
+
+logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
+
+# Heavy modules in the order they are loaded, so each import time only counts that module
+APP_MODULES = ['chatgpt4maya.clients',
+               'chatgpt4maya.chatgpt',
+               'PySide2.QtWidgets',
+               'chatgpt4maya.styles',
+               'chatgpt4maya.syntax',
+               'chatgpt4maya.app']
+
+# Modules that can be imported off the main thread, they don't touch Qt or Maya
+BACKGROUND_MODULES = ['chatgpt4maya.clients', 'chatgpt4maya.chatgpt']
+
+# Seconds it took to import each module, filled in as they are loaded
+IMPORT_TIMES = {}
+_import_lock = threading.Lock()
+
+# Whether the import times were logged, they're logged once when the app is first loaded
+_reported = False
+
+
+def timed_import(name):
+    """
+    Import a module and record how long it took.
+
+    Args:
+        name (str): The full name of the module.
+
+    Returns:
+        module: The imported module.
+    """
+    # Modules are in sys.modules before they finish loading, so only trust it inside the
+    # lock, after any import on the other thread is done
+    with _import_lock:
+        if name in sys.modules:
+            return sys.modules[name]
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        if name not in IMPORT_TIMES:
+            IMPORT_TIMES[name] = time.perf_counter() - start
+            logging.info(f'Imported {name} in {IMPORT_TIMES[name] * 1000:.0f} ms')
+    return module
+
+
+def import_report():
+    """
+    Log and return how long the heavy modules took to import.
+
+    Returns:
+        dict: Seconds per module, in the order they were imported.
+    """
+    total = sum(IMPORT_TIMES.values())
+    lines = [f'  {name:24} {seconds * 1000:8.0f} ms' for name, seconds in IMPORT_TIMES.items()]
+    logging.info('Import times:\n' + '\n'.join(lines) + f'\n  {"total":24} {total * 1000:8.0f} ms')
+    return dict(IMPORT_TIMES)
+
+
+def load_app():
+    """
+    Import the chat windows and everything they depend on.
+
+    How long the imports took is logged the first time.
+
+    Returns:
+        module: The chatgpt4maya.app module.
+    """
+    global _reported
+    for name in APP_MODULES:
+        timed_import(name)
+    if not _reported:
+        _reported = True
+        import_report()
+    return sys.modules['chatgpt4maya.app']
+
+
+def prefetch():
+    """
+    Load the heavy modules before they are needed.
+
+    openai and the api client are imported on a background thread, and connections to
+    the api are warmed up. The Qt modules are imported when Maya is idle on the main thread.
+
+    Returns:
+        threading.Thread: The thread doing the background imports.
+    """
+
+    def run():
+        try:
+            for name in BACKGROUND_MODULES:
+                timed_import(name)
+
+            # Open connections to the api while the artist gets to the menu
+            settings = Config()
+            api_key = settings.get('OpenAI', 'OpenAIApiKey', os.getenv('OPENAI_API_KEY'))
+            if api_key:
+                sys.modules['chatgpt4maya.clients'].warm_up(api_key,
+                                                            settings.get('OpenAI', 'OpenAIBaseUrl') or
+                                                            os.getenv('OPENAI_BASE_URL'))
+        except Exception as e:
+            logging.error(f'Could not prefetch ChatGPT modules: {e}')
+            return
+
+        # Maya commands can't be called from this thread
+        maya.utils.executeDeferred(load_app)
+
+    thread = threading.Thread(target=run, name='ChatGPTPrefetch', daemon=True)
+    thread.start()
+    return thread
+
+
+def delete_menu(menu_id):
+    """
+    Delete a menu
+
+    Args:
+        menu_id (str): The ID of the menu to be deleted.
+    """
+    if cmds.menu(menu_id, exists=True):  # Check if the menu exists
+        cmds.deleteUI(menu_id)  # Delete the menu
+
+
+def create_menu(prefetch_modules=True):
+    """
+    Create a menu with options for the ChatGPT plugin.
+
+    Args:
+        prefetch_modules (bool, optional): Load the chat window in the background. Defaults to True.
+    """
+    # Delete menu if it already exists
+    delete_menu(MENU)
+
+    # Create menu
+    menu = cmds.menu(MENU,
+                     parent='MayaWindow',
+                     label='ChatGPT',
+                     tearOff=True)
+
+    # Add menu items
+    cmds.menuItem(parent=MENU,
+                  label='Open chat',
+                  # i=os.path.join(ICONS_PATH, 'reload.png'),
+                  enable=True,
+                  c=open_chat)
+    cmds.menuItem(optionBox=True, c=open_config)
+    # cmds.menuItem(parent=MENU,
+    #               label='Quick command',
+    #               # i=os.path.join(ICONS_PATH, 'reload.png'),
+    #               enable=False)
+    cmds.menuItem(parent=MENU,
+                  label='Get API key...',
+                  # i=os.path.join(ICONS_PATH, 'reload.png'),
+                  enable=True,
+                  c=open_api_key_url)
+
+    if prefetch_modules:
+        prefetch()
+
+
+def open_api_key_url(*args):
+    """
+    Opens a web browser to the OpenAI API key management page.
+    """
+    url = 'https://platform.openai.com/account/api-keys'  # URL of the API key management page
+    logging.info(f'Opening web browser to {url}')  # Log the URL that is being opened
+    helpers.open_url(url)  # Open the URL in the user's default web browser
+
+
+def open_chat(*args):
+    """
+    Opens the ChatGPT chat window, loading it first if needed.
+
+    Returns:
+        ui (ChatWindow): The ChatWindow instance.
+    """
+    return load_app().open_chat()
+
+
+def open_config(*args):
+    """
+    Opens the ChatGPT configuration window, loading it first if needed.
+
+    Returns:
+        ui (ConfigWindow): The ConfigWindow instance.
+    """
+    return load_app().open_config()
+
+
+def shutdown():
+    """Stop the background services that were started, without importing anything new."""
+    for name in ['chatgpt4maya.workers',
+                 'chatgpt4maya.codeview',
+                 'chatgpt4maya.clients',
+                 'chatgpt4maya.engine',
+                 'chatgpt4maya.history']:
+        module = sys.modules.get(name)
+        if module:
+            module.shutdown()
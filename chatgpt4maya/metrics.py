@@ -0,0 +1,223 @@
+"""metrics.py
+Counters and histograms for the request lifecycle.
+
+Everything is recorded in REGISTRY, use snapshot() to read it from the UI, the logs or
+external tools.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+from chatgpt4maya import config
+
+logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
+
+
+class Counter:
+    """A number that only goes up."""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def increment(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """
+    Distribution of observed values.
+
+    Count, sum, min and max cover every observation, percentiles are computed from the
+    most recent observations.
+    """
+
+    def __init__(self, size=1024):
+        """
+        Args:
+            size (int, optional): Number of recent observations kept for percentiles. Defaults to 1024.
+        """
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._recent = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+            self._recent.append(value)
+
+    def percentile(self, percent):
+        """
+        Get a percentile of the recent observations.
+
+        Args:
+            percent (float): The percentile, between 0 and 100.
+
+        Returns:
+            float: The value, or None if nothing has been observed.
+        """
+        with self._lock:
+            ordered = sorted(self._recent)
+        if not ordered:
+            return None
+        index = max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered) + 0.5)) - 1))
+        return ordered[index]
+
+    def snapshot(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95)}
+
+
+class Registry:
+    """Named counters and histograms, created the first time they are used."""
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name):
+        with self._lock:
+            if name not in self._counters:
+                self._counters[name] = Counter()
+            return self._counters[name]
+
+    def histogram(self, name):
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram()
+            return self._histograms[name]
+
+    def snapshot(self):
+        """
+        Get the current value of everything that has been recorded.
+
+        Returns:
+            dict: Counter values and histogram summaries by name.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+        return {'counters': {name: counter.snapshot() for name, counter in counters.items()},
+                'histograms': {name: histogram.snapshot() for name, histogram in histograms.items()}}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+REGISTRY = Registry()
+
+
+def counter(name):
+    return REGISTRY.counter(name)
+
+
+def histogram(name):
+    return REGISTRY.histogram(name)
+
+
+def snapshot():
+    return REGISTRY.snapshot()
+
+
+class RequestTimer:
+    """
+    Times the phases of a single request.
+
+    Phases are marked as the request goes along, finish() records them in the registry:
+
+    - queue: waiting for the rate limiter until the request is first sent
+    - retry_wait: from the first attempt until the last one is sent, failed attempts,
+      backoff and rate limiting included, only recorded for requests that were retried
+    - connect: from sending the last attempt until the api starts answering
+    - first_token: from the start until the first content arrives
+    - total: from the start until the reply is complete
+    """
+
+    def __init__(self, registry=None):
+        self.registry = registry if registry else REGISTRY
+        self.start = time.perf_counter()
+        self.marks = {}
+        self.retries = 0
+
+    def mark(self, name):
+        """Mark that a phase ended now, marking it again overwrites it."""
+        self.marks[name] = time.perf_counter() - self.start
+
+    def mark_once(self, name):
+        """Mark that a phase ended now, unless it was already marked."""
+        if name not in self.marks:
+            self.mark(name)
+
+    def sent(self):
+        """Mark that an attempt of the request is being sent."""
+        self.mark_once('sent')
+        self.mark('attempt')
+
+    def retried(self):
+        """Count an attempt that failed and is retried."""
+        self.retries += 1
+
+    def finish(self, usage=None, error=False):
+        """
+        Record the request in the registry.
+
+        Args:
+            usage (dict, optional): The usage returned by the api. Defaults to None.
+            error (bool, optional): True if the request failed. Defaults to False.
+
+        Returns:
+            dict: Seconds spent in each phase and the token counts of the request.
+        """
+        self.mark_once('done')
+        sent = self.marks.get('sent', 0.0)
+        attempt = self.marks.get('attempt', sent)
+        result = {'queue': sent,
+                  'retry_wait': attempt - sent if self.retries else None,
+                  'connect': self.marks['connected'] - attempt if 'connected' in self.marks else None,
+                  'first_token': self.marks.get('first_token'),
+                  'total': self.marks['done'],
+                  'prompt_tokens': None,
+                  'completion_tokens': None,
+                  'retries': self.retries}
+
+        self.registry.counter('requests').increment()
+        if error:
+            self.registry.counter('errors').increment()
+            return result
+
+        for phase in ['queue', 'retry_wait', 'connect', 'first_token', 'total']:
+            if result[phase] is not None:
+                self.registry.histogram(f'request.{phase}_seconds').observe(result[phase])
+
+        if usage:
+            result['prompt_tokens'] = usage.get('prompt_tokens')
+            result['completion_tokens'] = usage.get('completion_tokens')
+            for key in ['prompt_tokens', 'completion_tokens']:
+                if result[key] is not None:
+                    self.registry.counter(f'tokens.{key}').increment(result[key])
+                    self.registry.histogram(f'request.{key}').observe(result[key])
+
+        first_token = f'{result["first_token"] * 1000:.0f} ms' if result['first_token'] is not None else '-'
+        retries = f'{self.retries} retries {result["retry_wait"] * 1000:.0f} ms, ' if self.retries else ''
+        logging.info(f'Request took {result["total"] * 1000:.0f} ms '
+                     f'(queue {result["queue"] * 1000:.0f} ms, {retries}first token {first_token}, '
+                     f'{result["prompt_tokens"]} prompt + {result["completion_tokens"]} completion tokens)')
+        return result
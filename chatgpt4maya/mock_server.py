@@ -0,0 +1,202 @@
+"""mock_server.py
+Local stand-in for the OpenAI chat completions api, for working and benchmarking offline.
+
+Run it with `python -m chatgpt4maya.mock_server` and set OpenAIBaseUrl in the config (or
+OPENAI_BASE_URL) to the url it prints.
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from chatgpt4maya import config, tokens
+
+logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
+
+MOCK_REPLY = ("Here's how to create a cube in Maya using MEL:\n"
+              '\n'
+              '```mel\n'
+              'polyCube -w 1 -h 1 -d 1;\n'
+              '```\n'
+              '\n'
+              "And here's how to create a cube in Maya using Python:\n"
+              '\n'
+              '```python\n'
+              'import maya.cmds as cmds\n'
+              '\n'
+              'cmds.polyCube(w=1, h=1, d=1)\n'
+              '```\n'
+              '\n'
+              'Both of these commands will create a cube with a width, height, and depth of 1 unit. '
+              'You can adjust the values to create a cube of any size.')
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Handles requests to the mock server, the settings are read from the server."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send_json(200, {'object': 'list',
+                                  'data': [{'id': 'gpt-3.5-turbo', 'object': 'model', 'owned_by': 'mock'}]})
+        else:
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+            return
+
+        server = self.server
+        time.sleep(server.latency)
+
+        # Inject errors the way the real api returns them
+        if server.error_rate and random.random() < server.error_rate:
+            status = server.error_status
+            headers = {'Retry-After': str(server.retry_after)} if status == 429 else {}
+            self._send_json(status, {'error': {'message': f'Injected {status} error',
+                                               'type': 'mock_error',
+                                               'code': None}}, headers)
+            return
+
+        reply = server.reply
+        words = reply.split(' ')
+        pieces = [word + ' ' for word in words[:-1]] + [words[-1]]
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        created = int(time.time())
+        model = request.get('model', 'gpt-3.5-turbo')
+        usage = {'prompt_tokens': sum(tokens.count_message_tokens(m) for m in request.get('messages', [])),
+                 'completion_tokens': tokens.count_tokens(reply)}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+
+        if not request.get('stream'):
+            # Pretend the whole reply was generated before answering
+            time.sleep(usage['completion_tokens'] / server.tokens_per_second)
+            self._send_json(200, {'id': completion_id,
+                                  'object': 'chat.completion',
+                                  'created': created,
+                                  'model': model,
+                                  'choices': [{'index': 0,
+                                               'finish_reason': 'stop',
+                                               'message': {'role': 'assistant', 'content': reply}}],
+                                  'usage': usage})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def send_chunk(choices, chunk_usage=None):
+            data = {'id': completion_id,
+                    'object': 'chat.completion.chunk',
+                    'created': created,
+                    'model': model,
+                    'choices': choices}
+            if chunk_usage:
+                data['usage'] = chunk_usage
+            self._write_event(f'data: {json.dumps(data)}\n\n')
+
+        send_chunk([{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])
+        for piece in pieces:
+            time.sleep(tokens.count_tokens(piece) / server.tokens_per_second)
+            send_chunk([{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}])
+        send_chunk([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+        if request.get('stream_options', {}).get('include_usage'):
+            send_chunk([], usage)
+        self._write_event('data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _write_event(self, event):
+        data = event.encode('utf-8')
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+
+class MockServer(ThreadingHTTPServer):
+    """
+    OpenAI compatible chat completions server with configurable speed and errors.
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.2, tokens_per_second=100.0, error_rate=0.0,
+                 error_status=429, retry_after=1, reply=MOCK_REPLY):
+        """
+        Args:
+            host (str, optional): Host to listen on. Defaults to '127.0.0.1'.
+            port (int, optional): Port to listen on, 0 picks a free port. Defaults to 0.
+            latency (float, optional): Seconds before the first byte of a reply. Defaults to 0.2.
+            tokens_per_second (float, optional): Speed the reply is generated at. Defaults to 100.
+            error_rate (float, optional): Fraction of requests that fail. Defaults to 0.
+            error_status (int, optional): Http status of failed requests. Defaults to 429.
+            retry_after (float, optional): Retry-After header of 429 errors. Defaults to 1.
+            reply (str, optional): Content of every reply. Defaults to MOCK_REPLY.
+        """
+        super().__init__((host, port), MockHandler)
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.reply = reply
+        self._thread = None
+
+    @property
+    def url(self):
+        """The base url to give the client."""
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def start(self):
+        """Serve on a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, name='ChatGPTMockServer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the OpenAI chat completions api.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds before the first byte')
+    parser.add_argument('--tokens-per-second', type=float, default=100.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=429)
+    parser.add_argument('--retry-after', type=float, default=1)
+    args = parser.parse_args()
+
+    server = MockServer(args.host, args.port, args.latency, args.tokens_per_second, args.error_rate,
+                        args.error_status, args.retry_after)
+    logging.info(f'Mock server listening on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -127,6 +127,11 @@ QLabel#logotype{{
     width: 100%;
     text-align: center;
 }}
+QLabel#token-count{{
+    background: none;
+    color: {Color.light_gray};
+    font-size: 14px;
+}}
 
 ChatBubble {{
     padding: {Margin.xsmall}px {Margin.medium}px;
@@ -187,11 +192,31 @@ QLabel[selector='code'] {{
     font-weight: {FONT['code'].weight};
 }}
 
+QLabel[selector='status'] {{
+    color: {Color.mint};
+    font-size: 14px;
+}}
+QLabel[selector='status'][success='false'] {{
+    color: {Color.code_pink};
+}}
+QLabel[selector='profile'] {{
+    font-family: {FONT['code'].family};
+    color: {Color.code_comments};
+    font-size: 12px;
+}}
+
 QFrame[selector='code'] {{
     font-family: {FONT['code'].family};
     font-weight: {FONT['code'].weight};
     background: {Color.dark_gray};
 }}
+QPlainTextEdit[selector='code'] {{
+    font-family: {FONT['code'].family};
+    font-weight: {FONT['code'].weight};
+    color: {Color.code_white};
+    background: {Color.dark_gray};
+    border: none;
+}}
 
 QLineEdit {{
     background: rgba(0,0,0,0);
@@ -249,16 +274,40 @@ Button#button-save[selector='changed']:hover {{
 }}
 
 
+Button#button-preview {{
+    background: {Color.primary};
+}}
+Button#button-preview:hover {{
+    background: {rgb_to_hex(multiply(Color.primary, 1.1))};
+}}
+Button#button-profile {{
+    background: {Color.light_gray};
+}}
+Button#button-profile:hover {{
+    background: {rgb_to_hex(multiply(Color.light_gray, 1.1))};
+}}
 Button#button-copy {{
     background: {Color.light_gray};
 }}
 Button#button-copy:hover {{
     background: {rgb_to_hex(multiply(Color.light_gray, 1.1))};
 }}
+QPushButton#button-expand {{
+    background: none;
+    color: {Color.light_gray};
+    font-size: 14px;
+}}
+QPushButton#button-expand:hover {{
+    color: {Color.almost_white};
+}}
 
 QScrollArea{{
     padding: 0 {Margin.large}px;
 }}
+QListView#conversation-view{{
+    padding: {Margin.small}px {Margin.large}px 0;
+    border: none;
+}}
 
 QScrollBar:vertical {{
     border: none;
@@ -0,0 +1,129 @@
+"""summary.py
+Background summarization of older turns in a conversation.
+"""
+import logging
+import threading
+
+from chatgpt4maya import config, tokens
+
+logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
+
+SUMMARY_PROMPT = ('You keep a running summary of a conversation between a user and an assistant helping '
+                  'with Autodesk Maya. Update the summary with the new messages. Keep names of nodes, '
+                  'attributes, files and any decisions or code the user relies on. Reply with the summary only.')
+
+# Summaries don't need the chat model, a cheaper and faster one is used
+SUMMARY_MODEL = 'gpt-4o-mini'
+
+
+class Summarizer:
+    """
+    Folds older user/assistant turns into a running summary.
+
+    Summarizing happens on a background thread with a cheaper model, and only the messages
+    that were added since the last update are sent, together with the previous summary.
+    """
+
+    def __init__(self, client, model=SUMMARY_MODEL, threshold=3000, keep_messages=6, max_tokens=512,
+                 scheduler=None):
+        """
+        Args:
+            client (openai.OpenAI): The client used to create the summary.
+            model (str, optional): The model used to create the summary. Defaults to SUMMARY_MODEL.
+            threshold (int, optional): Summarize when the messages that could be folded use more
+                tokens than this. Defaults to 3000.
+            keep_messages (int, optional): Number of newest messages that are never folded. Defaults to 6.
+            max_tokens (int, optional): Max length of the summary. Defaults to 512.
+            scheduler (chatgpt.RequestScheduler, optional): Rate limits and retries the summary
+                requests. Defaults to None.
+        """
+        self.client = client
+        self.model = model
+        self.threshold = threshold
+        self.keep_messages = keep_messages
+        self.max_tokens = max_tokens
+        self.scheduler = scheduler
+        self.summary = ''
+        self.summarized = 0
+        self._generation = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        """
+        Get the current summary and how many messages it covers.
+
+        Returns:
+            tuple[str, int]: The summary and the number of messages folded into it.
+        """
+        with self._lock:
+            return self.summary, self.summarized
+
+    def update(self, messages):
+        """
+        Start summarizing in the background if enough messages have piled up.
+
+        Args:
+            messages (list[dict]): The messages in the conversation, without the system message.
+        """
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+
+            end = len(messages) - self.keep_messages
+            # Always stop after a reply, a user message without one (a failed request) is kept
+            # with the message that follows it
+            while end > self.summarized and messages[end - 1]['role'] != 'assistant':
+                end -= 1
+            if end <= self.summarized:
+                return
+            new_messages = messages[self.summarized:end]
+            if not new_messages:
+                return
+            if sum(tokens.count_message_tokens(message) for message in new_messages) < self.threshold:
+                return
+
+            self._thread = threading.Thread(target=self._summarize,
+                                            args=(self.summary, new_messages, end, self._generation),
+                                            name='ChatGPTSummarizer',
+                                            daemon=True)
+            self._thread.start()
+
+    def _summarize(self, summary, new_messages, end, generation):
+        transcript = '\n\n'.join(f'{message["role"]}: {message["content"]}' for message in new_messages)
+        content = f'Summary so far:\n{summary or "(empty)"}\n\nNew messages:\n{transcript}'
+        messages = [{'role': 'system', 'content': SUMMARY_PROMPT},
+                    {'role': 'user', 'content': content}]
+
+        def create():
+            return self.client.chat.completions.create(model=self.model,
+                                                       messages=messages,
+                                                       temperature=0,
+                                                       max_tokens=self.max_tokens)
+
+        try:
+            if self.scheduler:
+                token_count = sum(tokens.count_message_tokens(message) for message in messages) + self.max_tokens
+                response = self.scheduler.call(create, token_count=token_count)
+            else:
+                response = create()
+            new_summary = response.choices[0].message.content.strip()
+        except Exception as e:
+            logging.error(f'Could not summarize conversation: {e}')
+            return
+
+        with self._lock:
+            # The conversation was reset while summarizing
+            if generation != self._generation:
+                return
+            self.summary = new_summary
+            self.summarized = end
+        logging.info(f'Summarized {len(new_messages)} messages')
+
+    def reset(self):
+        """Forget the summary, any summary being created is discarded."""
+        with self._lock:
+            self._generation += 1
+            self.summary = ''
+            self.summarized = 0
+            self._thread = None
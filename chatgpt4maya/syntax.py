@@ -1,15 +1,27 @@
-"""This code is courtesy of the Python Wiki.
-    From author: "I have placed this code under the Modified BSD License because
-    I believe the author intended it to be freely used.
-    However, I don't believe that I originally wrote this example,
-    though I was responsible for migrating it to the Python Wiki.
-    -- DavidBoddie 2017-01-19 20:34:17 "
+"""syntax.py
+Styled ranges for the code blocks in replies.
+
+PythonLexer and MelLexer split code into (start, length, style) ranges line by line with a
+single precompiled regular expression each, shared by every code block. They're pure
+Python, so codeview.CodeView runs them on a worker thread. RangeCache keeps the ranges by
+content, so code that was shown before isn't tokenized again.
+
+format() and STYLES are adapted from the Python Wiki highlighting example, under the
+Modified BSD License.
 Source https://wiki.python.org/moin/PyQt/Python%20syntax%20highlighting
 License https://directory.fsf.org/wiki/License:BSD-3-Clause
 """
 
+import functools
+import hashlib
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+from chatgpt4maya import metrics
 from chatgpt4maya.styles import hex_to_rgb, Color
-from PySide2 import QtCore, QtGui
+from PySide2 import QtGui
 
 
 def format(color, style=''):
@@ -40,168 +52,380 @@ STYLES = {
     'comment': format(color=Color.code_comments, style='italic'),
     'self': format(color=Color.code_pink, style='italic'),
     'numbers': format(color=Color.code_purple),
-    'function': format(color=Color.code_green)
+    'function': format(color=Color.code_green),
+    'variable': format(color=Color.code_orange),
+    'flag': format(color=Color.code_yellow, style='italic')
 }
 
+# Languages, the same as in execution
+PYTHON = 'python'
+MEL = 'mel'
+
+# Commands highlighted in MEL when maya.cmds isn't available
+MEL_COMMANDS = [
+    'addAttr', 'aimConstraint', 'button', 'catch', 'clamp', 'columnLayout', 'connectAttr', 'createNode',
+    'curve', 'delete', 'deleteUI', 'duplicate', 'error', 'eval', 'exists', 'file', 'filterExpand',
+    'floatField', 'getAttr', 'group', 'joint', 'keyframe', 'listAttr', 'listConnections', 'listRelatives',
+    'ls', 'makeIdentity', 'nodeType', 'objExists', 'orientConstraint', 'parent', 'parentConstraint',
+    'playbackOptions', 'pointConstraint', 'polyCube', 'polyCylinder', 'polyPlane', 'polySphere', 'print',
+    'refresh', 'rename', 'rotate', 'scale', 'select', 'setAttr', 'setKeyframe', 'showWindow', 'size',
+    'source', 'spaceLocator', 'textField', 'tokenize', 'undoInfo', 'warning', 'window', 'xform',
+]
+
+
+class Lexer:
+    """
+    Splits code into styled ranges, line by line, with a single regular expression.
 
-class PythonHighlighter(QtGui.QSyntaxHighlighter):
-    """Syntax highlighter for the Python language.
+    The lexers are pure Python, so code can be tokenized on a worker thread and the
+    ranges applied on the main thread. Ranges are (start, length, style) tuples, where
+    style is a key of STYLES. The state carried from one line to the next is 0 outside
+    of multi-line strings.
     """
-    # Python keywords
-    keywords = [
-        'and', 'assert', 'break', 'class', 'continue', 'def',
+    # A named group per kind of token, the group names are styles except 'name', which
+    # are identifiers looked up in the keywords
+    pattern = re.compile(r'(?P<name>[A-Za-z_]\w*)')
+    keywords = frozenset()
+    language = 'text'
+
+    def tokenize_line(self, line, state=0):
+        """
+        Get the styled ranges of a line.
+
+        Args:
+            line (str): The line, without the line break.
+            state (int, optional): The state at the end of the previous line. Defaults to 0.
+
+        Returns:
+            tuple[list[tuple[int, int, str]], int]: The ranges and the state at the end of the line.
+        """
+        ranges = []
+        for match in self.pattern.finditer(line):
+            style = match.lastgroup
+            if style == 'name':
+                if match.group() in self.keywords:
+                    ranges.append((match.start(), match.end() - match.start(), 'keyword'))
+            else:
+                ranges.append((match.start(), match.end() - match.start(), style))
+        return ranges, 0
+
+    def tokenize(self, code):
+        """
+        Get the styled ranges of every line.
+
+        Args:
+            code (str): The code.
+
+        Returns:
+            list[list[tuple[int, int, str]]]: The ranges of each line.
+        """
+        return self.tokenize_states(code)[0]
+
+    def tokenize_states(self, code):
+        """
+        Get the styled ranges of every line and the state at the end of each line.
+
+        Args:
+            code (str): The code.
+
+        Returns:
+            tuple[list[list[tuple[int, int, str]]], list[int]]: The ranges and the state of each line.
+        """
+        lines = []
+        states = []
+        state = 0
+        for line in code.split('\n'):
+            ranges, state = self.tokenize_line(line, state)
+            lines.append(ranges)
+            states.append(state)
+        return lines, states
+
+
+class PythonLexer(Lexer):
+    """Lexer for Python."""
+    keywords = frozenset([
+        'and', 'as', 'assert', 'async', 'await', 'break', 'class', 'continue', 'def',
         'del', 'elif', 'else', 'except', 'exec', 'finally',
         'for', 'from', 'global', 'if', 'import', 'in',
-        'is', 'lambda', 'not', 'or', 'pass', 'print',
-        'raise', 'return', 'try', 'while', 'yield',
+        'is', 'lambda', 'nonlocal', 'not', 'or', 'pass', 'print',
+        'raise', 'return', 'try', 'while', 'with', 'yield',
         'None', 'True', 'False',
-    ]
-
-    # Python operators
-    operators = [
-        '=',
-        # Comparison
-        '==', '!=', '<', '<=', '>', '>=',
-        # Arithmetic
-        '\+', '-', '\*', '/', '//', '\%', '\*\*',
-        # In-place
-        '\+=', '-=', '\*=', '/=', '\%=',
-        # Bitwise
-        '\^', '\|', '\&', '\~', '>>', '<<',
-    ]
-
-    # Python braces
-    braces = [
-        '\{', '\}', '\(', '\)', '\[', '\]',
-    ]
-
-    def __init__(self, parent: QtGui.QTextDocument) -> None:
-        super().__init__(parent)
-
-        # Multi-line strings (expression, flag, style)
-        self.tri_single = (QtCore.QRegExp("'''"), 1, STYLES['string2'])
-        self.tri_double = (QtCore.QRegExp('"""'), 2, STYLES['string2'])
-
-        rules = []
-
-        # Keyword, operator, and brace rules
-        rules += [(r'\b%s\b' % w, 0, STYLES['keyword'])
-                  for w in PythonHighlighter.keywords]
-        rules += [(r'%s' % o, 0, STYLES['operator'])
-                  for o in PythonHighlighter.operators]
-        rules += [(r'%s' % b, 0, STYLES['brace'])
-                  for b in PythonHighlighter.braces]
-
-        # All other rules
-        rules += [
-            # 'self'
-            (r'\bself\b', 0, STYLES['self']),
-
-            # 'def' followed by an identifier
-            (r'\bdef\b\s*(\w+)', 1, STYLES['defclass']),
-            # 'class' followed by an identifier
-            (r'\bclass\b\s*(\w+)', 1, STYLES['defclass']),
-
-            # Numeric literals
-            (r'\b[+-]?[0-9]+[lL]?\b', 0, STYLES['numbers']),
-            (r'\b[+-]?0[xX][0-9A-Fa-f]+[lL]?\b', 0, STYLES['numbers']),
-            (r'\b[+-]?[0-9]+(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?\b', 0, STYLES['numbers']),
-
-            # Double-quoted string, possibly containing escape sequences
-            (r'"[^"\\]*(\\.[^"\\]*)*"', 0, STYLES['string']),
-            # Single-quoted string, possibly containing escape sequences
-            (r"'[^'\\]*(\\.[^'\\]*)*'", 0, STYLES['string']),
-
-            # From '#' until a newline
-            (r'#[^\n]*', 0, STYLES['comment']),
-
-            # Functions
-            (r'\b[a-z][a-zA-Z]*\b(?=\()', 0, STYLES['function'])
-        ]
-
-        # Build a QRegExp for each pattern
-        self.rules = [(QtCore.QRegExp(pat), index, fmt)
-                      for (pat, index, fmt) in rules]
-
-    def highlightBlock(self, text):
-        """Apply syntax highlighting to the given block of text.
+    ])
+    language = PYTHON
+
+    pattern = re.compile(r'''
+        (?P<comment>\#.*)
+        |(?P<string2>\'\'\'|""")
+        |(?P<string>"[^"\\]*(?:\\.[^"\\]*)*"|'[^'\\]*(?:\\.[^'\\]*)*')
+        |(?P<numbers>\b(?:0[xX][0-9A-Fa-f]+|[0-9]+(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?)[lLjJ]?\b)
+        |(?P<name>[A-Za-z_]\w*)
+        |(?P<operator>\*\*=?|//=?|>>=?|<<=?|[=!<>]=?|[-+*/%^|&~]=?)
+        |(?P<brace>[{}()\[\]])
+        ''', re.VERBOSE)
+
+    # States inside multi-line strings
+    TRIPLE_STATES = {"'''": 1, '"""': 2}
+    TRIPLE_QUOTES = {1: "'''", 2: '"""'}
+
+    def tokenize_line(self, line, state=0):
+        ranges = []
+        position = 0
+        if state:
+            # Inside a multi-line string from the start of the line
+            end = line.find(self.TRIPLE_QUOTES[state])
+            if end < 0:
+                return ([(0, len(line), 'string2')] if line else []), state
+            position = end + 3
+            ranges.append((0, position, 'string2'))
+            state = 0
+
+        after_def = False
+        length = len(line)
+        match = self.pattern.search(line, position)
+        while match:
+            style = match.lastgroup
+            start, end = match.span()
+            if style == 'name':
+                word = match.group()
+                if after_def:
+                    ranges.append((start, end - start, 'defclass'))
+                elif word in self.keywords:
+                    ranges.append((start, end - start, 'keyword'))
+                elif word == 'self':
+                    ranges.append((start, end - start, 'self'))
+                elif end < length and line[end] == '(':
+                    ranges.append((start, end - start, 'function'))
+                after_def = word in ('def', 'class')
+            elif style == 'string2':
+                close = line.find(match.group(), end)
+                if close < 0:
+                    ranges.append((start, length - start, 'string2'))
+                    return ranges, self.TRIPLE_STATES[match.group()]
+                end = close + 3
+                ranges.append((start, end - start, 'string2'))
+                after_def = False
+            else:
+                ranges.append((start, end - start, style))
+                after_def = False
+            match = self.pattern.search(line, end)
+        return ranges, state
+
+
+@functools.lru_cache(maxsize=1)
+def mel_commands():
+    """
+    Get the names of the Maya commands, looked up once.
+
+    Returns:
+        frozenset[str]: The commands in maya.cmds, or MEL_COMMANDS outside of Maya.
+    """
+    try:
+        from maya import cmds
+        commands = frozenset(name for name in dir(cmds) if not name.startswith('_'))
+    except ImportError:
+        commands = frozenset()
+    return commands or frozenset(MEL_COMMANDS)
+
+
+class MelLexer(Lexer):
+    """
+    Lexer for MEL, codeview.CodeView highlights MEL code blocks with it, see lexer_for().
+
+    Maya commands are looked up in mel_commands().
+    """
+    keywords = frozenset([
+        'break', 'case', 'continue', 'default', 'do', 'else', 'false', 'float', 'for', 'global',
+        'if', 'in', 'int', 'matrix', 'no', 'off', 'on', 'proc', 'return', 'string', 'switch',
+        'true', 'vector', 'while', 'yes',
+    ])
+    language = MEL
+
+    # Keywords that can come between proc and the name of the procedure
+    PROC_PREFIXES = frozenset(['global', 'proc', 'float', 'int', 'matrix', 'string', 'vector'])
+
+    pattern = re.compile(r'''
+        (?P<comment>//.*)
+        |(?P<comment_block>/\*)
+        |(?P<string>"[^"\\]*(?:\\.[^"\\]*)*")
+        |(?P<variable>\$[A-Za-z_]\w*)
+        |(?P<flag>(?<![\w)\]])-[A-Za-z]\w*)
+        |(?P<numbers>\b(?:0[xX][0-9A-Fa-f]+|[0-9]+(?:\.[0-9]*)?(?:[eE][+-]?[0-9]+)?)\b)
+        |(?P<name>[A-Za-z_]\w*)
+        |(?P<operator>\+\+|--|&&|\|\||[=!<>]=?|[-+*/%^]=?)
+        |(?P<brace>[{}()\[\]`])
+        ''', re.VERBOSE)
+
+    # State inside a /* */ comment
+    COMMENT_STATE = 1
+
+    def tokenize_line(self, line, state=0):
+        ranges = []
+        position = 0
+        if state == self.COMMENT_STATE:
+            end = line.find('*/')
+            if end < 0:
+                return ([(0, len(line), 'comment')] if line else []), state
+            position = end + 2
+            ranges.append((0, position, 'comment'))
+            state = 0
+
+        commands = mel_commands()
+        after_proc = False
+        length = len(line)
+        match = self.pattern.search(line, position)
+        while match:
+            style = match.lastgroup
+            start, end = match.span()
+            if style == 'name':
+                word = match.group()
+                if after_proc and word not in self.PROC_PREFIXES:
+                    ranges.append((start, end - start, 'defclass'))
+                    after_proc = False
+                elif word in self.keywords:
+                    ranges.append((start, end - start, 'keyword'))
+                    after_proc = after_proc or word == 'proc'
+                elif word in commands or (end < length and line[end] == '('):
+                    ranges.append((start, end - start, 'function'))
+            elif style == 'comment_block':
+                close = line.find('*/', end)
+                if close < 0:
+                    ranges.append((start, length - start, 'comment'))
+                    return ranges, self.COMMENT_STATE
+                end = close + 2
+                ranges.append((start, end - start, 'comment'))
+            else:
+                ranges.append((start, end - start, style))
+                # The return type of a procedure can be an array
+                after_proc = after_proc and match.group() in '[]'
+            match = self.pattern.search(line, end)
+        return ranges, state
+
+
+_lexers = {PYTHON: PythonLexer(), MEL: MelLexer()}
+
+
+def lexer_for(language=None):
+    """
+    Get the lexer for a language, lexers don't keep any state and are shared.
+
+    Args:
+        language (str, optional): PYTHON or MEL, see execution.detect_language. Defaults to PYTHON.
+
+    Returns:
+        Lexer: The lexer.
+    """
+    return _lexers.get(language, _lexers[PYTHON])
+
+
+# Bytes of format ranges kept in memory
+RANGE_CACHE_SIZE = 8 * 1024 * 1024
+
+# Size of one range, the style names and most of the ints in them are shared
+_RANGE_SIZE = sys.getsizeof((0, 0, 'keyword'))
+
+
+def range_key(code, language):
+    """
+    Create a cache key for tokenized code.
+
+    Args:
+        code (str): The code.
+        language (str): The language it is tokenized as.
+
+    Returns:
+        bytes: A sha1 digest of the language and code.
+    """
+    return hashlib.sha1(f'{language}\0{code}'.encode('utf-8')).digest()
+
+
+def _tokens_size(tokens):
+    """Rough number of bytes taken by the ranges and states of tokenized code."""
+    lines, states = tokens
+    size = sys.getsizeof(lines) + sys.getsizeof(states)
+    for ranges in lines:
+        size += sys.getsizeof(ranges) + len(ranges) * _RANGE_SIZE
+    return size
+
+
+class RangeCache:
+    """
+    Styled ranges of code that was tokenized before, by content.
+
+    The same code is only tokenized once, however many code blocks show it and however
+    often the conversation is rebuilt. The least recently used entries are evicted when
+    they take more than max_bytes. Safe to use from the tokenizer thread.
+    """
+
+    def __init__(self, max_bytes=RANGE_CACHE_SIZE):
         """
-        self.tripleQuoutesWithinStrings = []
-        # Do other syntax formatting
-        for expression, nth, format in self.rules:
-            index = expression.indexIn(text, 0)
-            if index >= 0:
-                # if there is a string we check
-                # if there are some triple quotes within the string
-                # they will be ignored if they are matched again
-                if expression.pattern() in [r'"[^"\\]*(\\.[^"\\]*)*"', r"'[^'\\]*(\\.[^'\\]*)*'"]:
-                    innerIndex = self.tri_single[0].indexIn(text, index + 1)
-                    if innerIndex == -1:
-                        innerIndex = self.tri_double[0].indexIn(text, index + 1)
-
-                    if innerIndex != -1:
-                        tripleQuoteIndexes = range(innerIndex, innerIndex + 3)
-                        self.tripleQuoutesWithinStrings.extend(tripleQuoteIndexes)
-
-            while index >= 0:
-                # skipping triple quotes within strings
-                if index in self.tripleQuoutesWithinStrings:
-                    index += 1
-                    expression.indexIn(text, index)
-                    continue
-
-                # We actually want the index of the nth match
-                index = expression.pos(nth)
-                length = len(expression.cap(nth))
-                self.setFormat(index, length, format)
-                index = expression.indexIn(text, index + length)
-
-        self.setCurrentBlockState(0)
-
-        # Do multi-line strings
-        in_multiline = self.match_multiline(text, *self.tri_single)
-        if not in_multiline:
-            in_multiline = self.match_multiline(text, *self.tri_double)
-
-    def match_multiline(self, text, delimiter, in_state, style):
-        """Do highlighting of multi-line strings. ``delimiter`` should be a
-        ``QRegExp`` for triple-single-quotes or triple-double-quotes, and
-        ``in_state`` should be a unique integer to represent the corresponding
-        state changes when inside those strings. Returns True if we're still
-        inside a multi-line string when this function is finished.
+        Args:
+            max_bytes (int, optional): Max size of the cached ranges. Defaults to RANGE_CACHE_SIZE.
         """
-        # If inside triple-single quotes, start at 0
-        if self.previousBlockState() == in_state:
-            start = 0
-            add = 0
-        # Otherwise, look for the delimiter on this line
-        else:
-            start = delimiter.indexIn(text)
-            # skipping triple quotes within strings
-            if start in self.tripleQuoutesWithinStrings:
-                return False
-            # Move past this match
-            add = delimiter.matchedLength()
-
-        # As long as there's a delimiter match on this line...
-        while start >= 0:
-            # Look for the ending delimiter
-            end = delimiter.indexIn(text, start + add)
-            # Ending delimiter on this line?
-            if end >= add:
-                length = end - start + add + delimiter.matchedLength()
-                self.setCurrentBlockState(0)
-            # No; multi-line string
-            else:
-                self.setCurrentBlockState(in_state)
-                length = len(text) - start + add
-            # Apply formatting
-            self.setFormat(start, length, style)
-            # Look for the next match
-            start = delimiter.indexIn(text, start + length)
-
-        # Return True if still inside a multi-line string, False otherwise
-        if self.currentBlockState() == in_state:
-            return True
-        else:
-            return False
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, code, lexer):
+        """
+        Get the styled ranges and states of every line, if the code is cached.
+
+        The result is shared, it must not be changed.
+
+        Args:
+            code (str): The code.
+            lexer (Lexer): The lexer the code is tokenized with.
+
+        Returns:
+            tuple[list[list[tuple[int, int, str]]], list[int]]: The ranges and the state of each
+                line, or None if the code isn't cached.
+        """
+        key = range_key(code, lexer.language)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+        metrics.counter('syntax.cache_hits').increment()
+        return entry[0]
+
+    def tokenize(self, code, lexer):
+        """
+        Get the styled ranges and states of every line, tokenizing the code if it isn't cached.
+
+        Args:
+            code (str): The code.
+            lexer (Lexer): The lexer to tokenize it with.
+
+        Returns:
+            tuple[list[list[tuple[int, int, str]]], list[int]]: The ranges and the state of each line.
+        """
+        tokens = self.get(code, lexer)
+        if tokens is not None:
+            return tokens
+
+        metrics.counter('syntax.cache_misses').increment()
+        tokens = lexer.tokenize_states(code)
+        size = _tokens_size(tokens)
+        key = range_key(code, lexer.language)
+        with self._lock:
+            if key not in self._entries and size <= self.max_bytes:
+                self._entries[key] = (tokens, size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    _, (_, evicted_size) = self._entries.popitem(last=False)
+                    self.size -= evicted_size
+        return tokens
+
+    def clear(self):
+        """Remove all cached ranges."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+RANGE_CACHE = RangeCache()
+
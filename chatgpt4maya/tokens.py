@@ -0,0 +1,130 @@
+"""tokens.py
+Local token counting and context window management.
+"""
+import functools
+import logging
+import re
+
+from chatgpt4maya import config
+
+logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
+
+# Use tiktoken for exact counts if it's installed next to openai
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding('cl100k_base')
+except Exception:
+    tiktoken = None
+    _encoding = None
+
+# Tokens the api adds around every message and to prime the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+# Rough approximation of the BPE tokenizer, words and single punctuation characters
+_TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text):
+    """
+    Count the tokens in a string.
+
+    Uses tiktoken if available, otherwise an approximation that's close enough for
+    budgeting.
+
+    Args:
+        text (str): The text to count.
+
+    Returns:
+        int: The number of tokens.
+    """
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(_TOKEN_PATTERN.findall(text))
+
+
+@functools.lru_cache(maxsize=4096)
+def _count_message_tokens(role, content):
+    return TOKENS_PER_MESSAGE + count_tokens(role) + count_tokens(content)
+
+
+def count_message_tokens(message):
+    """
+    Count the tokens a message uses, including the per message overhead.
+
+    Args:
+        message (dict): A message with role and content.
+
+    Returns:
+        int: The number of tokens.
+    """
+    return _count_message_tokens(message['role'], message['content'])
+
+
+class ContextWindow:
+    """
+    Keeps the messages sent to the api within a token budget.
+
+    The first message is kept if it's a system message, after that as many of the
+    newest messages as fit are kept.
+    """
+
+    def __init__(self, budget=8192):
+        """
+        Args:
+            budget (int, optional): Max number of tokens to send. Defaults to 8192.
+        """
+        self.budget = budget
+        self.total_tokens = 0
+        self.sent_tokens = 0
+        self.trimmed_messages = 0
+
+    def fit(self, messages):
+        """
+        Trim the messages to fit the budget.
+
+        Args:
+            messages (list[dict]): All messages in the conversation.
+
+        Returns:
+            list[dict]: The messages to send.
+        """
+        counts = [count_message_tokens(message) for message in messages]
+        self.total_tokens = sum(counts) + TOKENS_PER_REPLY
+
+        head = []
+        used = TOKENS_PER_REPLY
+        if messages and messages[0]['role'] == 'system':
+            head = [messages[0]]
+            used += counts[0]
+            messages = messages[1:]
+            counts = counts[1:]
+
+        # Walk backwards from the newest message, the newest one is always sent
+        start = len(messages)
+        for i in reversed(range(len(messages))):
+            if used + counts[i] > self.budget and start < len(messages):
+                break
+            used += counts[i]
+            start = i
+
+        self.sent_tokens = used
+        self.trimmed_messages = start
+        if start:
+            logging.debug(f'Trimmed {start} messages to fit {self.budget} tokens')
+        return head + messages[start:]
+
+    def counts(self):
+        """
+        Get the token counts of the last fit.
+
+        Returns:
+            dict: The total tokens in the conversation, the tokens sent, the budget and
+                the number of messages left out.
+        """
+        return {'total': self.total_tokens,
+                'sent': self.sent_tokens,
+                'budget': self.budget,
+                'trimmed_messages': self.trimmed_messages}
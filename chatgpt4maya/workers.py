@@ -0,0 +1,357 @@
+"""workers.py
+Preview code blocks in headless mayapy processes before running them in the live session.
+
+The pool keeps a few mayapy workers running. Each preview opens a copy of the scene,
+or an export of the selection, in a worker, runs the code block there and reports
+back how it went. A hanging or crashing script only takes the worker down, which is
+restarted for the next preview.
+
+Run as `mayapy -m chatgpt4maya.workers` it is the worker itself, reading jobs as json
+lines on stdin and answering on stdout.
+"""
+import json
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from chatgpt4maya import config, execution, metrics
+
+logging.basicConfig(level=logging.INFO, format=config.LOG_FORMAT)
+
+# Folder the scene copies sent to the workers are exported to
+SNAPSHOT_PATH = Path(tempfile.gettempdir()) / 'chatgpt4maya' / 'previews'
+
+# Seconds to wait for mayapy to start
+STARTUP_TIMEOUT = 120
+
+
+class PreviewResult:
+    """How a code block went in a worker."""
+
+    def __init__(self, result, load_elapsed=None, nodes_before=None, nodes_after=None):
+        """
+        Args:
+            result (execution.ExecutionResult): The outcome of running the code.
+            load_elapsed (float, optional): Seconds it took to open the scene. Defaults to None.
+            nodes_before (int, optional): Number of nodes before running the code. Defaults to None.
+            nodes_after (int, optional): Number of nodes after running the code. Defaults to None.
+        """
+        self.result = result
+        self.load_elapsed = load_elapsed
+        self.nodes_before = nodes_before
+        self.nodes_after = nodes_after
+
+    @property
+    def success(self):
+        return self.result.success
+
+    def summary(self):
+        """A one line description to show next to the code block."""
+        summary = f'Preview: {self.result.summary()}'
+        if self.nodes_before is not None and self.nodes_after is not None:
+            summary += f', {self.nodes_after - self.nodes_before:+d} nodes'
+        if self.load_elapsed is not None:
+            summary += f' (scene opened in {self.load_elapsed * 1000:.0f} ms)'
+        return summary
+
+
+def _failed(message, details=None):
+    return PreviewResult(execution.ExecutionResult(None, success=False, error=message, details=details))
+
+
+class WorkerProcess:
+    """A mayapy process running code blocks one at a time."""
+
+    def __init__(self, python=None):
+        """
+        Args:
+            python (str, optional): The mayapy to run. Defaults to the one next to the running Maya.
+
+        Raises:
+            FileNotFoundError: If no python is given and there is no mayapy next to Maya.
+        """
+        self.python = str(python) if python else str(config.python_executable())
+        self.process = None
+        self._job_id = 0
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _read_line(self, timeout):
+        # readline() has no timeout, so the process is killed if it takes too long
+        timer = threading.Timer(timeout, self.stop)
+        timer.daemon = True
+        timer.start()
+        try:
+            return self.process.stdout.readline()
+        finally:
+            timer.cancel()
+
+    def start(self):
+        """Start mayapy and wait until Maya is initialized."""
+        environment = dict(os.environ)
+        repo_path = str(config.REPO_PATH.resolve())
+        environment['PYTHONPATH'] = os.pathsep.join(filter(None, [repo_path, environment.get('PYTHONPATH')]))
+        start = time.perf_counter()
+        self.process = subprocess.Popen([self.python, '-u', '-m', 'chatgpt4maya.workers'],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        env=environment,
+                                        universal_newlines=True,
+                                        encoding='utf-8',
+                                        bufsize=1)
+        line = self._read_line(STARTUP_TIMEOUT)
+        try:
+            ready = bool(line) and json.loads(line).get('ready')
+        except ValueError:
+            ready = False
+        if not ready:
+            self.stop()
+            raise RuntimeError(f'Could not start {self.python}')
+        metrics.histogram('workers.startup_seconds').observe(time.perf_counter() - start)
+        logging.info(f'Started preview worker {self.process.pid} in {time.perf_counter() - start:.1f} s')
+
+    def run(self, code, language=None, scene=None, timeout=300):
+        """
+        Run a code block in the worker, starting it if needed.
+
+        Args:
+            code (str): The code.
+            language (str, optional): The tag after the code fence. Defaults to None.
+            scene (str, optional): Scene to open before running the code. Defaults to an empty scene.
+            timeout (float, optional): Seconds before the worker is killed. Defaults to 300.
+
+        Returns:
+            PreviewResult: How it went.
+        """
+        try:
+            if not self.is_alive():
+                self.start()
+            self._job_id += 1
+            job = {'id': self._job_id, 'code': code, 'language': language, 'scene': scene}
+            self.process.stdin.write(json.dumps(job) + '\n')
+            self.process.stdin.flush()
+            line = self._read_line(timeout)
+        except (OSError, ValueError, RuntimeError) as e:
+            self.stop()
+            return _failed(str(e))
+
+        if not line:
+            self.stop()
+            return _failed(f'The worker stopped or took longer than {timeout} s')
+
+        # Anything else than a reply means the worker is out of step with the jobs
+        try:
+            reply = json.loads(line)
+        except ValueError:
+            self.stop()
+            return _failed(f'The worker sent an unexpected reply: {line.strip()[:200]}')
+        return PreviewResult(execution.ExecutionResult.from_dict(reply['result']),
+                             reply.get('load_elapsed'),
+                             reply.get('nodes_before'),
+                             reply.get('nodes_after'))
+
+    def stop(self):
+        """Kill the process, it is started again by the next run."""
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait(5)
+
+
+class WorkerPool:
+    """
+    A few worker processes previewing code blocks in parallel.
+
+    Previews are submitted from the main thread and answered with futures, each
+    preview takes the next free worker.
+    """
+
+    def __init__(self, size=2, python=None, timeout=300):
+        """
+        Args:
+            size (int, optional): Number of worker processes. Defaults to 2.
+            python (str, optional): The mayapy to run. Defaults to the one next to the running Maya.
+            timeout (float, optional): Seconds a preview may take. Defaults to 300.
+        """
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._workers = [WorkerProcess(python) for _ in range(size)]
+        for worker in self._workers:
+            self._idle.put(worker)
+        self._executor = ThreadPoolExecutor(max_workers=size)
+
+    def _run(self, code, language, scene):
+        # The most recently used worker is taken first, it's the one most likely to be running
+        worker = self._idle.get()
+        try:
+            start = time.perf_counter()
+            preview = worker.run(code, language, scene, self.timeout)
+            metrics.histogram('workers.preview_seconds').observe(time.perf_counter() - start)
+            return preview
+        finally:
+            self._idle.put(worker)
+
+    def submit(self, code, language=None, scene=None):
+        """
+        Preview a code block in the next free worker.
+
+        Args:
+            code (str): The code.
+            language (str, optional): The tag after the code fence. Defaults to None.
+            scene (str, optional): Scene to open before running the code, see snapshot(). Defaults
+                to an empty scene.
+
+        Returns:
+            concurrent.futures.Future: A future for the PreviewResult.
+        """
+        return self._executor.submit(self._run, code, language, scene)
+
+    def stop(self):
+        """Kill the workers, previews that are running report an error."""
+        self._executor.shutdown(wait=False)
+        for worker in self._workers:
+            worker.stop()
+
+
+def snapshot(selection=False):
+    """
+    Export a copy of the scene, or of the selection, for the workers to open.
+
+    Saved scenes are copied too, so code that saves in a preview never overwrites the
+    scene the artist is working on. Must be called from the main thread.
+
+    Args:
+        selection (bool, optional): Only export the selected nodes, if anything is selected. Defaults to False.
+
+    Returns:
+        str: The path to the scene.
+    """
+    from maya import cmds
+
+    if selection and cmds.ls(selection=True):
+        return _export(SNAPSHOT_PATH / f'selection-{uuid.uuid4().hex}.mb', exportSelected=True)
+
+    return _export(SNAPSHOT_PATH / f'scene-{uuid.uuid4().hex}.mb', exportAll=True)
+
+
+def _export(path, **flags):
+    from maya import cmds
+
+    # Remove what was written if the export fails part way
+    SNAPSHOT_PATH.mkdir(exist_ok=True, parents=True)
+    try:
+        cmds.file(str(path), type='mayaBinary', force=True, preserveReferences=True, **flags)
+    except Exception:
+        remove_snapshot(path)
+        raise
+    return str(path)
+
+
+def remove_snapshot(path):
+    """
+    Delete a scene exported by snapshot(), other scenes are never deleted.
+
+    Args:
+        path (str): The path returned by snapshot().
+    """
+    path = Path(path)
+    if path.parent == SNAPSHOT_PATH and path.exists():
+        try:
+            path.unlink()
+        except OSError as e:
+            logging.warning(f'Could not remove {path}: {e}')
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool(size=2):
+    """
+    Get the worker pool shared by the whole session, creating it if needed.
+
+    Args:
+        size (int, optional): Number of worker processes, only used when the pool is created. Defaults to 2.
+
+    Returns:
+        WorkerPool: The pool.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(size)
+        return _pool
+
+
+def shutdown():
+    """Stop the shared pool, if it was started, and remove the exported scenes."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.stop()
+            _pool = None
+    shutil.rmtree(str(SNAPSHOT_PATH), ignore_errors=True)
+
+
+def serve():
+    """Run as a worker, answering jobs from stdin until it is closed."""
+    # Keep stdout for the replies, everything printed by Maya or the code goes to stderr
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    # maya.cmds is only imported once Maya is initialized, which is why it isn't imported
+    # at the top of the module
+    import maya.standalone
+
+    maya.standalone.initialize(name='python')
+    from maya import cmds
+
+    replies.write(json.dumps({'ready': True}) + '\n')
+    replies.flush()
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+
+        start = time.perf_counter()
+        try:
+            if job.get('scene'):
+                cmds.file(job['scene'], open=True, force=True)
+            else:
+                cmds.file(new=True, force=True)
+        except RuntimeError as e:
+            result = execution.ExecutionResult(job.get('language'), success=False,
+                                               error=f'Could not open {job["scene"]}: {e}')
+            replies.write(json.dumps({'id': job['id'], 'result': result.to_dict()}) + '\n')
+            replies.flush()
+            continue
+        load_elapsed = time.perf_counter() - start
+
+        nodes_before = len(cmds.ls())
+        result = execution.run(job['code'], job.get('language'))
+        reply = {'id': job['id'],
+                 'result': result.to_dict(),
+                 'load_elapsed': load_elapsed,
+                 'nodes_before': nodes_before,
+                 'nodes_after': len(cmds.ls())}
+        replies.write(json.dumps(reply) + '\n')
+        replies.flush()
+
+    maya.standalone.uninitialize()
+
+
+if __name__ == '__main__':
+    serve()
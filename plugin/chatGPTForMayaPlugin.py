@@ -1,10 +1,14 @@
-from chatgpt4maya.app import create_menu, delete_menu
+import os
+
+# Only the menu is loaded with the plugin, the chat window is loaded when it's first needed
+from chatgpt4maya.menu import create_menu, delete_menu, shutdown
 from chatgpt4maya.config import MENU
 
 
 def initializePlugin(*args, **kwargs):
-    create_menu()
+    create_menu(prefetch_modules=os.getenv('CHATGPT4MAYA_PREFETCH', '1') != '0')
 
 
 def uninitializePlugin(*args, **kwargs):
     delete_menu(MENU)
+    shutdown()